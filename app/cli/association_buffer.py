@@ -0,0 +1,238 @@
+import logging
+
+from db_bulk import chunked
+
+# ==============================================================================
+# product_categories 紐付けバッファ
+# = (products.id, categories.id) の組をメモリ上で重複排除し、
+#   複数行の INSERT IGNORE でまとめて書き込む (ProductCategoryLinkBuffer: 追加のみ)。
+#   ProductCategoryLinkSync は製品ごとの紐付けの集合を現在の product_categories と比較し、
+#   追加分の INSERT と削除分の DELETE だけを書き込む (差分同期)。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_FLUSH_SIZE = 1000
+# 紐付けの書き込みモード: append = 追加のみ (ProductCategoryLinkBuffer), sync = 差分同期 (ProductCategoryLinkSync)
+# sync は処理した製品の紐付けのうち統合結果にないものを削除するため、他の経路 (classify_and_populate_products.py や
+# 管理画面) で追加した紐付けも消える。そのためデフォルトは append とし、sync は明示的に指定した場合だけ使う。
+LINK_MODES = ('append', 'sync')
+DEFAULT_LINK_MODE = 'append'
+# 現在の紐付けを読み込む SELECT 1回あたりの最大製品数
+SYNC_LOAD_CHUNK_SIZE = 1000
+
+
+class ProductCategoryLinkBuffer:
+    """
+    product_categories への紐付けをバッファし、flush_size 件ごとに
+    1ステートメントの INSERT IGNORE で送信するクラス。
+    同じ (product_id, category_id) は reset() されるまで一度しか送信しない。
+
+    書き込みは呼び出し元のトランザクション内で行われるため、
+    コミット前に flush() し、コミット後に reset()、ロールバック後に discard() を呼ぶこと。
+    """
+
+    def __init__(self, flush_size: int = DEFAULT_FLUSH_SIZE):
+        self.flush_size = max(1, flush_size)
+        self._pending = []
+        self._seen = set()
+        # 統計情報
+        self.rows_sent = 0               # INSERT IGNORE で送信した行数
+        self.rows_inserted = 0           # 実際に新規挿入された行数
+        self.duplicates_skipped = 0      # メモリ上の重複排除で送信しなかった行数
+        self.statements_executed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def add(self, cursor, product_db_id: int, category_id: int):
+        """紐付けを1件追加する。バッファが flush_size に達したら自動的に flush する。"""
+        pair = (product_db_id, category_id)
+        if pair in self._seen:
+            self.duplicates_skipped += 1
+            return
+        self._seen.add(pair)
+        self._pending.append(pair)
+        if len(self._pending) >= self.flush_size:
+            self.flush(cursor)
+
+    def set_product_links(self, cursor, product_db_id: int, category_ids):
+        """1製品分の紐付けを追加する (追加のみのため、既存の紐付けは削除しない)。"""
+        for category_id in category_ids:
+            self.add(cursor, product_db_id, category_id)
+
+    def flush(self, cursor) -> int:
+        """バッファ内の紐付けを INSERT IGNORE で送信し、新規挿入された行数を返す。"""
+        if not self._pending:
+            return 0
+        inserted = 0
+        for chunk in chunked(self._pending, self.flush_size):
+            placeholders = ", ".join(["(%s, %s)"] * len(chunk))
+            params = [value for pair in chunk for value in pair]
+            cursor.execute(f"INSERT IGNORE INTO product_categories (product_id, category_id) VALUES {placeholders}", params)
+            inserted += max(cursor.rowcount, 0)
+            self.rows_sent += len(chunk)
+            self.statements_executed += 1
+        self.rows_inserted += inserted
+        logger.debug("product_categories に %d 件を送信しました (新規 %d 件)。", len(self._pending), inserted)
+        self._pending = []
+        return inserted
+
+    def reset(self):
+        """コミット後に呼ぶ。重複排除用の記録をクリアする。"""
+        self._pending = []
+        self._seen.clear()
+
+    def discard(self):
+        """ロールバック後に呼ぶ。未送信の紐付けと重複排除用の記録を破棄する。"""
+        self.reset()
+
+    def mark(self):
+        """セーブポイントの作成時に呼び、rollback_to() に渡す位置を返す。"""
+        return (self._pending, len(self._pending))
+
+    def rollback_to(self, mark):
+        """
+        ROLLBACK TO SAVEPOINT の後に呼び、バッファをセーブポイント時点の内容に戻す。
+        セーブポイント以降に flush した行はDB側で取り消されるため、
+        セーブポイント以前に追加した分は未送信として戻す
+        (flush は新しいリストに差し替えるので、mark 時点のリストは内容を保持している)。
+        """
+        pending, length = mark
+        self._pending = pending[:length]
+
+    def stats(self) -> dict:
+        """送信行数・新規挿入数・重複スキップ数などの統計を返す。"""
+        return {
+            'rows_sent': self.rows_sent,
+            'rows_inserted': self.rows_inserted,
+            'rows_ignored_by_db': self.rows_sent - self.rows_inserted,
+            'duplicates_skipped': self.duplicates_skipped,
+            'statements_executed': self.statements_executed,
+        }
+
+
+class ProductCategoryLinkSync:
+    """
+    product_categories を製品ごとのあるべき紐付けの集合に同期するクラス。
+    ProductCategoryLinkBuffer と同じく呼び出し元のトランザクション内で書き込み、
+    flush / reset / discard / mark / rollback_to の使い方も同じ。
+
+    set_product_links() で製品ごとのカテゴリIDの集合を登録し、flush() で登録済みの製品の
+    現在の紐付けを SELECT 1回 (SYNC_LOAD_CHUNK_SIZE 製品ごと) で読み込んで差分を計算する。
+    追加分は複数行の INSERT IGNORE、削除分は (product_id, category_id) IN (...) の DELETE で書き込むため、
+    書き込み量は実際に変わった紐付けの数だけになる。
+    同じ製品が flush までに複数回登録された場合は、後から登録した集合を使う。
+    """
+
+    def __init__(self, flush_size: int = DEFAULT_FLUSH_SIZE):
+        self.flush_size = max(1, flush_size)
+        self._pending = []
+        self._pending_links = 0
+        # 統計情報
+        self.products_synced = 0         # 差分を計算した製品数
+        self.links_unchanged = 0         # 既に存在したため書き込まなかった紐付けの数
+        self.rows_inserted = 0           # 追加した紐付けの数
+        self.rows_deleted = 0            # 削除した紐付けの数
+        self.statements_executed = 0
+
+    def __len__(self):
+        return len(self._pending)
+
+    def set_product_links(self, cursor, product_db_id: int, category_ids):
+        """
+        1製品分のあるべき紐付けを登録する。
+        登録済みの紐付けの数または製品数が flush_size に達したら自動的に flush する。
+        """
+        category_ids = frozenset(category_ids)
+        self._pending.append((product_db_id, category_ids))
+        self._pending_links += len(category_ids)
+        if self._pending_links >= self.flush_size or len(self._pending) >= self.flush_size:
+            self.flush(cursor)
+
+    def flush(self, cursor) -> int:
+        """登録済みの製品の紐付けを同期し、追加した行数を返す。"""
+        if not self._pending:
+            return 0
+        desired_links = dict(self._pending)
+
+        current_links = {product_db_id: set() for product_db_id in desired_links}
+        for chunk in chunked(list(desired_links), SYNC_LOAD_CHUNK_SIZE):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"SELECT product_id, category_id FROM product_categories WHERE product_id IN ({placeholders})", chunk)
+            for product_db_id, category_id in cursor.fetchall():
+                current_links[product_db_id].add(category_id)
+            self.statements_executed += 1
+
+        additions = []
+        removals = []
+        for product_db_id, category_ids in desired_links.items():
+            existing = current_links[product_db_id]
+            additions.extend((product_db_id, category_id) for category_id in category_ids - existing)
+            removals.extend((product_db_id, category_id) for category_id in existing - category_ids)
+            self.links_unchanged += len(category_ids & existing)
+
+        # 通常は追加・削除それぞれ1ステートメント (max_allowed_packet を超えないよう flush_size 件ごとに分割する)
+        for chunk in chunked(removals, self.flush_size):
+            placeholders = ", ".join(["(%s, %s)"] * len(chunk))
+            params = [value for pair in chunk for value in pair]
+            cursor.execute(f"DELETE FROM product_categories WHERE (product_id, category_id) IN ({placeholders})", params)
+            self.rows_deleted += max(cursor.rowcount, 0)
+            self.statements_executed += 1
+
+        inserted = 0
+        for chunk in chunked(additions, self.flush_size):
+            # 同時に実行中の他プロセスが同じ紐付けを追加した場合に備えて INSERT IGNORE を使う
+            placeholders = ", ".join(["(%s, %s)"] * len(chunk))
+            params = [value for pair in chunk for value in pair]
+            cursor.execute(f"INSERT IGNORE INTO product_categories (product_id, category_id) VALUES {placeholders}", params)
+            inserted += max(cursor.rowcount, 0)
+            self.statements_executed += 1
+        self.rows_inserted += inserted
+
+        self.products_synced += len(desired_links)
+        logger.debug("product_categories を %d 製品分同期しました (追加 %d 件, 削除 %d 件)。", len(desired_links), len(additions), len(removals))
+        self._pending = []
+        self._pending_links = 0
+        return inserted
+
+    def reset(self):
+        """コミット後に呼ぶ。"""
+        self._pending = []
+        self._pending_links = 0
+
+    def discard(self):
+        """ロールバック後に呼ぶ。未送信の紐付けを破棄する。"""
+        self.reset()
+
+    def mark(self):
+        """セーブポイントの作成時に呼び、rollback_to() に渡す位置を返す。"""
+        return (self._pending, len(self._pending))
+
+    def rollback_to(self, mark):
+        """
+        ROLLBACK TO SAVEPOINT の後に呼び、登録内容をセーブポイント時点に戻す
+        (ProductCategoryLinkBuffer.rollback_to と同じく、flush は新しいリストに差し替える)。
+        """
+        pending, length = mark
+        self._pending = pending[:length]
+        self._pending_links = sum(len(category_ids) for _, category_ids in self._pending)
+
+    def stats(self) -> dict:
+        """同期した製品数・追加数・削除数などの統計を返す。"""
+        return {
+            'products_synced': self.products_synced,
+            'links_unchanged': self.links_unchanged,
+            'rows_inserted': self.rows_inserted,
+            'rows_deleted': self.rows_deleted,
+            'statements_executed': self.statements_executed,
+        }
+
+
+def create_link_writer(link_mode: str = DEFAULT_LINK_MODE, flush_size: int = DEFAULT_FLUSH_SIZE):
+    """link_mode ('sync' / 'append') に応じた紐付けの書き込みクラスを返す。"""
+    if link_mode == 'append':
+        return ProductCategoryLinkBuffer(flush_size)
+    if link_mode == 'sync':
+        return ProductCategoryLinkSync(flush_size)
+    raise ValueError(f"不正な link_mode です: {link_mode}")
@@ -0,0 +1,375 @@
+import argparse
+import json
+import logging
+import platform
+import random
+import sys
+import time
+from datetime import datetime
+
+import populate_products_and_categories as populate
+from association_buffer import ProductCategoryLinkBuffer
+from category_cache import CategoryResolver
+from duga_payloads import generate_product_raw_rows
+from json_codec import JSON_BACKEND, decode_raw_rows
+from merge_state import MERGE_STATE_COLUMNS, MERGE_STATE_TABLE
+from raw_data import RawProcessedMarker
+
+# ==============================================================================
+# ホットパスのマイクロベンチマーク
+# = populate_products_and_categories.py の CPU だけで完結する処理 (フィールド抽出プラン・値の変換・カテゴリの平坦化・
+#   画像候補の選定・製品の統合) を合成 Duga ペイロードで計測し、items/秒 を報告する。
+#   DB アクセスはメモリ上の InMemoryCursor で置き換えるため、MySQL は不要。
+#   --save-baseline で結果を保存し、次回以降 --baseline で比較すると items/秒 の低下を検出できる。
+#
+#   使い方:
+#     python app/cli/bench_hot_paths.py --save-baseline /tmp/bench_baseline.json
+#     python app/cli/bench_hot_paths.py --baseline /tmp/bench_baseline.json --threshold 0.1
+# ==============================================================================
+
+DEFAULT_PRODUCTS = 2000
+DEFAULT_SNAPSHOTS = 3
+DEFAULT_REPEAT = 5
+DEFAULT_THRESHOLD = 0.10 # 10% 以上の低下を回帰とみなす
+
+
+class InMemoryCursor:
+    """
+    process_single_product_id_batch が発行する SQL にだけ応答するメモリ上のカーソル。
+    products・categories・product_merge_state を辞書で保持し、実行したステートメント数を数える。
+    """
+
+    def __init__(self):
+        self.products = {}
+        self.categories = {}
+        self.merge_states = {}
+        self.statements = 0
+        self.rowcount = 0
+        self.lastrowid = None
+        self._result = []
+
+    def execute(self, sql, params=()):
+        self.statements += 1
+        self._result = []
+        self.rowcount = 0
+        statement = sql.lstrip()
+        if statement.startswith("SELECT id, content_hash FROM products"):
+            existing = self.products.get(params[0])
+            self._result = [existing] if existing else []
+        elif statement.startswith("INSERT INTO products"):
+            self.lastrowid = len(self.products) + 1
+            self.products[params[0]] = (self.lastrowid, params[20])
+            self.rowcount = 1
+        elif statement.startswith("UPDATE products"):
+            product_db_id = self.products[params[-1]][0]
+            self.products[params[-1]] = (product_db_id, params[19])
+            self.rowcount = 1
+        elif statement.startswith("SELECT type, name, id FROM categories WHERE"):
+            keys = [tuple(params[i:i + 2]) for i in range(0, len(params), 2)]
+            self._result = [(key[0], key[1], self.categories[key]) for key in keys if key in self.categories]
+        elif statement.startswith("SELECT type, name, id FROM categories"):
+            self._result = [(key[0], key[1], category_id) for key, category_id in self.categories.items()]
+        elif statement.startswith("INSERT INTO categories"):
+            for i in range(0, len(params), 2):
+                self.categories.setdefault(tuple(params[i:i + 2]), len(self.categories) + 1)
+            self.rowcount = len(params) // 2
+        elif statement.startswith("SELECT product_id, genres_json, actresses_json, series_json, image_candidates_json"):
+            source_api_name = params[0]
+            self._result = [
+                (product_id,) + self.merge_states[(product_id, source_api_name)]
+                for product_id in params[1:] if (product_id, source_api_name) in self.merge_states
+            ]
+        elif statement.startswith("SELECT product_id, genres_json, actresses_json, series_json, main_image_url"):
+            # products は (id, content_hash) だけを保持するため、状態の初期値になる *_json はない (新規製品と同じ扱い)
+            self._result = []
+        elif statement.startswith(f"INSERT INTO `{MERGE_STATE_TABLE}`"):
+            column_count = len(MERGE_STATE_COLUMNS)
+            for i in range(0, len(params), column_count):
+                product_id, source_api_name, *values = params[i:i + column_count]
+                # SELECT と同じ列順 (updated_at を除く) で保持する
+                self.merge_states[(product_id, source_api_name)] = tuple(values[:-1])
+            self.rowcount = len(params) // column_count
+        elif statement.startswith(("INSERT IGNORE INTO product_categories", "UPDATE raw_api_data")):
+            self.rowcount = len(params)
+        else:
+            raise NotImplementedError(f"InMemoryCursor が対応していない SQL です: {statement[:60]}")
+
+    def fetchone(self):
+        return self._result[0] if self._result else None
+
+    def fetchall(self):
+        return self._result
+
+
+class InMemoryConnection:
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def is_connected(self):
+        return True
+
+
+# ==============================================================================
+# ベンチマークケース
+# = 各関数はデータセットを受け取り、(計測対象の引数なし関数, 1回の呼び出しで処理する件数) を返す
+# ==============================================================================
+
+def case_product_plan(dataset):
+    items = dataset['items']
+
+    def run():
+        product_plan = populate.DUGA_PRODUCT_PLAN
+        for item in items:
+            product_plan(item)
+    return run, len(items)
+
+
+def case_snapshot_plan(dataset):
+    items = dataset['items']
+
+    def run():
+        snapshot_plan = populate.DUGA_SNAPSHOT_PLAN
+        for item in items:
+            snapshot_plan(item)
+    return run, len(items)
+
+
+def case_image_candidate_plan(dataset):
+    items = dataset['items']
+
+    def run():
+        image_candidate_plan = populate.DUGA_IMAGE_CANDIDATE_PLAN
+        for item in items:
+            image_candidate_plan(item)
+    return run, len(items)
+
+
+def case_clean_string(dataset):
+    values = [value for item in dataset['items'] for value in (item['title'], item['caption'], item['makername'], None, '   ')]
+
+    def run():
+        clean_string = populate.clean_string
+        for value in values:
+            clean_string(value)
+    return run, len(values)
+
+
+def case_parse_date(dataset):
+    values = [item['releasedate'] for item in dataset['items']]
+
+    def run():
+        parse_date = populate.parse_date
+        for value in values:
+            parse_date(value)
+    return run, len(values)
+
+
+def case_convert_to_float(dataset):
+    values = [item['price'] for item in dataset['items']]
+
+    def run():
+        convert_to_float = populate.convert_to_float
+        for value in values:
+            convert_to_float(value)
+    return run, len(values)
+
+
+def case_flatten_genres(dataset):
+    items = dataset['items']
+
+    def run():
+        for item in items:
+            populate.collect_category_names(populate.flatten_category_entries(item.get('category')), set())
+    return run, len(items)
+
+
+def case_flatten_performers(dataset):
+    items = dataset['items']
+
+    def run():
+        for item in items:
+            populate.collect_category_names(populate.flatten_category_entries(item.get('performer')), set())
+    return run, len(items)
+
+
+def case_image_candidates(dataset):
+    items = dataset['items']
+
+    def run():
+        for item in items:
+            candidates = []
+            populate.collect_image_candidates(item, candidates)
+            list(dict.fromkeys(candidates))
+    return run, len(items)
+
+
+def case_json_decode(dataset):
+    raw_rows = list(dataset['raw_rows_by_key'].values())
+
+    def run():
+        for rows in raw_rows:
+            decode_raw_rows(rows)
+    return run, sum(len(rows) for rows in raw_rows)
+
+
+def case_merge_product(dataset):
+    products = [(key, rows, decode_raw_rows(rows)) for key, rows in dataset['raw_rows_by_key'].items()]
+
+    def run():
+        for (product_id, source_api), rows, decoded in products:
+            populate.merge_raw_rows_for_product(product_id, source_api, rows, decoded)
+    return run, len(products)
+
+
+def case_process_single_product(dataset):
+    raw_rows_by_key = dataset['raw_rows_by_key']
+
+    def run():
+        cursor = InMemoryCursor()
+        conn = InMemoryConnection()
+        category_resolver = CategoryResolver()
+        category_resolver.preload(cursor)
+        link_buffer = ProductCategoryLinkBuffer()
+        processed_marker = RawProcessedMarker()
+        for (product_id, source_api), rows in raw_rows_by_key.items():
+            populate.process_single_product_id_batch(
+                cursor, conn, product_id, source_api, category_resolver, link_buffer, processed_marker,
+                preloaded_raw_rows=rows,
+            )
+        link_buffer.flush(cursor)
+        processed_marker.flush(cursor)
+    return run, len(raw_rows_by_key)
+
+
+BENCHMARK_CASES = {
+    'product_plan': case_product_plan,
+    'snapshot_plan': case_snapshot_plan,
+    'image_candidate_plan': case_image_candidate_plan,
+    'clean_string': case_clean_string,
+    'parse_date': case_parse_date,
+    'convert_to_float': case_convert_to_float,
+    'flatten_genres': case_flatten_genres,
+    'flatten_performers': case_flatten_performers,
+    'image_candidates': case_image_candidates,
+    'json_decode': case_json_decode,
+    'merge_product': case_merge_product,
+    'process_single_product': case_process_single_product,
+}
+
+
+def build_dataset(params: dict) -> dict:
+    """params の条件で合成ペイロードを生成し、デコード済みの item リストと raw 行の辞書を返す。"""
+    rng = random.Random(params['seed'])
+    raw_rows_by_key = generate_product_raw_rows(
+        rng, params['products'], params['snapshots'],
+        categories=params['categories'], performers=params['performers'],
+        posterimages=params['posterimages'], jacketimages=params['jacketimages'],
+    )
+    items = [json.loads(row[1]) for rows in raw_rows_by_key.values() for row in rows]
+    return {'items': items, 'raw_rows_by_key': raw_rows_by_key}
+
+
+def run_benchmarks(params: dict, case_names, repeat: int) -> dict:
+    """
+    各ケースを repeat 回実行し、最速の回の items/秒 を記録する。
+    最速値を使うのは、他プロセスの影響などによる一時的な遅延を比較から除くため。
+    """
+    dataset = build_dataset(params)
+    results = {}
+    for name in case_names:
+        run, items = BENCHMARK_CASES[name](dataset)
+        timings = []
+        for _ in range(repeat):
+            started = time.perf_counter()
+            run()
+            timings.append(time.perf_counter() - started)
+        best = min(timings)
+        results[name] = {
+            'items': items,
+            'best_seconds': best,
+            'mean_seconds': sum(timings) / len(timings),
+            'items_per_second': items / best if best > 0 else 0.0,
+        }
+        print(f"{name:<24} {results[name]['items_per_second']:>14,.0f} items/s  (best {best * 1000:.2f} ms, {items} items)")
+    return results
+
+
+def compare_with_baseline(results: dict, baseline: dict, threshold: float) -> list:
+    """
+    ベースラインとの items/秒 の変化率を表示し、threshold を超えて低下したケース名のリストを返す。
+    """
+    regressions = []
+    print()
+    print(f"ベースライン ({baseline.get('created_at')}, {baseline.get('json_backend')}) との比較:")
+    for name, result in results.items():
+        base = baseline['results'].get(name)
+        if not base or not base['items_per_second']:
+            print(f"  {name:<24} (ベースラインなし)")
+            continue
+        change = result['items_per_second'] / base['items_per_second'] - 1.0
+        flag = ''
+        if change < -threshold:
+            flag = '  << 回帰'
+            regressions.append(name)
+        print(f"  {name:<24} {base['items_per_second']:>14,.0f} -> {result['items_per_second']:>14,.0f} items/s  ({change:+.1%}){flag}")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="合成 Duga ペイロードで populate のホットパスを計測します (MySQL 不要)。")
+    parser.add_argument('--products', type=int, default=DEFAULT_PRODUCTS, help="生成する製品数")
+    parser.add_argument('--snapshots', type=int, default=DEFAULT_SNAPSHOTS, help="1製品あたりのスナップショット (raw_api_data 行) 数")
+    parser.add_argument('--categories', type=int, default=3, help="1スナップショットあたりの category エントリ数")
+    parser.add_argument('--performers', type=int, default=2, help="1スナップショットあたりの performer エントリ数")
+    parser.add_argument('--posterimages', type=int, default=1, help="1スナップショットあたりの posterimage エントリ数")
+    parser.add_argument('--jacketimages', type=int, default=1, help="1スナップショットあたりの jacketimage エントリ数")
+    parser.add_argument('--seed', type=int, default=42, help="ペイロード生成の乱数シード")
+    parser.add_argument('--repeat', type=int, default=DEFAULT_REPEAT, help="各ケースの実行回数 (最速の回を採用)")
+    parser.add_argument('--cases', nargs='+', choices=sorted(BENCHMARK_CASES), default=list(BENCHMARK_CASES),
+                        help="実行するケース (省略時は全ケース)")
+    parser.add_argument('--baseline', default=None, help="比較するベースライン JSON のパス")
+    parser.add_argument('--threshold', type=float, default=DEFAULT_THRESHOLD,
+                        help="items/秒 がこの割合を超えて低下したケースを回帰とみなす (デフォルト: 0.10)")
+    parser.add_argument('--save-baseline', default=None, help="今回の結果をベースラインとして保存する JSON のパス")
+    args = parser.parse_args()
+
+    # 製品ごとの INFO ログが計測結果を支配しないよう、ベンチマーク中は WARNING 以上のみ出力する
+    populate.logger.setLevel(logging.WARNING)
+
+    params = {
+        'products': args.products,
+        'snapshots': args.snapshots,
+        'categories': args.categories,
+        'performers': args.performers,
+        'posterimages': args.posterimages,
+        'jacketimages': args.jacketimages,
+        'seed': args.seed,
+    }
+    print(f"Python {platform.python_version()} / JSON バックエンド: {JSON_BACKEND} / パラメータ: {params}")
+    results = run_benchmarks(params, args.cases, args.repeat)
+
+    regressions = []
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            baseline = json.load(f)
+        if baseline.get('params') != params:
+            print(f"警告: ベースラインと生成パラメータが異なります (ベースライン: {baseline.get('params')})。")
+        regressions = compare_with_baseline(results, baseline, args.threshold)
+
+    if args.save_baseline:
+        with open(args.save_baseline, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'json_backend': JSON_BACKEND,
+                'params': params,
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+        print(f"ベースラインを保存しました: {args.save_baseline}")
+
+    if regressions:
+        print(f"{len(regressions)} 件のケースで {args.threshold:.0%} を超える性能低下が検出されました: {', '.join(regressions)}")
+        sys.exit(1)
@@ -0,0 +1,134 @@
+import logging
+
+import mysql.connector
+
+from db_bulk import chunked
+
+# ==============================================================================
+# カテゴリIDキャッシュ
+# = categories テーブルを (type, name) -> id の辞書としてメモリに保持し、
+#   get_or_create_category の製品ごとの SELECT を不要にする
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+# 未登録カテゴリを一度に INSERT する最大件数
+DEFAULT_INSERT_CHUNK_SIZE = 500
+
+
+class CategoryResolver:
+    """
+    categories テーブルの (type, name) -> id をメモリ上で解決するクラス。
+    起動時に preload() で全件を読み込み、以降はキャッシュから返す。
+    キャッシュにない名前だけを複数行 INSERT でまとめて作成する。
+
+    作成したカテゴリは呼び出し元のトランザクション内で INSERT されるため、
+    コミット後に on_commit()、ロールバック後に on_rollback() を呼ぶこと。
+    ロールバックされたIDがキャッシュに残らないようにするため。
+    """
+
+    def __init__(self, insert_chunk_size: int = DEFAULT_INSERT_CHUNK_SIZE):
+        self.insert_chunk_size = insert_chunk_size
+        self._ids = {}
+        self._pending_keys = set() # 未コミットのトランザクションで作成したキー
+        self._pending_order = []   # _pending_keys を作成順に並べたもの (セーブポイントへの巻き戻し用)
+        self.created_count = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    def preload(self, cursor):
+        """categories テーブル全件をキャッシュに読み込む。"""
+        cursor.execute("SELECT type, name, id FROM categories")
+        self._ids = {(category_type, name): category_id for category_type, name, category_id in cursor.fetchall()}
+        self._pending_keys.clear()
+        self._pending_order = []
+        logger.info("categories を %d 件キャッシュに読み込みました。", len(self._ids))
+        return len(self._ids)
+
+    def get(self, category_type: str, category_name: str):
+        """キャッシュ済みのカテゴリIDを返す。未登録の場合は None。"""
+        return self._ids.get((category_type, category_name))
+
+    def resolve(self, cursor, category_type: str, category_name: str) -> int:
+        """1件のカテゴリIDを返す。キャッシュにない場合は作成する。"""
+        key = (category_type, category_name)
+        category_id = self._ids.get(key)
+        if category_id is None:
+            category_id = self.resolve_many(cursor, [key])[key]
+        return category_id
+
+    def resolve_many(self, cursor, keys) -> dict:
+        """
+        (type, name) のリストをまとめて解決し、{(type, name): id} を返す。
+        キャッシュにないものは複数行 INSERT で作成してからIDを取得する。
+        """
+        missing_keys = [key for key in dict.fromkeys(keys) if key not in self._ids]
+        for chunk in chunked(missing_keys, self.insert_chunk_size):
+            self._create_missing(cursor, chunk)
+        return {key: self._ids[key] for key in keys}
+
+    def _create_missing(self, cursor, keys):
+        """
+        未登録カテゴリを1ステートメントで INSERT し、IDを読み戻してキャッシュする。
+        他プロセスが同時に同じカテゴリを作成した場合 (1062 Duplicate entry) は
+        INSERT IGNORE でやり直し、1件ずつ既存IDを再取得する。
+        """
+        placeholders = ", ".join(["(%s, %s)"] * len(keys))
+        params = [value for key in keys for value in key]
+        try:
+            cursor.execute(f"INSERT INTO categories (type, name) VALUES {placeholders}", params)
+        except mysql.connector.Error as err:
+            if err.errno != 1062: # Duplicate entry for key 'uk_type_name' 以外は再スロー
+                raise
+            logger.warning("カテゴリの一括作成中に重複が検出されたため、INSERT IGNORE で再試行します (%d 件)。", len(keys))
+            cursor.execute(f"INSERT IGNORE INTO categories (type, name) VALUES {placeholders}", params)
+            created_rows = cursor.rowcount
+            for key in keys:
+                cursor.execute("SELECT id FROM categories WHERE type = %s AND name = %s", key)
+                result = cursor.fetchone()
+                if result is None:
+                    logger.error("カテゴリ '%s' - '%s' の重複作成後の再取得に失敗しました。", key[0], key[1])
+                    raise
+                self._ids[key] = result[0]
+            # どのキーが新規作成されたかは区別できないため、全キーを未コミット扱いにする
+            self._add_pending(keys)
+            self.created_count += max(created_rows, 0)
+            return
+
+        where_clause = " OR ".join(["(type = %s AND name = %s)"] * len(keys))
+        cursor.execute(f"SELECT type, name, id FROM categories WHERE {where_clause}", params)
+        for category_type, name, category_id in cursor.fetchall():
+            self._ids[(category_type, name)] = category_id
+        self._add_pending(keys)
+        self.created_count += len(keys)
+        logger.info("新しいカテゴリを %d 件作成しました。", len(keys))
+
+    def _add_pending(self, keys):
+        for key in keys:
+            if key not in self._pending_keys:
+                self._pending_keys.add(key)
+                self._pending_order.append(key)
+
+    def on_commit(self):
+        """トランザクションのコミット後に呼ぶ。作成済みカテゴリを確定扱いにする。"""
+        self._pending_keys.clear()
+        self._pending_order = []
+
+    def on_rollback(self):
+        """トランザクションのロールバック後に呼ぶ。未コミットのカテゴリをキャッシュから除く。"""
+        for key in self._pending_keys:
+            self._ids.pop(key, None)
+        self._pending_keys.clear()
+        self._pending_order = []
+
+    def mark(self):
+        """セーブポイントの作成時に呼び、rollback_to() に渡す位置を返す。"""
+        return len(self._pending_order)
+
+    def rollback_to(self, mark):
+        """ROLLBACK TO SAVEPOINT の後に呼ぶ。mark 以降に作成したカテゴリをキャッシュから除く。"""
+        for key in self._pending_order[mark:]:
+            self._ids.pop(key, None)
+            self._pending_keys.discard(key)
+        del self._pending_order[mark:]
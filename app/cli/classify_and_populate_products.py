@@ -1,40 +1,30 @@
-import os
+import argparse
 import mysql.connector
 import json
 from datetime import datetime
 
+from association_buffer import ProductCategoryLinkBuffer
+from category_cache import CategoryResolver
+from db_connection import DB_CONFIG, get_connection, release_connection
+from field_map import FieldSpec, compile_field_map
+from group_commit import GroupCommitter
+from json_codec import decode_raw_rows
+from product_hash import compute_product_content_hash, ensure_content_hash_column_exists
+from raw_data import (
+    DEFAULT_PAGE_SIZE, RawProcessedMarker, ensure_work_queue_index_exists, iter_unprocessed_key_pages,
+    load_unprocessed_raw_rows_for_keys, mark_raw_rows_processed,
+)
+
 # Dotenvライブラリを使って.envファイルをロード
 # (このスクリプトが単独で実行される際に環境変数を読み込むため)
 from dotenv import load_dotenv
 load_dotenv()
 
-# MySQL接続情報
-# Docker Compose 環境では 'mysql' がサービス名としてホストになります
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'mysql'),
-    'user': os.getenv('DB_USER', 'root'),
-    'password': os.getenv('DB_PASS', 'password'), # .env の DB_PASS に合わせる
-    'database': os.getenv('DB_NAME', 'tiper')
-}
-
 # ==============================================================================
 # ヘルパー関数群
-# = JSONデータからの安全な値の取得や、型変換など
+# = 日付・数値の型変換など
 # ==============================================================================
 
-def get_safe_value(data, path, default=None):
-    """
-    ネストされたJSONデータから安全に値を取得する。
-    例: get_safe_value(item_data, ['item', 'title'])
-    """
-    current_data = data
-    for key in path:
-        if isinstance(current_data, dict) and key in current_data:
-            current_data = current_data[key]
-        else:
-            return default
-    return current_data
-
 def parse_date(date_str):
     """日付文字列をYYYY-MM-DD形式に変換。無効な場合はNone。"""
     if not date_str:
@@ -76,6 +66,45 @@ def convert_to_float(value, default=0.0):
     except (ValueError, TypeError):
         return default
 
+# ==============================================================================
+# フィールドマップ (raw_api_data の item → products のカラム)
+# = field_map.compile_field_map で1回だけコンパイルし、item 1件から全カラムを1パスで取り出す
+# ==============================================================================
+
+# メイン (最新) のスナップショットから取り出す products のカラム (並びは process_product_batch_from_raw_data での展開順)
+PRODUCT_FIELDS = (
+    FieldSpec('title', ('title',), normalize=clean_string),
+    FieldSpec('original_title', ('original_title',), normalize=clean_string),
+    FieldSpec('caption', ('caption',), normalize=clean_string),
+    FieldSpec('release_date', ('release_date',), normalize=parse_date),
+    FieldSpec('maker_name', ('maker_name',), normalize=clean_string),
+    FieldSpec('item_no', ('item_no',), normalize=clean_string),
+    FieldSpec('price', ('price',), normalize=convert_to_float),
+    FieldSpec('volume', ('volume',), normalize=convert_to_int),
+    FieldSpec('url', ('url',), normalize=clean_string),
+    FieldSpec('affiliate_url', ('affiliate_url',), normalize=clean_string),
+    FieldSpec('sample_movie_url', ('sample_movie_url',), normalize=clean_string),
+    FieldSpec('sample_movie_capture_url', ('sample_movie_capture_url',), normalize=clean_string),
+)
+
+# 画像URLの候補 (large → medium → small の順、同じサイズでは image_url → jacket_url の順で優先)
+IMAGE_CANDIDATE_FIELDS = tuple(
+    FieldSpec(f"{image_key}_{size}", (image_key, size))
+    for size in ('large', 'medium', 'small')
+    for image_key in ('image_url', 'jacket_url')
+)
+
+# 全スナップショットから集めるカテゴリ・シリーズ・画像候補
+SNAPSHOT_FIELDS = (
+    FieldSpec('genres', ('genres',), default=()),
+    FieldSpec('actresses', ('actresses',), default=()),
+    FieldSpec('series_name', ('series', 'name'), normalize=clean_string),
+) + IMAGE_CANDIDATE_FIELDS
+
+PRODUCT_PLAN = compile_field_map(PRODUCT_FIELDS, 'ProductRecord')
+SNAPSHOT_PLAN = compile_field_map(SNAPSHOT_FIELDS, 'SnapshotRecord')
+IMAGE_CANDIDATE_SLICE = slice(len(SNAPSHOT_FIELDS) - len(IMAGE_CANDIDATE_FIELDS), None)
+
 # ==============================================================================
 # データベース操作関数
 # ==============================================================================
@@ -126,32 +155,52 @@ def ensure_processed_at_column_exists(cursor, conn):
             print(f"processed_atカラムの確認または追加エラー: {err}")
             raise # その他のエラーは再スローする
 
-def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, source_api_name: str):
+def mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker=None):
+    """
+    1製品分のraw_api_data行を処理済みにする。
+    processed_marker (RawProcessedMarker) が渡された場合はIDを追加するだけで、
+    UPDATE はコミット直前の processed_marker.flush() でまとめて行う。
+    """
+    raw_ids = [raw_data_row[0] for raw_data_row in all_raw_data_for_product]
+    if processed_marker is not None:
+        processed_marker.add(raw_ids)
+    else:
+        mark_raw_rows_processed(cursor, raw_ids)
+
+def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, source_api_name: str, category_resolver=None, link_buffer=None, processed_marker=None,
+                                        preloaded_raw_rows=None):
     """
     特定の product_id (API側) と source_api に関連するraw_api_data全てを処理し、
     productsテーブルを更新、カテゴリを統合して紐付ける。
+    preloaded_raw_rows が渡された場合は load_unprocessed_raw_rows_for_keys で
+    取得済みの行を使い、製品ごとの SELECT を省略する。
     """
-    # 関連するraw_api_dataを全て取得 (processed_atがNULLのもの)
-    cursor.execute("""
-        SELECT id, api_response_data, fetched_at
-        FROM raw_api_data
-        WHERE product_id = %s AND source_api = %s AND processed_at IS NULL
-        ORDER BY fetched_at DESC, id DESC
-    """, (product_api_id, source_api_name))
-    all_raw_data_for_product = cursor.fetchall()
+    if preloaded_raw_rows is not None:
+        all_raw_data_for_product = preloaded_raw_rows
+    else:
+        # 関連するraw_api_dataを全て取得 (processed_atがNULLのもの)
+        cursor.execute("""
+            SELECT id, api_response_data, fetched_at
+            FROM raw_api_data
+            WHERE product_id = %s AND source_api = %s AND processed_at IS NULL
+            ORDER BY fetched_at DESC, id DESC
+        """, (product_api_id, source_api_name))
+        all_raw_data_for_product = cursor.fetchall()
 
     if not all_raw_data_for_product:
         return 0 # 処理すべきデータがなければ0を返す
 
+    # 各raw行のJSONは1回だけデコードし、メイン行の選択とカテゴリ・画像の収集で共有する
+    decoded_raw_rows = decode_raw_rows(all_raw_data_for_product)
+
     # productsテーブルを更新するための「メイン」となる生データを選択
     # ここでは最新の fetched_at を持つものをメインとする
     # (fetched_at が同じ場合は id が大きい方を選ぶことで一意性を保つ)
-    main_raw_data_row = all_raw_data_for_product[0]
+    main_raw_data_row = decoded_raw_rows[0]
     main_raw_api_data_id = main_raw_data_row[0]
-    main_raw_json_data = json.loads(main_raw_data_row[1])
     
-    # main_raw_json_data 自体が既に 'item' の中身なので、直接使用
-    main_item_data = main_raw_json_data 
+    # デコード済みのデータ自体が既に 'item' の中身なので、直接使用
+    main_item_data = main_raw_data_row[1]
 
     # 全てのraw_api_dataレコードからカテゴリ情報を収集
     collected_genres = set()
@@ -162,15 +211,15 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
     main_image_candidates = []
     og_image_candidates = [] # OGP画像もメイン画像と同じロジックで収集
 
-    for raw_data_row in all_raw_data_for_product:
-        current_raw_json_data = json.loads(raw_data_row[1])
-        # current_raw_json_data 自体が既に 'item' の中身なので、直接使用
-        current_item_data = current_raw_json_data 
+    for raw_data_row in decoded_raw_rows:
+        # デコード済みのデータ自体が既に 'item' の中身なので、直接使用
+        current_item_data = raw_data_row[1]
+        snapshot = SNAPSHOT_PLAN(current_item_data)
 
         # ジャンル収集
-        genres = get_safe_value(current_item_data, ['genres'], [])
+        genres = snapshot.genres
         if isinstance(genres, dict) and 'genre' in genres: 
-            genres = get_safe_value(genres, ['genre'], [])
+            genres = genres['genre']
         for genre_entry in genres:
             if isinstance(genre_entry, dict) and 'name' in genre_entry:
                 genre_name = clean_string(genre_entry['name'])
@@ -178,9 +227,9 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
                     collected_genres.add(genre_name)
 
         # 女優収集
-        actresses = get_safe_value(current_item_data, ['actresses'], [])
+        actresses = snapshot.actresses
         if isinstance(actresses, dict) and 'actress' in actresses: 
-            actresses = get_safe_value(actresses, ['actress'], [])
+            actresses = actresses['actress']
         for actress_entry in actresses:
             if isinstance(actress_entry, dict) and 'name' in actress_entry:
                 actress_name = clean_string(actress_entry['name'])
@@ -188,20 +237,11 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
                     collected_actresses.add(actress_name)
         
         # シリーズ収集
-        series_name = clean_string(get_safe_value(current_item_data, ['series', 'name']))
-        if series_name:
-            collected_series_names.add(series_name)
+        if snapshot.series_name:
+            collected_series_names.add(snapshot.series_name)
 
         # 画像URL候補の収集
-        img_urls = get_safe_value(current_item_data, ['image_url'], {})
-        jkt_urls = get_safe_value(current_item_data, ['jacket_url'], {})
-        
-        if get_safe_value(img_urls, ['large']): main_image_candidates.append(get_safe_value(img_urls, ['large']))
-        if get_safe_value(jkt_urls, ['large']): main_image_candidates.append(get_safe_value(jkt_urls, ['large']))
-        if get_safe_value(img_urls, ['medium']): main_image_candidates.append(get_safe_value(img_urls, ['medium']))
-        if get_safe_value(jkt_urls, ['medium']): main_image_candidates.append(get_safe_value(jkt_urls, ['medium']))
-        if get_safe_value(img_urls, ['small']): main_image_candidates.append(get_safe_value(img_urls, ['small']))
-        if get_safe_value(jkt_urls, ['small']): main_image_candidates.append(get_safe_value(jkt_urls, ['small']))
+        main_image_candidates.extend(image_url for image_url in snapshot[IMAGE_CANDIDATE_SLICE] if image_url)
         
         # OGP画像は、もし専用フィールドがあればそれを優先、なければメイン画像と同じロジック
         # Duga APIには専用のOGPフィールドがないため、メイン画像と同じ候補リストを使用
@@ -209,18 +249,9 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
 
 
     # productsテーブルに挿入するデータをメインの生データから抽出
-    title = clean_string(get_safe_value(main_item_data, ['title']))
-    original_title = clean_string(get_safe_value(main_item_data, ['original_title']))
-    caption = clean_string(get_safe_value(main_item_data, ['caption']))
-    release_date = parse_date(get_safe_value(main_item_data, ['release_date']))
-    maker_name = clean_string(get_safe_value(main_item_data, ['maker_name']))
-    item_no = clean_string(get_safe_value(main_item_data, ['item_no']))
-    price = convert_to_float(get_safe_value(main_item_data, ['price']), default=0.0)
-    volume = convert_to_int(get_safe_value(main_item_data, ['volume']), default=0)
-    url = clean_string(get_safe_value(main_item_data, ['url']))
-    affiliate_url = clean_string(get_safe_value(main_item_data, ['affiliate_url']))
-    sample_movie_url = clean_string(get_safe_value(main_item_data, ['sample_movie_url']))
-    sample_movie_capture_url = clean_string(get_safe_value(main_item_data, ['sample_movie_capture_url']))
+    # (カラムと JSON パスの対応は PRODUCT_FIELDS を参照)
+    (title, original_title, caption, release_date, maker_name, item_no, price, volume, url, affiliate_url,
+     sample_movie_url, sample_movie_capture_url) = PRODUCT_PLAN(main_item_data)
     source_api_for_products = source_api_name # productsテーブルの source_api には raw_api_data の source_api を利用
     
     # メイン画像URLの選定 (優先順位付け)
@@ -240,25 +271,42 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
     if not product_api_id:
         print(f"警告: product_id (raw_api_data.product_id) が空のためスキップします (Source: {source_api_name}).")
         # 処理済みのraw_api_dataレコードにマークを付ける (スキップされたものも)
-        for raw_data_row in all_raw_data_for_product:
-            update_raw_processed_sql = "UPDATE raw_api_data SET processed_at = %s WHERE id = %s"
-            cursor.execute(update_raw_processed_sql, (datetime.now(), raw_data_row[0]))
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
         return 0
 
     # タイトルが空の場合のスキップ処理
     if not title: # titleがNoneまたは空文字列の場合
         print(f"警告: 製品タイトルが空のためスキップします。Product ID: {product_api_id} (Source: {source_api_name}).")
         # 関連するraw_api_dataレコードも処理済みとしてマーク
-        for raw_data_row in all_raw_data_for_product:
-            update_raw_processed_sql = "UPDATE raw_api_data SET processed_at = %s WHERE id = %s"
-            cursor.execute(update_raw_processed_sql, (datetime.now(), raw_data_row[0]))
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
         return 0
 
 
+    # 紐付けるカテゴリの (type, name) を ジャンル → 女優 → レーベル → シリーズ の順で並べる
+    category_keys = [("ジャンル", genre_name) for genre_name in collected_genres]
+    category_keys.extend(("女優", actress_name) for actress_name in collected_actresses)
+    if maker_name: # レーベル (maker_name) はメインデータから取得
+        category_keys.append(("レーベル", maker_name))
+    category_keys.extend(("シリーズ", series_name) for series_name in collected_series_names)
+
+    # 統合結果のハッシュ (raw_api_data_id と JSONカラムは除き、カテゴリ集合はソートして含める)
+    content_hash = compute_product_content_hash({
+        'product_id': product_api_id, 'title': title, 'original_title': original_title, 'caption': caption,
+        'release_date': release_date, 'maker_name': maker_name, 'item_no': item_no, 'price': price, 'volume': volume,
+        'url': url, 'affiliate_url': affiliate_url, 'main_image_url': main_image_url, 'og_image_url': og_image_url,
+        'sample_movie_url': sample_movie_url, 'sample_movie_capture_url': sample_movie_capture_url,
+        'source_api': source_api_for_products,
+    }, category_keys)
+
     # データベースに製品が存在するか確認
-    cursor.execute("SELECT id FROM products WHERE product_id = %s", (product_api_id,))
+    cursor.execute("SELECT id, content_hash FROM products WHERE product_id = %s", (product_api_id,))
     existing_product = cursor.fetchone()
 
+    if existing_product and existing_product[1] == content_hash:
+        # 前回から内容が変わっていないため、UPDATE と紐付けの書き込みを省略してraw行のみ処理済みにする
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
+        return 1
+
     now = datetime.now()
     product_db_id = None # productsテーブルのIDを初期化
 
@@ -277,7 +325,7 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
                 item_no = %s, price = %s, volume = %s, url = %s, affiliate_url = %s,
                 main_image_url = %s, og_image_url = %s, sample_movie_url = %s, sample_movie_capture_url = %s,
                 actresses_json = %s, genres_json = %s, series_json = %s,
-                source_api = %s, raw_api_data_id = %s
+                source_api = %s, raw_api_data_id = %s, content_hash = %s
             WHERE product_id = %s
         """
         cursor.execute(update_query, (
@@ -285,7 +333,7 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
             item_no, price, volume, url, affiliate_url,
             main_image_url, og_image_url, sample_movie_url, sample_movie_capture_url,
             actresses_json_str, genres_json_str, series_json_str, # JSONカラム
-            source_api_for_products, main_raw_api_data_id, product_api_id 
+            source_api_for_products, main_raw_api_data_id, content_hash, product_api_id 
         ))
         print(f"製品を更新しました: Product ID={product_api_id}, Title='{title}'")
     else:
@@ -297,9 +345,9 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
                 item_no, price, volume, url, affiliate_url,
                 main_image_url, og_image_url, sample_movie_url, sample_movie_capture_url,
                 actresses_json, genres_json, series_json,
-                source_api, raw_api_data_id
+                source_api, raw_api_data_id, content_hash
             ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
             )
         """
         cursor.execute(insert_query, (
@@ -307,7 +355,7 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
             item_no, price, volume, url, affiliate_url,
             main_image_url, og_image_url, sample_movie_url, sample_movie_capture_url,
             actresses_json_str, genres_json_str, series_json_str, # JSONカラム
-            source_api_for_products, main_raw_api_data_id
+            source_api_for_products, main_raw_api_data_id, content_hash
         ))
         product_db_id = cursor.lastrowid # 新規挿入されたproductsテーブルのIDを取得
         print(f"新しい製品を挿入しました: Product ID={product_api_id}, Title='{title}'")
@@ -315,90 +363,111 @@ def process_product_batch_from_raw_data(cursor, conn, product_api_id: str, sourc
     # categories および product_categories テーブルへの紐付け
     # (productsテーブルのJSONカラムに保存する情報とは別に、カテゴリ管理用のテーブルにも紐付ける)
     if product_db_id:
-        # 収集したジャンルを紐付け
-        for genre_name in collected_genres:
-            category_id = get_or_create_category(cursor, conn, "ジャンル", genre_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            # print(f"  製品ID {product_api_id} にジャンル '{genre_name}' を紐付けました。") # 大量ログ防止のためコメントアウト
-
-        # 収集した女優を紐付け
-        for actress_name in collected_actresses:
-            category_id = get_or_create_category(cursor, conn, "女優", actress_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            # print(f"  製品ID {product_api_id} に女優 '{actress_name}' を紐付けました。") # 大量ログ防止のためコメントアウト
-
-        # レーベル (maker_name) を紐付け (メインデータから取得)
-        if maker_name: 
-            category_id = get_or_create_category(cursor, conn, "レーベル", maker_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            # print(f"  製品ID {product_api_id} にレーベル '{maker_name}' を紐付けました。") # 大量ログ防止のためコメントアウト
-
-        # 収集したシリーズを紐付け
-        for series_name in collected_series_names: # シリーズ名セットを使用
-            category_id = get_or_create_category(cursor, conn, "シリーズ", series_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            # print(f"  製品ID {product_api_id} にシリーズ '{series_name}' を紐付けました。") # 大量ログ防止のためコメントアウト
-        
+        if category_resolver is not None:
+            # メモリキャッシュから解決し、未登録のものだけをまとめて作成
+            category_ids = category_resolver.resolve_many(cursor, category_keys)
+        else:
+            category_ids = {key: get_or_create_category(cursor, conn, key[0], key[1]) for key in category_keys}
+
+        for category_key in category_keys:
+            if link_buffer is not None:
+                # 重複排除してバッファに追加 (書き込みはコミット前の flush でまとめて行う)
+                link_buffer.add(cursor, product_db_id, category_ids[category_key])
+            else:
+                associate_product_with_category(cursor, conn, product_db_id, category_ids[category_key])
+            # print(f"  製品ID {product_api_id} に{category_key[0]} '{category_key[1]}' を紐付けました。") # 大量ログ防止のためコメントアウト
+
         # 処理済みのraw_api_dataレコードにマークを付ける
-        for raw_data_row in all_raw_data_for_product:
-            update_raw_processed_sql = "UPDATE raw_api_data SET processed_at = %s WHERE id = %s"
-            cursor.execute(update_raw_processed_sql, (datetime.now(), raw_data_row[0]))
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
 
     return 1 # 処理した製品数を返すため
 
 
-def main_classification_process():
+def main_classification_process(drain: bool = False, page_size: int = DEFAULT_PAGE_SIZE, time_budget_seconds=None,
+                                commit_every: int = 1, commit_interval_ms=None):
     """
     raw_api_data から未処理のユニークな product_id, source_api の組み合わせを取得し、
     それぞれを process_product_batch_from_raw_data で処理するメインループ。
+    drain=True の場合は未処理キューを (source_api, product_id) のキーセットページングで
+    page_size 件ずつ、キューが空になるか time_budget_seconds に達するまで処理し続ける。
+    commit_every / commit_interval_ms を指定すると N製品ごと / T ミリ秒ごとにまとめてコミットする
+    (各製品は SAVEPOINT 内で処理され、失敗した製品だけがロールバックされる)。
     """
     conn = None
     total_products_processed = 0
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        # 共通プールの接続は autocommit = False (DB_AUTOCOMMIT) で、トランザクションは明示的に管理する
+        conn = get_connection()
         cursor = conn.cursor()
 
-        # ★★★ 修正済み: autocommit を False に設定し、明示的なトランザクション開始を削除 ★★★
-        conn.autocommit = False 
-        # ★★★ 修正済み ★★★
-
         # raw_api_dataテーブルにprocessed_atカラムが存在することを確認し、なければ追加する
         ensure_processed_at_column_exists(cursor, conn)
+        ensure_content_hash_column_exists(cursor, conn, DB_CONFIG['database'])
+
+        # categories を全件メモリに読み込み、以降のカテゴリID解決はキャッシュから行う
+        category_resolver = CategoryResolver()
+        category_resolver.preload(cursor)
+        link_buffer = ProductCategoryLinkBuffer()
+        processed_marker = RawProcessedMarker()
+        group_committer = GroupCommitter(
+            conn, cursor, category_resolver, link_buffer, processed_marker,
+            commit_every=commit_every, commit_interval_ms=commit_interval_ms,
+        )
         
-        # 未処理のユニークな (product_id, source_api) の組み合わせを取得
-        # LIMIT 100 は一度にメモリに読み込む重複したraw_api_dataレコードの数を制御するために重要
-        cursor.execute("""
-            SELECT DISTINCT product_id, source_api
-            FROM raw_api_data
-            WHERE processed_at IS NULL
-            LIMIT 1000 -- 一度に処理するユニークな製品IDの数を増やしました
-        """)
-        unique_product_ids_to_process = cursor.fetchall()
+        if drain:
+            # 継続ドレインモード: キーセットページングで未処理キューを最後まで辿る
+            ensure_work_queue_index_exists(cursor, conn, DB_CONFIG['database'])
+            key_pages = iter_unprocessed_key_pages(cursor, page_size, time_budget_seconds)
+        else:
+            # 未処理のユニークな (product_id, source_api) の組み合わせを取得
+            # LIMIT 100 は一度にメモリに読み込む重複したraw_api_dataレコードの数を制御するために重要
+            cursor.execute("""
+                SELECT DISTINCT product_id, source_api
+                FROM raw_api_data
+                WHERE processed_at IS NULL
+                LIMIT 1000 -- 一度に処理するユニークな製品IDの数を増やしました
+            """)
+            unique_product_ids_to_process = cursor.fetchall()
+            key_pages = [unique_product_ids_to_process] if unique_product_ids_to_process else []
+
+        page_count = 0
+        for unique_product_ids_to_process in key_pages:
+            page_count += 1
+            print(f"raw_api_dataから {len(unique_product_ids_to_process)} 件のユニークな製品IDを処理します。(ページ {page_count})")
+
+            # ページ内の全製品の未処理raw行を数回のクエリでまとめて取得しておく
+            raw_rows_by_key = load_unprocessed_raw_rows_for_keys(cursor, unique_product_ids_to_process)
+
+            # 各ユニークな製品IDについて処理を実行
+            for product_api_id, source_api_name in unique_product_ids_to_process:
+                try:
+                    # ★★★ 修正済み: conn.start_transaction() の呼び出しを削除 ★★★
+                    # conn.start_transaction() 
+                    # ★★★ 修正済み ★★★
+                    # グループコミット時は SAVEPOINT 内で処理し、失敗した製品だけを取り消す
+                    with group_committer.product():
+                        processed_count_for_this_product = process_product_batch_from_raw_data(
+                            cursor, conn, product_api_id, source_api_name, category_resolver, link_buffer, processed_marker,
+                            preloaded_raw_rows=raw_rows_by_key.get((product_api_id, source_api_name), []),
+                        )
+                except Exception as e:
+                    print(f"製品ID {product_api_id} の処理中にエラーが発生しました: {e}")
+                    # エラーが発生した product_id の raw_api_data は processed_at が更新されないため、次回の実行で再度試行される
+                    continue
+                total_products_processed += processed_count_for_this_product
+                if group_committer.product_done():
+                    print(f"製品ID {product_api_id} までの処理とコミットが完了しました。")
 
-        if not unique_product_ids_to_process:
+            # ページの終わりで未コミットの製品をコミットする
+            group_committer.commit_pending()
+
+        if page_count == 0:
             print("処理すべきユニークな製品データが見つかりませんでした。")
             return
 
-        print(f"raw_api_dataから {len(unique_product_ids_to_process)} 件のユニークな製品IDを処理します。")
-
-        # 各ユニークな製品IDについて処理を実行
-        for product_api_id, source_api_name in unique_product_ids_to_process:
-            try:
-                # ★★★ 修正済み: conn.start_transaction() の呼び出しを削除 ★★★
-                # conn.start_transaction() 
-                # ★★★ 修正済み ★★★
-                processed_count_for_this_product = process_product_batch_from_raw_data(cursor, conn, product_api_id, source_api_name)
-                total_products_processed += processed_count_for_this_product
-                conn.commit() # 各製品IDの処理後にコミット
-                print(f"製品ID {product_api_id} の処理とコミットが完了しました。")
-            except Exception as e:
-                print(f"製品ID {product_api_id} の処理中にエラーが発生しました: {e}")
-                if conn and conn.is_connected():
-                    conn.rollback()
-                    print("トランザクションをロールバックしました。")
-                # エラーが発生した product_id の raw_api_data は processed_at が更新されないため、次回の実行で再度試行される
-
         print(f"製品、カテゴリ、および紐付けテーブルへのデータ投入が完了しました。総計 {total_products_processed} 件の製品を処理しました。")
+        print(f"product_categories 書き込み統計: {link_buffer.stats()}")
+        print(f"コミット統計: {group_committer.stats()}")
 
     except mysql.connector.Error as err:
         print(f"MySQL接続またはクエリ実行エラー: {err}")
@@ -416,10 +485,11 @@ def main_classification_process():
             conn.rollback()
             print("トランザクションをロールバックしました。")
     finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
-            print("MySQL接続を閉じました。")
+        if conn is not None:
+            if conn.is_connected():
+                cursor.close()
+            release_connection(conn)
+            print("MySQL接続をプールに返却しました。")
 
 # ==============================================================================
 # メイン処理の実行
@@ -431,6 +501,22 @@ if __name__ == "__main__":
     # もしテスト用にダミーデータが必要な場合は、別途関数を定義し呼び出すか、
     # PHPスクリプトを実行して raw_api_data にデータを投入してください。
     
+    parser = argparse.ArgumentParser(description="raw_api_data から製品とカテゴリを分類・投入します。")
+    parser.add_argument('--drain', action='store_true',
+                        help="未処理キューが空になるまでキーセットページングで処理し続ける")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help="--drain 時に1ページで取得するユニークな製品IDの数")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="--drain 時の処理時間の上限 (秒)。超えると次のページを取得せずに終了する")
+    parser.add_argument('--commit-every', type=int, default=1,
+                        help="N製品ごとにまとめてコミットする (各製品は SAVEPOINT 内で処理。1の場合は従来通り1製品ごと)")
+    parser.add_argument('--commit-interval-ms', type=int, default=None,
+                        help="前回のコミットから T ミリ秒経過したらコミットする (--commit-every と併用可)")
+    args = parser.parse_args()
+
     # 製品とカテゴリの分類・投入プロセスを実行
-    main_classification_process()
+    main_classification_process(
+        drain=args.drain, page_size=args.page_size, time_budget_seconds=args.time_budget,
+        commit_every=args.commit_every, commit_interval_ms=args.commit_interval_ms,
+    )
 
@@ -0,0 +1,396 @@
+import argparse
+import hashlib
+import logging
+import sys
+import time
+
+import mysql.connector
+
+import populate_products_and_categories as populate
+from db_bulk import chunked
+from db_connection import DB_CONFIG, get_connection, release_connection
+from json_codec import JSONDecodeError, loads
+from log_setup import setup_queue_logging
+from raw_data import (
+    PAYLOAD_ZLIB_COLUMN_NAME, RAW_LOAD_CHUNK_SIZE, compress_payload, ensure_payload_zlib_column_exists,
+    payload_zlib_column_exists, read_raw_payload,
+)
+from run_metrics import NULL_METRICS, RunMetrics
+
+# ==============================================================================
+# raw_api_data スナップショットの圧縮 (コンパクション)
+# = raw_api_data には取得したスナップショットが全て残り続けるため、(source_api, product_id) ごとに
+#   統合結果に影響しない古いスナップショットを削除し、任意で処理済みの古いスナップショットを zlib 圧縮して保存する。
+#
+#   製品ごとの行を fetched_at DESC, id DESC 順に並べ、未処理 / 処理済みの行それぞれについて:
+#     - 最新の行は常に残す
+#     - 残す行とバイト単位で同一のペイロードの行は削除する
+#     - 残す行に含まれないカテゴリ (ジャンル・女優・シリーズ) を持つ行は残す
+#     - 残す行に画像URLの候補が1つもない間は、画像URLの候補を持つ行を残す
+#     - それ以外の行は削除する
+#   merge_raw_rows_for_product はメイン (最新) の行のフィールドと全行のカテゴリの和集合・最初の画像URLの候補を使うため、
+#   未処理の行を間引いても統合結果は変わらない。カテゴリの取り出し方が分からないソースは同一ペイロードの削除だけを行う。
+#   products.raw_api_data_id から参照されている行は削除しない。
+#
+#   圧縮した行は api_response_data が JSON の null になり、内容は read_raw_payload でしか読めない。
+#   populate / classify の未処理キューは api_response_data だけを読むため、圧縮済みの行の processed_at を
+#   NULL に戻しても再処理はできない (再処理が必要な製品の行は圧縮しないこと)。
+#
+#   PHP の取得処理と並行して実行できるよう、削除・圧縮は主キー指定の小さなバッチごとにコミットし、
+#   ロック待ちがタイムアウトしたバッチは読み飛ばして次の実行に回す。
+#
+#   使い方:
+#     python app/cli/compact_raw_api_data.py --dry-run
+#     python app/cli/compact_raw_api_data.py --compress --batch-size 500 --sleep-ms 50
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+log_file_path = '/var/www/html/app/logs/compact_raw_api_data.log'
+
+METRICS_JOB_NAME = 'compact_raw_api_data'
+DEFAULT_KEY_PAGE_SIZE = 500
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_LOCK_WAIT_TIMEOUT_SECONDS = 5
+# ロック待ちのタイムアウト (1205) とデッドロック (1213) は、そのバッチを読み飛ばして処理を続ける
+RETRYABLE_LOCK_ERRNOS = (1205, 1213)
+
+
+# ==============================================================================
+# スナップショットの内容
+# ==============================================================================
+
+def duga_snapshot_contents(item_data) -> tuple:
+    """
+    Duga の item 1件から、merge_raw_rows_for_product が収集するカテゴリの (type, name) の集合と
+    画像URLの候補があるかどうかを返す。
+    """
+    snapshot = populate.DUGA_SNAPSHOT_PLAN(item_data)
+    genres = set()
+    actresses = set()
+    populate.collect_category_names(populate.flatten_category_entries(snapshot.category), genres)
+    populate.collect_category_names(populate.flatten_category_entries(snapshot.performer), actresses)
+    category_keys = {("ジャンル", name) for name in genres}
+    category_keys.update(("女優", name) for name in actresses)
+    if snapshot.series_name:
+        category_keys.add(("シリーズ", snapshot.series_name))
+    has_image = any(snapshot[populate.DUGA_IMAGE_CANDIDATE_SLICE])
+    return category_keys, has_image
+
+
+# source_api → スナップショットの内容を返す関数。ここにないソースは同一ペイロードの削除だけを行う
+SNAPSHOT_CONTENT_EXTRACTORS = {
+    'duga': duga_snapshot_contents,
+}
+
+
+def plan_product_compaction(source_api_name: str, raw_rows, protected_ids=(), compress: bool = False) -> dict:
+    """
+    1製品分の raw_api_data 行 [(id, JSON文字列, processed_at, 圧縮済みかどうか), ...] (fetched_at DESC, id DESC 順) から、
+    削除する行と圧縮する行を決める。
+    戻り値は {'duplicate': [id, ...], 'redundant': [id, ...], 'compress': [(id, JSON文字列), ...]}。
+    """
+    extract_contents = SNAPSHOT_CONTENT_EXTRACTORS.get(source_api_name)
+    plan = {'duplicate': [], 'redundant': [], 'compress': []}
+    newest_raw_id = raw_rows[0][0] if raw_rows else None
+
+    # 未処理の行は統合結果が変わらないように、処理済みの行は保存容量のために、それぞれの中で間引く
+    unprocessed_rows = [row for row in raw_rows if row[2] is None]
+    processed_rows = [row for row in raw_rows if row[2] is not None]
+    for rows in (unprocessed_rows, processed_rows):
+        kept_digests = set()
+        kept_category_keys = set()
+        kept_has_image = False
+        for index, (raw_id, payload, processed_at, is_compressed) in enumerate(rows):
+            protected = raw_id in protected_ids
+            digest = hashlib.sha256(payload.encode('utf-8')).digest()
+            if digest in kept_digests and not protected:
+                plan['duplicate'].append(raw_id)
+                continue
+
+            if extract_contents is not None:
+                try:
+                    category_keys, has_image = extract_contents(loads(payload))
+                except (JSONDecodeError, TypeError) as e:
+                    logger.warning("raw_api_data.id=%s のペイロードを解析できないため、そのまま残します: %s", raw_id, e)
+                    category_keys, has_image = None, False
+                if (index > 0 and not protected and category_keys is not None
+                        and category_keys <= kept_category_keys and (kept_has_image or not has_image)):
+                    plan['redundant'].append(raw_id)
+                    continue
+                kept_category_keys.update(category_keys or ())
+                kept_has_image = kept_has_image or has_image
+
+            kept_digests.add(digest)
+            if compress and processed_at is not None and raw_id != newest_raw_id and not is_compressed:
+                plan['compress'].append((raw_id, payload))
+    return plan
+
+
+# ==============================================================================
+# データベース操作
+# ==============================================================================
+
+def fetch_multi_snapshot_key_page(cursor, after_key=None, page_size: int = DEFAULT_KEY_PAGE_SIZE) -> list:
+    """
+    after_key = (product_id, source_api) より後ろにある、スナップショットが2件以上ある (product_id, source_api) を
+    (product_id, source_api) 順に最大 page_size 件返す。idx_product_id_source_api の順に走査する。
+    """
+    if after_key is None:
+        key_condition, key_params = "", ()
+    else:
+        key_condition = "WHERE product_id > %s OR (product_id = %s AND source_api > %s)"
+        key_params = (after_key[0], after_key[0], after_key[1])
+    cursor.execute(f"""
+        SELECT product_id, source_api
+        FROM raw_api_data
+        {key_condition}
+        GROUP BY product_id, source_api
+        HAVING COUNT(*) > 1
+        ORDER BY product_id, source_api
+        LIMIT %s
+    """, key_params + (page_size,))
+    return cursor.fetchall()
+
+
+def load_raw_rows_for_keys(cursor, product_keys, has_zlib_column: bool, chunk_size: int = RAW_LOAD_CHUNK_SIZE) -> dict:
+    """
+    (product_id, source_api) のリストに対応する raw_api_data 行を処理済みのものも含めてまとめて取得し、
+    {(product_id, source_api): [(id, JSON文字列, processed_at, 圧縮済みかどうか), ...]} (fetched_at DESC, id DESC 順) を返す。
+    圧縮済みの行は展開した JSON 文字列を返す。
+    """
+    zlib_column = f", `{PAYLOAD_ZLIB_COLUMN_NAME}`" if has_zlib_column else ", NULL"
+    product_ids_by_source = {}
+    for product_api_id, source_api_name in product_keys:
+        product_ids_by_source.setdefault(source_api_name, []).append(product_api_id)
+
+    raw_rows_by_key = {tuple(key): [] for key in product_keys}
+    for source_api_name, product_ids in product_ids_by_source.items():
+        for chunk in chunked(list(dict.fromkeys(product_ids)), chunk_size):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"""
+                SELECT id, api_response_data, processed_at, product_id{zlib_column}
+                FROM raw_api_data
+                WHERE source_api = %s AND product_id IN ({placeholders})
+                ORDER BY fetched_at DESC, id DESC
+            """, [source_api_name] + chunk)
+            for raw_id, api_response_data, processed_at, product_api_id, payload_zlib in cursor.fetchall():
+                raw_rows_by_key.setdefault((product_api_id, source_api_name), []).append(
+                    (raw_id, read_raw_payload(api_response_data, payload_zlib), processed_at, payload_zlib is not None)
+                )
+    return raw_rows_by_key
+
+
+def fetch_referenced_raw_ids(cursor, product_ids, chunk_size: int = 1000) -> set:
+    """products.raw_api_data_id から参照されている raw_api_data.id の集合を返す。"""
+    referenced_ids = set()
+    for chunk in chunked(dict.fromkeys(product_ids), chunk_size):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"SELECT raw_api_data_id FROM products WHERE product_id IN ({placeholders}) AND raw_api_data_id IS NOT NULL",
+            chunk,
+        )
+        referenced_ids.update(row[0] for row in cursor.fetchall())
+    return referenced_ids
+
+
+class CompactionBatchWriter:
+    """
+    削除・圧縮を batch_size 行ずつの短いトランザクションで実行するクラス。
+    バッチごとにコミットし、sleep_ms ミリ秒待ってから次のバッチに進む (PHP の取得処理とのロック競合を抑えるため)。
+    ロック待ちのタイムアウトやデッドロックが発生したバッチはロールバックして読み飛ばす。
+    """
+
+    def __init__(self, conn, cursor, batch_size: int = DEFAULT_BATCH_SIZE, sleep_ms: int = 0, dry_run: bool = False, metrics=NULL_METRICS):
+        self.conn = conn
+        self.cursor = cursor
+        self.batch_size = max(1, batch_size)
+        self.sleep_seconds = max(0, sleep_ms) / 1000.0
+        self.dry_run = dry_run
+        self.metrics = metrics
+        self.batches_skipped = 0
+
+    def _run_batch(self, execute) -> int:
+        if self.dry_run:
+            return 0
+        try:
+            with self.metrics.stage('write'):
+                affected_rows = execute()
+            with self.metrics.stage('commit'):
+                self.conn.commit()
+        except mysql.connector.Error as err:
+            if err.errno not in RETRYABLE_LOCK_ERRNOS:
+                raise
+            self.conn.rollback()
+            self.batches_skipped += 1
+            self.metrics.incr('batches_skipped')
+            logger.warning("ロック競合のためバッチを読み飛ばしました (次回の実行で再試行されます): %s", err)
+            return 0
+        if self.sleep_seconds:
+            time.sleep(self.sleep_seconds)
+        return affected_rows
+
+    def delete(self, raw_ids) -> int:
+        deleted_rows = 0
+        for chunk in chunked(raw_ids, self.batch_size):
+            def execute():
+                placeholders = ", ".join(["%s"] * len(chunk))
+                self.cursor.execute(f"DELETE FROM raw_api_data WHERE id IN ({placeholders})", chunk)
+                return self.cursor.rowcount
+            deleted_rows += self._run_batch(execute)
+        return deleted_rows
+
+    def compress(self, compress_rows) -> int:
+        compressed_rows = 0
+        for chunk in chunked(compress_rows, self.batch_size):
+            params = [(compress_payload(payload), raw_id) for raw_id, payload in chunk]
+            self.metrics.incr('bytes_before_compress', sum(len(payload.encode('utf-8')) for _, payload in chunk))
+            self.metrics.incr('bytes_after_compress', sum(len(payload_zlib) for payload_zlib, _ in params))
+
+            def execute():
+                # 処理済みの行だけを圧縮する (未処理の行は populate / classify が読むため圧縮しない)
+                self.cursor.executemany(
+                    f"UPDATE raw_api_data SET api_response_data = CAST('null' AS JSON), `{PAYLOAD_ZLIB_COLUMN_NAME}` = %s "
+                    "WHERE id = %s AND processed_at IS NOT NULL",
+                    params,
+                )
+                return self.cursor.rowcount
+            compressed_rows += self._run_batch(execute)
+        return compressed_rows
+
+
+def compact_raw_api_data(compress: bool = False, dry_run: bool = False, key_page_size: int = DEFAULT_KEY_PAGE_SIZE,
+                         batch_size: int = DEFAULT_BATCH_SIZE, sleep_ms: int = 0,
+                         lock_wait_timeout: int = DEFAULT_LOCK_WAIT_TIMEOUT_SECONDS, time_budget_seconds=None,
+                         metrics=None) -> dict:
+    """
+    raw_api_data を (product_id, source_api) のキーセットページングで先頭から末尾まで辿り、
+    製品ごとに plan_product_compaction の結果に従って削除・圧縮する。
+    dry_run=True の場合は件数の集計だけを行い、書き込まない。
+    time_budget_seconds を超えた時点で次のページを取得せずに終了する。
+    処理件数とエラーメッセージ、ステージ別の所要時間をまとめた辞書を返す。
+    """
+    if metrics is None:
+        metrics = RunMetrics(METRICS_JOB_NAME)
+    summary = {'groups': 0, 'rows_scanned': 0, 'rows_deleted': 0, 'rows_compressed': 0, 'errors': []}
+    started = time.monotonic()
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        # PHP の取得処理などを長く待たせないよう、ロック待ちは短く打ち切る
+        cursor.execute("SET SESSION innodb_lock_wait_timeout = %s", (lock_wait_timeout,))
+        if compress and not dry_run:
+            ensure_payload_zlib_column_exists(cursor, conn, DB_CONFIG['database'])
+        has_zlib_column = payload_zlib_column_exists(cursor, DB_CONFIG['database'])
+        writer = CompactionBatchWriter(conn, cursor, batch_size, sleep_ms, dry_run, metrics)
+
+        after_key = None
+        while True:
+            if time_budget_seconds is not None and time.monotonic() - started >= time_budget_seconds:
+                logger.info("時間予算 (%s 秒) に達したため、コンパクションを終了します。", time_budget_seconds)
+                break
+            with metrics.stage('key_scan'):
+                product_keys = fetch_multi_snapshot_key_page(cursor, after_key, key_page_size)
+            if not product_keys:
+                break
+            after_key = tuple(product_keys[-1])
+            metrics.incr('pages')
+
+            with metrics.stage('raw_fetch'):
+                raw_rows_by_key = load_raw_rows_for_keys(cursor, product_keys, has_zlib_column)
+                referenced_ids = fetch_referenced_raw_ids(cursor, [product_api_id for product_api_id, _ in product_keys])
+            # 読み取りだけのトランザクションを終わらせ、スナップショットを保持し続けないようにする
+            conn.commit()
+
+            delete_ids = []
+            compress_rows = []
+            with metrics.stage('plan'):
+                for (product_api_id, source_api_name), raw_rows in raw_rows_by_key.items():
+                    if not raw_rows:
+                        continue
+                    plan = plan_product_compaction(source_api_name, raw_rows, referenced_ids, compress)
+                    delete_ids.extend(plan['duplicate'])
+                    delete_ids.extend(plan['redundant'])
+                    compress_rows.extend(plan['compress'])
+                    summary['groups'] += 1
+                    summary['rows_scanned'] += len(raw_rows)
+                    metrics.incr('groups')
+                    metrics.incr('rows_scanned', len(raw_rows))
+                    metrics.incr('rows_duplicate', len(plan['duplicate']))
+                    metrics.incr('rows_redundant', len(plan['redundant']))
+
+            deleted_rows = writer.delete(delete_ids)
+            compressed_rows = writer.compress(compress_rows)
+            summary['rows_deleted'] += deleted_rows
+            summary['rows_compressed'] += compressed_rows
+            metrics.incr('rows_deleted', deleted_rows)
+            metrics.incr('rows_compressed', compressed_rows)
+            logger.info(
+                "%s 件の製品を確認しました (削除対象 %s 行, 圧縮対象 %s 行%s)。",
+                len(product_keys), len(delete_ids), len(compress_rows), ", dry-run" if dry_run else "",
+            )
+
+        logger.info(
+            "コンパクションが完了しました: 製品 %s 件, 確認した行 %s 行, 削除 %s 行, 圧縮 %s 行, 読み飛ばしたバッチ %s 件。",
+            summary['groups'], summary['rows_scanned'], summary['rows_deleted'], summary['rows_compressed'], writer.batches_skipped,
+        )
+
+    except mysql.connector.Error as err:
+        logger.error("MySQL接続またはクエリ実行エラー: %s", err)
+        summary['errors'].append(f"MySQL接続またはクエリ実行エラー: {err}")
+        if conn and conn.is_connected():
+            conn.rollback()
+    finally:
+        if conn is not None:
+            if conn.is_connected():
+                cursor.close()
+            release_connection(conn)
+        metrics.finish()
+        metrics.log_summary(logger)
+        summary['metrics'] = metrics.to_dict()
+    return summary
+
+
+# ==============================================================================
+# メイン処理
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="raw_api_data の重複・不要なスナップショットを削除し、古いスナップショットを圧縮します。")
+    parser.add_argument('--compress', action='store_true',
+                        help="残す行のうち、最新以外の処理済みスナップショットを zlib 圧縮して保存する")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="削除・圧縮の対象件数を集計するだけで書き込まない")
+    parser.add_argument('--key-page-size', type=int, default=DEFAULT_KEY_PAGE_SIZE,
+                        help="1ページで確認する (product_id, source_api) の数")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="1トランザクションで削除・圧縮する最大行数")
+    parser.add_argument('--sleep-ms', type=int, default=0,
+                        help="バッチのコミットごとに待つ時間 (ミリ秒)。PHP の取得処理と並行して実行する場合に負荷を抑える")
+    parser.add_argument('--lock-wait-timeout', type=int, default=DEFAULT_LOCK_WAIT_TIMEOUT_SECONDS,
+                        help="innodb_lock_wait_timeout (秒)。超えたバッチは読み飛ばして次回の実行に回す")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="処理時間の上限 (秒)。超えると次のページを取得せずに終了する")
+    parser.add_argument('--metrics-json', default=None,
+                        help="実行終了時にステージ別の所要時間とカウンタを JSON で書き出すファイルパス")
+    parser.add_argument('--metrics-prom', default=None,
+                        help="実行終了時にメトリクスを Prometheus textfile collector 形式 (.prom) で書き出すファイルパス")
+    args = parser.parse_args()
+
+    setup_queue_logging(logger, log_file_path)
+    run_metrics = RunMetrics(METRICS_JOB_NAME)
+    summary = compact_raw_api_data(
+        compress=args.compress,
+        dry_run=args.dry_run,
+        key_page_size=args.key_page_size,
+        batch_size=args.batch_size,
+        sleep_ms=args.sleep_ms,
+        lock_wait_timeout=args.lock_wait_timeout,
+        time_budget_seconds=args.time_budget,
+        metrics=run_metrics,
+    )
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        run_metrics.write_prometheus_textfile(args.metrics_prom)
+    sys.exit(1 if summary['errors'] else 0)
@@ -0,0 +1,68 @@
+import logging
+
+# ==============================================================================
+# バルク書き込みヘルパー
+# = PHP側の App\Util\DbBatchInsert に相当する、複数行まとめての INSERT / UPSERT
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+# 1ステートメントあたりの最大行数 (max_allowed_packet を超えないように控えめに設定)
+DEFAULT_CHUNK_SIZE = 500
+
+
+def chunked(items, size):
+    """リストを size 件ずつのチャンクに分割して返すジェネレータ。"""
+    items = list(items)
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def bulk_insert_on_duplicate_update(cursor, table_name: str, columns, rows, update_columns, chunk_size: int = DEFAULT_CHUNK_SIZE) -> int:
+    """
+    指定テーブルに複数行を1ステートメントでまとめて挿入する。
+    UNIQUE KEY が重複した行は update_columns のみ VALUES() の値で更新する
+    (INSERT ... ON DUPLICATE KEY UPDATE)。
+    rows は columns と同じ順序のタプルのリスト。
+    トランザクション管理は呼び出し元で行う。
+    戻り値は MySQL が返す affected rows の合計 (新規=1, 更新=2, 変化なし=0 で数えられる)。
+    """
+    if not rows:
+        return 0
+
+    column_names = ", ".join(f"`{col}`" for col in columns)
+    row_placeholder = "(" + ", ".join(["%s"] * len(columns)) + ")"
+    update_clause = ", ".join(f"`{col}` = VALUES(`{col}`)" for col in update_columns)
+
+    affected_rows = 0
+    for chunk in chunked(rows, chunk_size):
+        sql = f"INSERT INTO `{table_name}` ({column_names}) VALUES " + ", ".join([row_placeholder] * len(chunk))
+        if update_clause:
+            sql += f" ON DUPLICATE KEY UPDATE {update_clause}"
+        params = [value for row in chunk for value in row]
+        cursor.execute(sql, params)
+        affected_rows += cursor.rowcount
+        logger.debug("バルクUPSERT: table=%s, rows=%d, affected=%d", table_name, len(chunk), cursor.rowcount)
+    return affected_rows
+
+
+def fetch_id_map(cursor, table_name: str, key_column: str, keys, chunk_size: int = 1000, resolve_keys=None) -> dict:
+    """
+    key_column の値のリストから {key: id} の辞書を IN (...) クエリでまとめて取得する。
+    見つからなかったキーは辞書に含まれない。
+    照合順序で大文字小文字などを区別しないカラムでは、DB に保存された値が要求した値と異なることがある。
+    resolve_keys(cursor, 要求したキー, 返ったキー) -> {返ったキー: 要求したキー} を渡すと、要求したキーで辞書を作る。
+    """
+    id_map = {}
+    unique_keys = list(dict.fromkeys(k for k in keys if k is not None))
+    for chunk in chunked(unique_keys, chunk_size):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"SELECT `{key_column}`, id FROM `{table_name}` WHERE `{key_column}` IN ({placeholders})",
+            chunk,
+        )
+        rows = cursor.fetchall()
+        requested_by_returned = resolve_keys(cursor, chunk, [key for key, _ in rows]) if resolve_keys is not None else {}
+        for key, row_id in rows:
+            id_map[requested_by_returned.get(key, key)] = row_id
+    return id_map
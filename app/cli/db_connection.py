@@ -0,0 +1,156 @@
+import logging
+import os
+from contextlib import contextmanager
+
+import mysql.connector
+from mysql.connector import pooling
+from dotenv import load_dotenv
+
+# ==============================================================================
+# 共通DB接続
+# = 各スクリプトの DB_CONFIG と mysql.connector.connect() をここにまとめ、
+#   mysql.connector.pooling のコネクションプールから接続を貸し出す。
+#   セッション設定 (autocommit / トランザクション分離レベル / sql_mode) は物理接続ごとに一度だけ適用し、
+#   同じプロセス内で接続を借り直しても再接続やセッション設定のやり直しが発生しないようにする。
+#   PHP側の App\Core\Database に相当する。
+#
+#   接続先とプールの設定は環境変数で変更できる。
+#     DB_HOST / DB_PORT / DB_USER / DB_NAME : 接続先 (デフォルト: mysql / 3306 / root / tiper)
+#     DB_PASS (または DB_PASSWORD)          : パスワード
+#     DB_POOL_SIZE                          : プールの接続数 (デフォルト: 4、最大 32)
+#     DB_AUTOCOMMIT                         : 1 / true で autocommit を有効にする (デフォルト: 無効)
+#     DB_ISOLATION_LEVEL                    : 例 READ COMMITTED (デフォルト: サーバーの設定)
+#     DB_SQL_MODE                           : セッションの sql_mode (デフォルト: サーバーの設定)
+#     DB_USE_PURE                           : 1 / true で C拡張を使わない (デフォルト: C拡張があれば使う)
+# ==============================================================================
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+POOL_NAME = 'etl_pool'
+DEFAULT_POOL_SIZE = 4
+ISOLATION_LEVELS = ('READ UNCOMMITTED', 'READ COMMITTED', 'REPEATABLE READ', 'SERIALIZABLE')
+
+
+def _env_flag(env_name: str, default: bool) -> bool:
+    value = os.getenv(env_name)
+    if value is None or value.strip() == '':
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+# MySQL接続情報
+DB_CONFIG = {
+    'host': os.getenv('DB_HOST', 'mysql'),
+    'port': int(os.getenv('DB_PORT', 3306)),
+    'user': os.getenv('DB_USER', 'root'),
+    'password': os.getenv('DB_PASS', os.getenv('DB_PASSWORD', '')),
+    'database': os.getenv('DB_NAME', 'tiper')
+}
+
+# 接続時に mysql.connector が適用するセッション設定
+SESSION_CONFIG = {
+    'autocommit': _env_flag('DB_AUTOCOMMIT', False),
+    # C拡張 (_mysql_connector) がインストールされていれば使う
+    'use_pure': _env_flag('DB_USE_PURE', not mysql.connector.HAVE_CEXT),
+}
+if os.getenv('DB_SQL_MODE'):
+    SESSION_CONFIG['sql_mode'] = os.getenv('DB_SQL_MODE')
+
+ISOLATION_LEVEL = (os.getenv('DB_ISOLATION_LEVEL') or '').strip().upper().replace('-', ' ') or None
+if ISOLATION_LEVEL is not None and ISOLATION_LEVEL not in ISOLATION_LEVELS:
+    logger.warning("DB_ISOLATION_LEVEL の値 '%s' は不正なため無視します。", ISOLATION_LEVEL)
+    ISOLATION_LEVEL = None
+
+_pool = None
+_pool_pid = None
+# fork 前の親プロセスから引き継いだプール。ソケットを親と共有しているため、
+# 子プロセスでは使わず、ガベージコレクションで閉じられないよう参照だけ保持する
+_inherited_pools = []
+# 分離レベルを適用済みの接続 (サーバーの接続ID)
+_initialized_connection_ids = set()
+
+
+def get_pool():
+    """
+    プロセス内で共有するコネクションプールを返す。初回呼び出し時に DB_POOL_SIZE 個の接続を開く。
+    fork した子プロセス (並列実行のワーカーなど) では親のソケットを使わないよう新しいプールを作成する。
+    """
+    global _pool, _pool_pid
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    if _pool is not None:
+        _inherited_pools.append(_pool)
+        _initialized_connection_ids.clear()
+
+    pool_size = max(1, min(int(os.getenv('DB_POOL_SIZE', DEFAULT_POOL_SIZE)), pooling.CNX_POOL_MAXSIZE))
+    # 返却時に COM_RESET_CONNECTION するとセッション設定が失われるため、pool_reset_session は無効にする
+    # (返却時の未完了トランザクションは release_connection でロールバックする)
+    _pool = pooling.MySQLConnectionPool(
+        pool_name=POOL_NAME, pool_size=pool_size, pool_reset_session=False,
+        **DB_CONFIG, **SESSION_CONFIG,
+    )
+    _pool_pid = os.getpid()
+    logger.info("DBコネクションプールを作成しました (接続数: %d, C拡張: %s)。", pool_size, not SESSION_CONFIG['use_pure'])
+    return _pool
+
+
+def get_connection():
+    """
+    プールから接続を借りる。close() (または release_connection()) でプールに返却される。
+    autocommit と sql_mode は接続時に適用済みで、分離レベルは物理接続ごとに初回だけ設定する。
+    プールの接続 (PooledMySQLConnection) に conn.autocommit = ... と代入しても実際の接続には反映されないため、
+    autocommit は DB_AUTOCOMMIT で指定する。
+    """
+    conn = get_pool().get_connection()
+    connection_id = conn.connection_id
+    if ISOLATION_LEVEL is not None and connection_id not in _initialized_connection_ids:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SET SESSION TRANSACTION ISOLATION LEVEL {ISOLATION_LEVEL}")
+        finally:
+            cursor.close()
+        _initialized_connection_ids.add(connection_id)
+    return conn
+
+
+def open_connection(**options):
+    """
+    プールを使わずに専用の接続を開く。プールの接続と同じ接続先・セッション設定に options を追加して接続する
+    (例: LOAD DATA LOCAL INFILE 用の allow_local_infile)。
+    返却は release_connection() で行う (プールの接続と違い、実際に切断される)。
+    """
+    conn = mysql.connector.connect(**DB_CONFIG, **SESSION_CONFIG, **options)
+    if ISOLATION_LEVEL is not None:
+        cursor = conn.cursor()
+        try:
+            cursor.execute(f"SET SESSION TRANSACTION ISOLATION LEVEL {ISOLATION_LEVEL}")
+        finally:
+            cursor.close()
+    return conn
+
+
+def release_connection(conn):
+    """
+    接続をプールに返却する。未完了のトランザクションはロールバックしてから返す。
+    """
+    if conn is None:
+        return
+    try:
+        if conn.is_connected() and conn.in_transaction:
+            conn.rollback()
+    except mysql.connector.Error as err:
+        logger.warning("接続の返却前の後始末に失敗しました: %s", err)
+    finally:
+        conn.close()
+
+
+@contextmanager
+def connection():
+    """with connection() as conn: の形で接続を借り、ブロックを抜けるときに返却する。"""
+    conn = get_connection()
+    try:
+        yield conn
+    finally:
+        release_connection(conn)
@@ -0,0 +1,77 @@
+import json
+import random
+from datetime import datetime, timedelta
+
+# ==============================================================================
+# 合成 Duga API ペイロード生成
+# = ベンチマークや負荷試験用に、Duga API の item と同じ形の辞書を乱数で生成する。
+#   カテゴリ・女優・画像の件数と、1製品あたりのスナップショット (raw_api_data 行) 数を指定できる。
+#   seed を固定すれば毎回同じデータになる。
+# ==============================================================================
+
+GENRE_NAMES = ('素人', 'フェチ', 'アダルト', 'ドラマ', 'コスプレ', 'ハイビジョン', '独占配信', 'ベスト・総集編')
+MAKER_NAMES = ('メーカーA', 'メーカーB', 'メーカーC', 'メーカーD')
+DATE_FORMATS = ('%Y-%m-%d', '%Y/%m/%d', '%Y%m%d')
+
+
+def generate_duga_item(rng: random.Random, product_id: str, categories: int = 3, performers: int = 2,
+                       posterimages: int = 1, jacketimages: int = 1) -> dict:
+    """
+    Duga API の item 1件分 (raw_api_data.api_response_data に保存される形) を生成する。
+    価格は「1,980円」のような文字列、日付は複数の書式が混ざるようにする。
+    """
+    release_date = datetime(2020, 1, 1) + timedelta(days=rng.randrange(2000))
+    return {
+        "productid": product_id,
+        "title": f"  合成タイトル {product_id} ",
+        "originaltitle": f"Synthetic Title {product_id}",
+        "caption": "合成データのキャプションです。" * rng.randint(1, 5),
+        "releasedate": release_date.strftime(rng.choice(DATE_FORMATS)),
+        "opendate": release_date.strftime('%Y-%m-%d'),
+        "makername": rng.choice(MAKER_NAMES),
+        "itemno": f"SYN-{rng.randrange(100000):05d}",
+        "price": f"{rng.randint(5, 60) * 100:,}円",
+        "volume": rng.randint(10, 240),
+        "url": f"http://example.com/ppv/{product_id}",
+        "affiliateurl": f"http://affiliate.example.com/ppv/{product_id}",
+        "posterimage": [
+            {"small": f"http://example.com/{product_id}/p_s{i}.jpg", "midium": f"http://example.com/{product_id}/p_m{i}.jpg",
+             "large": f"http://example.com/{product_id}/p_l{i}.jpg"}
+            for i in range(posterimages)
+        ],
+        "jacketimage": [
+            {"small": f"http://example.com/{product_id}/j_s{i}.jpg", "midium": f"http://example.com/{product_id}/j_m{i}.jpg",
+             "large": f"http://example.com/{product_id}/j_l{i}.jpg"}
+            for i in range(jacketimages)
+        ],
+        "thumbnail": [{"image": f"http://example.com/{product_id}/t_{i}.jpg"} for i in range(rng.randint(0, 10))],
+        "samplemovie": [{"midium": {"movie": f"http://example.com/{product_id}/mov.mp4",
+                                    "capture": f"http://example.com/{product_id}/cap.jpg"}}],
+        "category": [{"data": {"id": str(rng.randrange(100)), "name": rng.choice(GENRE_NAMES)}} for _ in range(categories)],
+        "performer": [{"data": {"id": f"ACT{rng.randrange(5000):04d}", "name": f"女優{rng.randrange(5000):04d}"}} for _ in range(performers)],
+        "series": {"name": f"シリーズ{rng.randrange(300):03d}"},
+        "label": {"id": f"LBL{rng.randrange(50):02d}", "name": f"レーベル{rng.randrange(50):02d}"},
+    }
+
+
+def generate_product_raw_rows(rng: random.Random, product_count: int, snapshots_per_product: int = 2,
+                              first_raw_id: int = 1, first_product_index: int = 0, **item_options) -> dict:
+    """
+    product_count 件の製品について snapshots_per_product 件ずつのスナップショットを生成し、
+    load_unprocessed_raw_rows_for_keys と同じ {(product_id, 'duga'): [(id, JSON文字列, fetched_at), ...]} を返す。
+    各製品の行は fetched_at DESC, id DESC 順に並べる。
+    大量に生成する場合は first_product_index をずらしながら分割して呼び出せばよい。
+    """
+    raw_rows_by_key = {}
+    raw_id = first_raw_id
+    fetched_base = datetime(2025, 1, 1)
+    for product_index in range(first_product_index, first_product_index + product_count):
+        product_id = f"SYN{product_index:07d}"
+        rows = []
+        for snapshot_index in range(snapshots_per_product):
+            item = generate_duga_item(rng, product_id, **item_options)
+            rows.append((raw_id, json.dumps(item, ensure_ascii=False), fetched_base + timedelta(hours=snapshot_index)))
+            raw_id += 1
+        rows.reverse()
+        raw_rows_by_key[(product_id, 'duga')] = rows
+    return raw_rows_by_key
@@ -0,0 +1,121 @@
+from collections import namedtuple
+
+# ==============================================================================
+# フィールド抽出プラン
+# = 「productsのカラム名 → JSONパスと正規化関数」の宣言的な対応表 (フィールドマップ) を
+#   1回だけ Python の関数にコンパイルし、item 1件から全カラムの値を1パスで取り出す。
+#   パスごとに辿る方式 (populate_db.py の get_safe_value) と違い、共通の親パス (例: samplemovie[0].midium) は1回しか辿らない。
+#   フィールドを追加してもツリーの走査は増えず、対応表に1行足すだけでよい。
+#
+#   取り出し結果は populate_db.py の get_safe_value と同じ規則に従う:
+#     - 文字列キーは dict にそのキーがある場合だけ辿る
+#     - 整数キーは dict にそのキーがある場合、または list の長さがキーより大きい場合だけ辿る
+#     - 辿れなかった場合は default を返す (値が None の場合は None のまま)
+#
+#   db_populator のイメージには populate_db.py と一緒にこのファイル単体がコピーされるため、
+#   標準ライブラリ以外に依存しないこと。
+# ==============================================================================
+
+_MISSING = object()
+
+
+def _is_none(value) -> bool:
+    return value is None
+
+
+class FieldSpec:
+    """
+    1カラム分の取り出し方。
+    paths    : JSONパス (キーのタプル)。複数指定した場合は、前のパスの値が empty(値) を満たすときに次のパスを使う
+    normalize: 取り出した値に適用する関数 (None の場合はそのまま)
+    default  : パスを辿れなかった場合の値 (normalize の前に適用される)
+    empty    : 次のパスにフォールバックするかどうかの判定関数 (デフォルト: 値が None)
+    """
+
+    __slots__ = ('name', 'paths', 'normalize', 'default', 'empty')
+
+    def __init__(self, name: str, *paths, normalize=None, default=None, empty=_is_none):
+        if not paths:
+            raise ValueError(f"フィールド '{name}' にパスが指定されていません。")
+        for path in paths:
+            for key in path:
+                # 生成するコードに埋め込むため、キーは str と int に限定する
+                if not isinstance(key, (str, int)) or isinstance(key, bool):
+                    raise TypeError(f"フィールド '{name}' のパスに使えないキーです: {key!r}")
+        self.name = name
+        self.paths = tuple(tuple(path) for path in paths)
+        self.normalize = normalize
+        self.default = default
+        self.empty = empty
+
+
+class FieldPlan:
+    """
+    compile_field_map() の結果。plan(item) で1件分のレコード (namedtuple) を返す。
+    source には生成した関数のソースコードが入る (デバッグ用)。
+    """
+
+    def __init__(self, fields, record_type, extract, source: str):
+        self.fields = fields
+        self.names = record_type._fields
+        self.record_type = record_type
+        self.source = source
+        self._extract = extract
+
+    def __call__(self, item):
+        return self._extract(item)
+
+
+def compile_field_map(fields, record_name: str = 'FieldRecord') -> FieldPlan:
+    """
+    FieldSpec のリストを、item からレコードを1パスで取り出す関数にコンパイルする。
+    JSONパスの共通部分は変数に置いて使い回し、各パスの途中の値は1回だけ計算する。
+    """
+    fields = tuple(fields)
+    record_type = namedtuple(record_name, [spec.name for spec in fields])
+    namespace = {'_MISSING': _MISSING, '_dict': dict, '_list': list, '_isinstance': isinstance, '_len': len,
+                 '_Record': record_type}
+    lines = ["def extract(item):"]
+    node_names = {(): 'item'} # パスの接頭辞 → その値を保持する変数名
+
+    def node(path) -> str:
+        """path の値を保持する変数名を返す。まだ計算していない接頭辞の代入文を lines に追加する。"""
+        if path in node_names:
+            return node_names[path]
+        parent = node(path[:-1])
+        key = path[-1]
+        name = f"n{len(node_names)}"
+        node_names[path] = name
+        if isinstance(key, str):
+            lines.append(f"    {name} = {parent}.get({key!r}, _MISSING) if _isinstance({parent}, _dict) else _MISSING")
+        else:
+            lines.append(
+                f"    {name} = ({parent}.get({key!r}, _MISSING) if _isinstance({parent}, _dict)"
+                f" else {parent}[{key!r}] if _isinstance({parent}, _list) and _len({parent}) > {key!r} else _MISSING)"
+            )
+        return name
+
+    value_names = []
+    for index, spec in enumerate(fields):
+        value_name = f"v{index}"
+        default_name = f"_default{index}"
+        namespace[default_name] = spec.default
+        for path_index, path in enumerate(spec.paths):
+            source_name = node(path)
+            if path_index == 0:
+                lines.append(f"    {value_name} = {default_name} if {source_name} is _MISSING else {source_name}")
+            else:
+                empty_name = f"_empty{index}"
+                namespace[empty_name] = spec.empty
+                lines.append(f"    if {empty_name}({value_name}):")
+                lines.append(f"        {value_name} = {default_name} if {source_name} is _MISSING else {source_name}")
+        if spec.normalize is not None:
+            normalize_name = f"_normalize{index}"
+            namespace[normalize_name] = spec.normalize
+            lines.append(f"    {value_name} = {normalize_name}({value_name})")
+        value_names.append(value_name)
+    lines.append(f"    return _Record({', '.join(value_names)})")
+
+    source = "\n".join(lines) + "\n"
+    exec(compile(source, f"<field_map:{record_name}>", 'exec'), namespace)
+    return FieldPlan(fields, record_type, namespace['extract'], source)
@@ -0,0 +1,147 @@
+import logging
+import time
+from contextlib import contextmanager
+
+from run_metrics import NULL_METRICS
+
+# ==============================================================================
+# グループコミット
+# = 1製品ごとの conn.commit() (= redo ログの flush) をやめ、N製品ごと または T ミリ秒ごとにまとめてコミットする。
+#   各製品は SAVEPOINT の中で処理し、失敗した製品だけを ROLLBACK TO SAVEPOINT で取り消す。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+SAVEPOINT_NAME = 'product_savepoint'
+
+
+class GroupCommitter:
+    """
+    製品単位の処理をまとめてコミットするクラス。
+    category_resolver (CategoryResolver) / link_buffer (ProductCategoryLinkBuffer / ProductCategoryLinkSync) /
+    processed_marker (RawProcessedMarker) のコミット前 flush とコミット後・ロールバック後の後始末もここで行う。
+
+    commit_every <= 1 かつ commit_interval_ms が未指定の場合は従来通り1製品ごとにコミットし、
+    セーブポイントは使わない (失敗時はトランザクション全体をロールバックする)。
+    metrics (RunMetrics) を渡すと flush とコミットの所要時間を計測する。
+    """
+
+    def __init__(self, conn, cursor, category_resolver, link_buffer, processed_marker,
+                 commit_every: int = 1, commit_interval_ms=None, metrics=NULL_METRICS):
+        self.conn = conn
+        self.cursor = cursor
+        self.category_resolver = category_resolver
+        self.link_buffer = link_buffer
+        self.processed_marker = processed_marker
+        self.commit_every = commit_every
+        self.commit_interval_ms = commit_interval_ms
+        self.metrics = metrics
+        self.group_mode = commit_every > 1 or commit_interval_ms is not None
+        self._products_in_group = 0
+        self._group_started = time.monotonic()
+        # 統計情報
+        self.commits = 0
+        self.rollbacks = 0
+        self.savepoint_rollbacks = 0
+
+    @contextmanager
+    def product(self):
+        """
+        1製品分の処理を囲むコンテキストマネージャ。
+        グループモードでは SAVEPOINT を作成し、例外が発生した場合はセーブポイントまで戻して例外を再送出する。
+        セーブポイントへ戻せない場合 (デッドロックでトランザクション全体が取り消された場合など) は
+        グループ全体をロールバックする。
+        """
+        if not self.group_mode:
+            try:
+                yield
+            except Exception:
+                self.rollback()
+                raise
+            return
+
+        self.cursor.execute(f"SAVEPOINT {SAVEPOINT_NAME}")
+        marks = (self.category_resolver.mark(), self.link_buffer.mark(), self.processed_marker.mark())
+        try:
+            yield
+        except Exception:
+            try:
+                self.cursor.execute(f"ROLLBACK TO SAVEPOINT {SAVEPOINT_NAME}")
+            except Exception as rollback_error:
+                logger.warning("セーブポイントへのロールバックに失敗したため、グループ全体をロールバックします (%d 件の製品が未処理に戻ります): %s",
+                               self._products_in_group, rollback_error)
+                self.rollback()
+                raise
+            self.category_resolver.rollback_to(marks[0])
+            self.link_buffer.rollback_to(marks[1])
+            self.processed_marker.rollback_to(marks[2])
+            self.savepoint_rollbacks += 1
+            raise
+        else:
+            self.cursor.execute(f"RELEASE SAVEPOINT {SAVEPOINT_NAME}")
+
+    def product_done(self) -> bool:
+        """
+        1製品の処理に成功した後に呼ぶ。
+        N製品 または T ミリ秒に達していればコミットし、コミットした場合は True を返す。
+        """
+        self._products_in_group += 1
+        if not self.group_mode:
+            return self.commit()
+        if self.commit_every > 0 and self._products_in_group >= self.commit_every:
+            return self.commit()
+        if self.commit_interval_ms is not None and (time.monotonic() - self._group_started) * 1000 >= self.commit_interval_ms:
+            return self.commit()
+        return False
+
+    def commit(self) -> bool:
+        """
+        バッファを flush してコミットする。flush またはコミットに失敗した場合はグループ全体をロールバックし、False を返す。
+        """
+        try:
+            with self.metrics.stage('link_flush'):
+                self.link_buffer.flush(self.cursor)
+            with self.metrics.stage('mark_processed'):
+                self.processed_marker.flush(self.cursor) # グループ内のraw行は同じタイムスタンプで1回の UPDATE
+            with self.metrics.stage('commit'):
+                self.conn.commit()
+        except Exception as e:
+            logger.error("グループコミット中にエラーが発生しました (%d 件の製品が未処理に戻ります): %s", self._products_in_group, e)
+            self.rollback()
+            return False
+        self.category_resolver.on_commit()
+        self.link_buffer.reset()
+        if self.group_mode:
+            logger.debug("%d 件の製品をまとめてコミットしました。", self._products_in_group)
+        self.commits += 1
+        self._start_group()
+        return True
+
+    def commit_pending(self) -> bool:
+        """未コミットの製品が残っていればコミットする (ページの終わりや終了時に呼ぶ)。"""
+        if self._products_in_group == 0:
+            return True
+        return self.commit()
+
+    def rollback(self):
+        """トランザクション全体をロールバックし、各バッファの未確定分を破棄する。"""
+        if self.conn and self.conn.is_connected():
+            self.conn.rollback()
+            logger.warning("トランザクションをロールバックしました。")
+        self.category_resolver.on_rollback()
+        self.link_buffer.discard()
+        self.processed_marker.discard()
+        self.rollbacks += 1
+        self._start_group()
+
+    def _start_group(self):
+        self._products_in_group = 0
+        self._group_started = time.monotonic()
+
+    def stats(self) -> dict:
+        """コミット回数・ロールバック回数などの統計を返す。"""
+        return {
+            'commits': self.commits,
+            'rollbacks': self.rollbacks,
+            'savepoint_rollbacks': self.savepoint_rollbacks,
+        }
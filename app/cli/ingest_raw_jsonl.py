@@ -0,0 +1,251 @@
+import sys
+import json
+import gzip
+import hashlib
+import time
+import argparse
+import logging
+from datetime import datetime
+
+import mysql.connector
+
+import json_codec
+from db_bulk import bulk_insert_on_duplicate_update, chunked
+from db_connection import DB_CONFIG, get_connection, release_connection
+from raw_data import PAYLOAD_ZLIB_COLUMN_NAME, payload_zlib_column_exists, read_raw_payload
+
+# ==============================================================================
+# JSONL ストリーミング取り込み
+# = APIダンプ (JSONL / gzip圧縮JSONL) を1行ずつ読み、raw_api_data にまとめて INSERT する。
+#   PHP の process_duga_api.php を経由せずに過去のダンプを再投入するためのコマンド。
+#   メモリ使用量はバッチサイズ分のみで、ファイルサイズに依存しない。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+RAW_INSERT_COLUMNS = ('product_id', 'api_response_data', 'source_api', 'fetched_at', 'updated_at')
+DEFAULT_BATCH_SIZE = 1000       # 1コミットあたりの行数
+DEFAULT_INSERT_CHUNK_SIZE = 500 # 1ステートメントあたりの行数
+DEFAULT_REPORT_INTERVAL_SECONDS = 10.0
+
+
+def open_jsonl(path: str):
+    """
+    JSONL ファイルをバイナリモードで開く (デコードは json_codec.loads に任せる)。
+    先頭2バイトが gzip のマジックナンバーなら gzip として開く。
+    """
+    if path == '-':
+        return sys.stdin.buffer
+    with open(path, 'rb') as f:
+        is_gzip = f.read(2) == b'\x1f\x8b'
+    if is_gzip:
+        return gzip.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def extract_item(record):
+    """
+    1行分のJSONから API の item を取り出す。
+    PHP 側と同じく {"item": {...}} 形式を想定し、item キーがない場合は行全体を item とみなす。
+    有効な item でなければ None を返す。
+    """
+    if not isinstance(record, dict):
+        return None
+    item = record.get('item', record)
+    if not isinstance(item, dict) or not item:
+        return None
+    return item
+
+
+def payload_digest(payload: str) -> str:
+    """正規化した JSON 文字列 (キー順をそろえたもの) の SHA-256 を返す。スナップショットの一致判定に使う。"""
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def find_existing_payload_digests(cursor, source_api_name: str, rows_by_digest: dict, include_compressed: bool = False) -> set:
+    """
+    {digest: (product_id, 正規化した JSON 文字列)} のうち、同じ内容のスナップショットが raw_api_data に既にあるものの digest を返す。
+    完全に一致するスナップショットの再投入をスキップするために使う
+    (PHP 側の product_id, source_api, api_response_data の一致チェックに相当)。
+    未圧縮の行は JSON としての一致を MySQL 側で判定するため、既存のスナップショットを Python に読み込まない。
+    include_compressed が True の場合、未圧縮の行と一致しなかったものだけ圧縮済みの行
+    (api_response_data が JSON の null) を read_raw_payload で展開し、digest を比べる (展開した内容は保持しない)。
+    """
+    existing = set()
+    row_placeholder = "SELECT CONVERT(%s USING utf8mb4) COLLATE utf8mb4_unicode_ci AS product_id, %s AS digest, CAST(%s AS JSON) AS payload"
+    for chunk in chunked(list(rows_by_digest.items()), DEFAULT_INSERT_CHUNK_SIZE):
+        params = [value for digest, (product_id, payload) in chunk for value in (product_id, digest, payload)]
+        cursor.execute(f"""
+            SELECT k.digest
+            FROM ({" UNION ALL ".join([row_placeholder] * len(chunk))}) k
+            WHERE EXISTS (
+                SELECT 1 FROM raw_api_data r
+                WHERE r.source_api = %s AND r.product_id = k.product_id AND r.api_response_data = k.payload
+            )
+        """, params + [source_api_name])
+        existing.update(digest for digest, in cursor.fetchall())
+
+    if not include_compressed:
+        return existing
+    remaining = {digest: product_id for digest, (product_id, _) in rows_by_digest.items() if digest not in existing}
+    for chunk in chunked(list(dict.fromkeys(remaining.values())), DEFAULT_INSERT_CHUNK_SIZE):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"SELECT `{PAYLOAD_ZLIB_COLUMN_NAME}` FROM raw_api_data "
+            f"WHERE source_api = %s AND product_id IN ({placeholders}) AND `{PAYLOAD_ZLIB_COLUMN_NAME}` IS NOT NULL",
+            [source_api_name] + chunk,
+        )
+        for api_response_data_zlib, in cursor.fetchall():
+            try:
+                digest = payload_digest(json.dumps(json_codec.loads(read_raw_payload(None, api_response_data_zlib)), ensure_ascii=False, sort_keys=True))
+            except (TypeError, ValueError):
+                continue
+            if digest in remaining:
+                existing.add(digest)
+    return existing
+
+
+class IngestStats:
+    """取り込み件数とスループットを集計するクラス。"""
+
+    def __init__(self):
+        self.started = time.monotonic()
+        self.lines_read = 0
+        self.bytes_read = 0
+        self.rows_inserted = 0
+        self.skipped_invalid = 0   # JSONとして不正、または item / productid がない行
+        self.skipped_existing = 0  # 既存データと完全に一致した行
+        self.batches_committed = 0
+
+    def report(self, prefix: str = "進捗"):
+        elapsed = max(time.monotonic() - self.started, 1e-9)
+        logger.info(
+            "%s: %d 行読込 (%.1f MB), %d 件INSERT, 不正 %d 件, 既存一致 %d 件, %d バッチ, "
+            "%.1f 秒, %.0f 行/秒, %.2f MB/秒",
+            prefix, self.lines_read, self.bytes_read / 1048576, self.rows_inserted,
+            self.skipped_invalid, self.skipped_existing, self.batches_committed,
+            elapsed, self.lines_read / elapsed, self.bytes_read / 1048576 / elapsed,
+        )
+
+
+def flush_batch(cursor, conn, batch, source_api_name: str, stats: IngestStats, skip_existing: bool, insert_chunk_size: int,
+                include_compressed: bool = False):
+    """
+    バッファした (product_id, 正規化した JSON 文字列) を raw_api_data にまとめて INSERT し、コミットする。
+    skip_existing が True の場合は既存データ (include_compressed が True なら圧縮済みの行も) と完全に一致するものを除外する。
+    """
+    if not batch:
+        return
+    # バッチ内の完全一致する重複を除外 (同じ内容のスナップショットは1件だけ残す)
+    unique_rows = {}
+    for product_id, payload in batch:
+        unique_rows.setdefault(payload_digest(payload), (product_id, payload))
+    stats.skipped_existing += len(batch) - len(unique_rows)
+
+    existing = find_existing_payload_digests(cursor, source_api_name, unique_rows, include_compressed) if skip_existing else set()
+
+    now = datetime.now()
+    rows = []
+    for digest, (product_id, payload) in unique_rows.items():
+        if digest in existing:
+            stats.skipped_existing += 1
+            continue
+        rows.append((product_id, payload, source_api_name, now, now))
+
+    bulk_insert_on_duplicate_update(cursor, 'raw_api_data', RAW_INSERT_COLUMNS, rows, [], insert_chunk_size)
+    conn.commit()
+    stats.rows_inserted += len(rows)
+    stats.batches_committed += 1
+
+
+def ingest_jsonl(path: str, source_api_name: str, batch_size: int = DEFAULT_BATCH_SIZE, insert_chunk_size: int = DEFAULT_INSERT_CHUNK_SIZE,
+                 skip_existing: bool = True, report_interval_seconds: float = DEFAULT_REPORT_INTERVAL_SECONDS) -> IngestStats:
+    """
+    JSONL / gzip圧縮JSONL ファイルを1行ずつ読み、(source_api, product_id) をキーとして
+    batch_size 件ごとに raw_api_data へ複数行 INSERT してコミットする。
+    report_interval_seconds ごとに進捗とスループットをログに出力する。
+    """
+    stats = IngestStats()
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        # 圧縮済みの行は api_response_data が JSON の null のため、圧縮カラムがあればそちらも読んで比較する
+        include_compressed = skip_existing and payload_zlib_column_exists(cursor, DB_CONFIG['database'])
+
+        batch = []
+        last_report = time.monotonic()
+        with open_jsonl(path) as f:
+            for line_number, line in enumerate(f, start=1):
+                stats.lines_read += 1
+                stats.bytes_read += len(line)
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    item = extract_item(json_codec.loads(line))
+                except ValueError as e:
+                    logger.warning("%d 行目のJSONが不正なためスキップします: %s", line_number, e)
+                    stats.skipped_invalid += 1
+                    continue
+                product_id = item.get('productid') if item else None
+                if not product_id:
+                    logger.warning("%d 行目に有効な item / productid がないためスキップします。", line_number)
+                    stats.skipped_invalid += 1
+                    continue
+
+                # デコード済みの辞書はバッチに残さず、正規化した JSON 文字列 (一致判定の digest の元) にして保持する
+                batch.append((str(product_id), json.dumps(item, ensure_ascii=False, sort_keys=True)))
+                if len(batch) >= batch_size:
+                    flush_batch(cursor, conn, batch, source_api_name, stats, skip_existing, insert_chunk_size, include_compressed)
+                    batch = []
+                    if time.monotonic() - last_report >= report_interval_seconds:
+                        stats.report()
+                        last_report = time.monotonic()
+
+        flush_batch(cursor, conn, batch, source_api_name, stats, skip_existing, insert_chunk_size, include_compressed)
+        stats.report("取り込み完了")
+
+    except mysql.connector.Error as err:
+        logger.error("MySQL接続またはクエリ実行エラー: %s", err)
+        if conn and conn.is_connected():
+            conn.rollback()
+            logger.warning("未コミットのバッチをロールバックしました。コミット済みのバッチはそのまま残ります。")
+        stats.report("中断")
+    finally:
+        if conn is not None:
+            if conn.is_connected():
+                cursor.close()
+            release_connection(conn)
+    return stats
+
+
+# ==============================================================================
+# メイン処理
+# ==============================================================================
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(levelname)s: %(message)s', stream=sys.stdout)
+
+    parser = argparse.ArgumentParser(description="JSONL / gzip圧縮JSONL のAPIダンプを raw_api_data に取り込みます。")
+    parser.add_argument('path', help="取り込むファイルのパス (.jsonl / .jsonl.gz、'-' で標準入力)")
+    parser.add_argument('--source-api', default='duga',
+                        help="raw_api_data.source_api に設定する値 (デフォルト: duga)")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="1コミットあたりの行数")
+    parser.add_argument('--insert-chunk-size', type=int, default=DEFAULT_INSERT_CHUNK_SIZE,
+                        help="INSERT 1ステートメントあたりの最大行数")
+    parser.add_argument('--no-skip-existing', action='store_true',
+                        help="既存データと完全に一致するスナップショットも INSERT する (空のテーブルへの再投入を高速化)")
+    parser.add_argument('--report-interval', type=float, default=DEFAULT_REPORT_INTERVAL_SECONDS,
+                        help="進捗を出力する間隔 (秒)")
+    args = parser.parse_args()
+
+    ingest_jsonl(
+        args.path,
+        args.source_api,
+        batch_size=args.batch_size,
+        insert_chunk_size=args.insert_chunk_size,
+        skip_existing=not args.no_skip_existing,
+        report_interval_seconds=args.report_interval,
+    )
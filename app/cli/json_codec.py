@@ -0,0 +1,37 @@
+import json
+import logging
+
+# ==============================================================================
+# JSONデコード層
+# = raw_api_data.api_response_data などのデコードに使う。
+#   orjson がインストールされていれば orjson を使い、なければ標準の json にフォールバックする。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+try:
+    import orjson
+except ImportError: # orjson は任意の依存関係
+    orjson = None
+
+JSON_BACKEND = 'orjson' if orjson is not None else 'json'
+
+# orjson.JSONDecodeError は json.JSONDecodeError (ValueError) のサブクラスなので、
+# どちらのバックエンドでも json.JSONDecodeError / ValueError で捕捉できる
+JSONDecodeError = json.JSONDecodeError
+
+
+def loads(data):
+    """str / bytes のJSONをデコードする。"""
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+def decode_raw_rows(all_raw_data_for_product) -> list:
+    """
+    (id, api_response_data, fetched_at) の行リストの api_response_data を1回ずつデコードし、
+    (id, デコード済みの item, fetched_at) のリストを返す。
+    メイン行の選択とカテゴリ・画像の収集で同じデコード結果を共有するために使う。
+    """
+    return [(raw_id, loads(api_response_data), fetched_at) for raw_id, api_response_data, fetched_at in all_raw_data_for_product]
@@ -0,0 +1,482 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+from datetime import datetime
+
+import mysql.connector
+
+import populate_products_and_categories as populate
+from association_buffer import DEFAULT_LINK_MODE, LINK_MODES
+from db_connection import open_connection, release_connection
+from json_codec import decode_raw_rows
+from log_setup import setup_queue_logging
+from merge_state import load_merge_states, save_merge_states
+from raw_data import DEFAULT_PAGE_SIZE, iter_unprocessed_key_pages, load_unprocessed_raw_rows_for_keys
+from run_checkpoint import (
+    STATUS_COMPLETED, STATUS_FAILED, STATUS_STOPPED, GracefulStop, ensure_checkpoint_table_exists, save_checkpoint, start_run,
+    update_run_status,
+)
+from run_metrics import RunMetrics
+
+# ==============================================================================
+# LOAD DATA LOCAL INFILE による初回バックフィル
+# = 新しいソースの初回投入のように未処理の raw_api_data が数百万件ある場合に、
+#   製品ごと (またはバッチごと) の INSERT の代わりに、統合済みの製品行・カテゴリの紐付け・処理済みの raw_api_data.id を
+#   一時 TSV ファイルに書き出し、LOAD DATA LOCAL INFILE でステージング用の一時テーブルへ読み込んでから
+#   集合演算の SQL で products / categories / product_categories にまとめて反映する。
+#
+#   統合 (merge_raw_rows_for_product / content_hash / category_keys_for_product) は
+#   process_single_product_id_batch と同じ関数を使うため、結果は通常の処理と一致する:
+#     - content_hash が既存の製品と一致する製品は products も紐付けも書き込まない
+#     - 同じ product_id が複数回現れた場合は後に処理したものが products に残る
+#     - product_categories は --link-mode append (デフォルト) では INSERT IGNORE と同じく追加のみ行い、
+#       --link-mode sync では書き込んだ製品の紐付けをステージングの集合に同期する (集合にない既存の紐付けは削除する)
+#     - タイトルが空などでスキップした製品の raw 行も処理済みにする
+#   chunk_products 件ごとに1トランザクションで反映してコミットする。
+#
+#   チャンクのコミットと同じトランザクションで、実行ID・最後に反映したキー・累計カウンタを
+#   run_checkpoints に保存する (run_checkpoint.py)。デプロイや OOM で中断された場合、次の実行は
+#   完了していない最新の実行を最後にコミットしたキーの続きから再開する (--fresh で最初からやり直す)。
+#   SIGTERM / SIGINT を受け取るか --time-budget に達すると、書き出し中のチャンクを反映・コミットしてから終了する。
+#
+#   MySQL サーバー側で local_infile が有効になっている必要がある (SET GLOBAL local_infile = 1 または --local-infile=1)。
+#
+#   使い方:
+#     python app/cli/load_data_backfill.py --chunk-products 50000 --tmp-dir /var/tmp
+#     python app/cli/load_data_backfill.py --time-budget 3300   # cron の枠内で終了し、次回の実行で続きから再開する
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+log_file_path = '/var/www/html/app/logs/load_data_backfill.log'
+
+METRICS_JOB_NAME = 'load_data_backfill'
+DEFAULT_CHUNK_PRODUCTS = 50000
+
+# ステージング用の一時テーブル
+STAGE_PRODUCTS_TABLE = 'stg_backfill_products'
+STAGE_LINKS_TABLE = 'stg_backfill_links'
+STAGE_RAW_IDS_TABLE = 'stg_backfill_raw_ids'
+STAGE_LINK_COLUMNS = ('product_id', 'category_type', 'category_name')
+
+# TSV (LOAD DATA のデフォルトの FIELDS ESCAPED BY '\\') でエスケープが必要な文字
+TSV_ESCAPES = str.maketrans({'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r', '\0': '\\0'})
+
+
+def tsv_field(value) -> str:
+    """値を LOAD DATA のデフォルト書式 (タブ区切り、バックスラッシュエスケープ、NULL は \\N) の1フィールドに変換する。"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, str):
+        return value.translate(TSV_ESCAPES)
+    return str(value).translate(TSV_ESCAPES)
+
+
+def tsv_line(values) -> str:
+    return '\t'.join(tsv_field(value) for value in values) + '\n'
+
+
+def ensure_local_infile_enabled(cursor):
+    """サーバー側の local_infile が無効な場合は RuntimeError を送出する。"""
+    cursor.execute("SELECT @@GLOBAL.local_infile")
+    if not cursor.fetchone()[0]:
+        raise RuntimeError(
+            "MySQL サーバーの local_infile が無効です。SET GLOBAL local_infile = 1 を実行するか、"
+            "mysqld を --local-infile=1 で起動してください。"
+        )
+
+
+def create_staging_tables(cursor):
+    """
+    ステージング用の一時テーブルを作成する。
+    カラムの型と照合順序は CREATE TABLE ... SELECT ... LIMIT 0 で本番テーブルから複製し、
+    JOIN 時に照合順序の不一致が起きないようにする。
+    products は product_id を主キーにし、LOAD DATA ... REPLACE で同じ product_id の後の行が残るようにする。
+    一時テーブルの作成・削除は暗黙のコミットを発生させない。
+    """
+    product_columns = ", ".join(f"`{col}`" for col in populate.PRODUCT_UPSERT_COLUMNS)
+    drop_staging_tables(cursor)
+    cursor.execute(f"""
+        CREATE TEMPORARY TABLE `{STAGE_PRODUCTS_TABLE}` (PRIMARY KEY (`product_id`))
+        SELECT {product_columns} FROM products LIMIT 0
+    """)
+    cursor.execute(f"""
+        CREATE TEMPORARY TABLE `{STAGE_LINKS_TABLE}`
+        SELECT p.product_id, c.type AS category_type, c.name AS category_name
+        FROM products p, categories c LIMIT 0
+    """)
+    cursor.execute(f"""
+        CREATE TEMPORARY TABLE `{STAGE_RAW_IDS_TABLE}` (PRIMARY KEY (`id`))
+        SELECT id FROM raw_api_data LIMIT 0
+    """)
+
+
+def clear_staging_tables(cursor):
+    for table_name in (STAGE_PRODUCTS_TABLE, STAGE_LINKS_TABLE, STAGE_RAW_IDS_TABLE):
+        cursor.execute(f"DELETE FROM `{table_name}`")
+
+
+def drop_staging_tables(cursor):
+    for table_name in (STAGE_PRODUCTS_TABLE, STAGE_LINKS_TABLE, STAGE_RAW_IDS_TABLE):
+        cursor.execute(f"DROP TEMPORARY TABLE IF EXISTS `{table_name}`")
+
+
+def load_tsv(cursor, file_path: str, table_name: str, columns, replace: bool = False) -> int:
+    """TSV ファイルを LOAD DATA LOCAL INFILE で一時テーブルに読み込み、読み込んだ行数を返す。"""
+    column_names = ", ".join(f"`{col}`" for col in columns)
+    duplicate_handling = "REPLACE" if replace else "IGNORE"
+    cursor.execute(
+        f"LOAD DATA LOCAL INFILE %s {duplicate_handling} INTO TABLE `{table_name}` CHARACTER SET utf8mb4 ({column_names})",
+        (file_path,),
+    )
+    return cursor.rowcount
+
+
+class BackfillChunkWriter:
+    """
+    1チャンク分の製品行・カテゴリの紐付け・raw_api_data.id を TSV ファイルに書き出すクラス。
+    行はメモリに溜めずにそのままファイルに書き込む。
+    """
+
+    def __init__(self, directory: str):
+        self.paths = {
+            'products': os.path.join(directory, 'products.tsv'),
+            'links': os.path.join(directory, 'links.tsv'),
+            'raw_ids': os.path.join(directory, 'raw_ids.tsv'),
+        }
+        self._files = {}
+        self.product_count = 0
+        self.link_count = 0
+        self.raw_id_count = 0
+
+    def open(self):
+        self._files = {name: open(path, 'w', encoding='utf-8', newline='') for name, path in self.paths.items()}
+        self.product_count = 0
+        self.link_count = 0
+        self.raw_id_count = 0
+
+    def close(self):
+        for file in self._files.values():
+            file.close()
+        self._files = {}
+
+    def add_raw_ids(self, raw_ids):
+        self._files['raw_ids'].writelines(f"{raw_id}\n" for raw_id in raw_ids)
+        self.raw_id_count += len(raw_ids)
+
+    def add_product(self, merged: dict, now):
+        self._files['products'].write(tsv_line(populate.product_row_values(merged, now)))
+        self.product_count += 1
+        category_keys = populate.category_keys_for_product(merged)
+        self._files['links'].writelines(
+            tsv_line((merged['product_id'], category_type, category_name)) for category_type, category_name in category_keys
+        )
+        self.link_count += len(category_keys)
+
+
+def write_key_page(cursor, writer: BackfillChunkWriter, product_keys, now, metrics) -> int:
+    """
+    (product_id, source_api) のリスト1ページ分の未処理 raw 行を取得・統合して TSV に書き出し、統合した製品数を返す。
+    process_product_keys_bulk と同じく、スキップした製品の raw 行も処理済みにする。
+    製品ごとの統合状態 (product_merge_state) は通常の INSERT で保存し、チャンクの反映と同じトランザクションでコミットされる。
+    """
+    with metrics.stage('raw_fetch'):
+        raw_rows_by_key = load_unprocessed_raw_rows_for_keys(cursor, product_keys)
+    with metrics.stage('state_load'):
+        merge_states = load_merge_states(cursor, product_keys)
+
+    merged_count = 0
+    page_states = []
+    for product_api_id, source_api_name in product_keys:
+        all_raw_data_for_product = raw_rows_by_key.get((product_api_id, source_api_name))
+        if not all_raw_data_for_product:
+            continue
+        metrics.incr('raw_rows', len(all_raw_data_for_product))
+
+        with metrics.stage('json_decode'):
+            decoded_raw_rows = decode_raw_rows(all_raw_data_for_product)
+        with metrics.stage('merge'):
+            merged = populate.merge_raw_rows_for_product(product_api_id, source_api_name, all_raw_data_for_product, decoded_raw_rows,
+                                                         merge_states.get((product_api_id, source_api_name)))
+        with metrics.stage('tsv_write'):
+            writer.add_raw_ids([raw_data_row[0] for raw_data_row in all_raw_data_for_product])
+            if merged is not None:
+                writer.add_product(merged, now)
+        if merged is not None:
+            merged_count += 1
+            page_states.append(merged['merge_state'])
+        else:
+            metrics.incr('products_skipped')
+    with metrics.stage('state_write'):
+        save_merge_states(cursor, page_states)
+    return merged_count
+
+
+def apply_chunk(cursor, writer: BackfillChunkWriter, processed_at, metrics, link_mode: str = DEFAULT_LINK_MODE) -> dict:
+    """
+    書き出し済みの TSV をステージングに読み込み、集合演算の SQL で本番テーブルに反映する。
+    link_mode='sync' の場合は、書き込んだ製品の紐付けのうちステージングにないものを削除する。
+    トランザクション管理 (コミット/ロールバック) は呼び出し元で行う。
+    """
+    product_columns = ", ".join(f"`{col}`" for col in populate.PRODUCT_UPSERT_COLUMNS)
+    update_clause = ", ".join(f"`{col}` = VALUES(`{col}`)" for col in populate.PRODUCT_UPDATE_COLUMNS)
+    result = {}
+
+    with metrics.stage('load_data'):
+        clear_staging_tables(cursor)
+        load_tsv(cursor, writer.paths['products'], STAGE_PRODUCTS_TABLE, populate.PRODUCT_UPSERT_COLUMNS, replace=True)
+        load_tsv(cursor, writer.paths['links'], STAGE_LINKS_TABLE, STAGE_LINK_COLUMNS)
+        load_tsv(cursor, writer.paths['raw_ids'], STAGE_RAW_IDS_TABLE, ('id',))
+
+    with metrics.stage('product_merge'):
+        # content_hash が既存の製品と一致する製品は、products も紐付けも書き込まない
+        cursor.execute(f"""
+            DELETE s FROM `{STAGE_PRODUCTS_TABLE}` s
+            JOIN products p ON p.product_id = s.product_id AND p.content_hash = s.content_hash
+        """)
+        result['products_unchanged'] = cursor.rowcount
+        cursor.execute(f"SELECT COUNT(*) FROM `{STAGE_PRODUCTS_TABLE}`")
+        result['products_written'] = cursor.fetchone()[0]
+        cursor.execute(f"""
+            INSERT INTO products ({product_columns})
+            SELECT {product_columns} FROM `{STAGE_PRODUCTS_TABLE}`
+            ON DUPLICATE KEY UPDATE {update_clause}
+        """)
+        result['products_affected'] = cursor.rowcount
+
+    with metrics.stage('category_merge'):
+        # 書き込んだ製品のカテゴリのうち未登録のものだけを作成する
+        # (CategoryResolver と同じく、他プロセスが同時に作成した重複は INSERT IGNORE で無視する)
+        cursor.execute(f"""
+            INSERT IGNORE INTO categories (type, name)
+            SELECT DISTINCT l.category_type, l.category_name
+            FROM `{STAGE_LINKS_TABLE}` l
+            JOIN `{STAGE_PRODUCTS_TABLE}` s ON s.product_id = l.product_id
+            LEFT JOIN categories c ON c.type = l.category_type AND c.name = l.category_name
+            WHERE c.id IS NULL
+        """)
+        result['categories_created'] = cursor.rowcount
+
+    with metrics.stage('link_merge'):
+        result['links_deleted'] = 0
+        if link_mode == 'sync':
+            # 一時テーブルは1つのクエリ内で2回参照できないため、ステージングの各テーブルは1回ずつ結合する
+            cursor.execute(f"""
+                DELETE pc FROM product_categories pc
+                JOIN products p ON p.id = pc.product_id
+                JOIN `{STAGE_PRODUCTS_TABLE}` s ON s.product_id = p.product_id
+                JOIN categories c ON c.id = pc.category_id
+                LEFT JOIN `{STAGE_LINKS_TABLE}` l
+                    ON l.product_id = s.product_id AND l.category_type = c.type AND l.category_name = c.name
+                WHERE l.product_id IS NULL
+            """)
+            result['links_deleted'] = cursor.rowcount
+        cursor.execute(f"""
+            INSERT IGNORE INTO product_categories (product_id, category_id)
+            SELECT DISTINCT p.id, c.id
+            FROM `{STAGE_LINKS_TABLE}` l
+            JOIN `{STAGE_PRODUCTS_TABLE}` s ON s.product_id = l.product_id
+            JOIN products p ON p.product_id = l.product_id
+            JOIN categories c ON c.type = l.category_type AND c.name = l.category_name
+        """)
+        result['links_inserted'] = cursor.rowcount
+
+    with metrics.stage('mark_processed'):
+        # チャンク内の raw 行は全て同じタイムスタンプで1回の UPDATE
+        cursor.execute(f"""
+            UPDATE raw_api_data r JOIN `{STAGE_RAW_IDS_TABLE}` t ON r.id = t.id
+            SET r.processed_at = %s
+        """, (processed_at,))
+        result['raw_rows_marked'] = cursor.rowcount
+    return result
+
+
+def run_load_data_backfill(chunk_products: int = DEFAULT_CHUNK_PRODUCTS, page_size: int = DEFAULT_PAGE_SIZE,
+                           tmp_dir=None, keep_files: bool = False, link_mode: str = DEFAULT_LINK_MODE,
+                           time_budget_seconds=None, resume: bool = True, stop=None, metrics=None) -> dict:
+    """
+    未処理キューをキーセットページングで末尾まで辿り、chunk_products 件ごとに
+    TSV 書き出し → LOAD DATA LOCAL INFILE → 集合演算の SQL で反映 → チェックポイント保存 → コミット を繰り返す。
+    resume=True の場合は完了していない最新の実行をチェックポイントの位置から再開する。
+    stop (GracefulStop) が停止を要求するか time_budget_seconds に達すると、書き出し中のチャンクを反映・コミットして終了する。
+    エラーが発生したチャンクはロールバックして処理を中断する (そのチャンクの raw_api_data は未処理のまま残る)。
+    この呼び出しの処理件数・チャンク数・エラーメッセージ、実行ID・終了時の状態と、ステージ別の所要時間をまとめた辞書を返す。
+    """
+    if metrics is None:
+        metrics = RunMetrics(METRICS_JOB_NAME)
+    if stop is None:
+        stop = GracefulStop(time_budget_seconds)
+    summary = {'run_id': None, 'status': None, 'products_processed': 0, 'chunks': 0, 'errors': []}
+    checkpoint = None
+    exhausted = False
+    work_dir = tempfile.mkdtemp(prefix='load_data_backfill_', dir=tmp_dir)
+    writer = BackfillChunkWriter(work_dir)
+    conn = None
+    try:
+        # LOAD DATA LOCAL INFILE は専用の接続で行い、読み込めるファイルを作業ディレクトリ内に限定する
+        # (allow_local_infile を False のまま allow_local_infile_in_path だけを指定する)
+        conn = open_connection(allow_local_infile_in_path=work_dir)
+        cursor = conn.cursor()
+        ensure_local_infile_enabled(cursor)
+        # バルクUPSERTと同じく products.product_id の UNIQUE KEY を、キーセットページング用のインデックスとあわせて確認する
+        populate.ensure_schema_for_run(cursor, conn, bulk_size=1, drain=True)
+        ensure_checkpoint_table_exists(cursor, conn, populate.DB_CONFIG['database'])
+        create_staging_tables(cursor)
+
+        checkpoint = start_run(cursor, conn, METRICS_JOB_NAME, resume)
+        summary['run_id'] = checkpoint.run_id
+        key_pages = iter(iter_unprocessed_key_pages(cursor, page_size, after_key=checkpoint.after_key))
+        while not exhausted and not stop.requested():
+            now = datetime.now()
+            writer.open()
+            chunk_merged = 0
+            chunk_last_key = None
+            try:
+                # 停止が要求されたら次のページは読まず、書き出し済みの分だけを反映する
+                while writer.product_count < chunk_products and not stop.requested():
+                    with metrics.stage('key_scan'):
+                        product_keys = next(key_pages, None)
+                    if product_keys is None:
+                        exhausted = True
+                        break
+                    metrics.incr('pages')
+                    chunk_merged += write_key_page(cursor, writer, product_keys, now, metrics)
+                    last_product_id, last_source_api = product_keys[-1]
+                    chunk_last_key = (last_source_api, last_product_id)
+            finally:
+                writer.close()
+            if writer.raw_id_count == 0:
+                break
+
+            try:
+                result = apply_chunk(cursor, writer, now, metrics, link_mode)
+                # チェックポイントはチャンクと同じトランザクションで保存する (コミットに失敗した場合は位置も進まない)
+                if chunk_last_key is not None:
+                    checkpoint.after_key = chunk_last_key
+                checkpoint.incr('chunks')
+                checkpoint.incr('products_processed', chunk_merged)
+                checkpoint.incr('raw_rows_marked', result['raw_rows_marked'])
+                save_checkpoint(cursor, checkpoint)
+                with metrics.stage('commit'):
+                    conn.commit()
+            except Exception as err:
+                logger.error("チャンク %s の反映中にエラーが発生しました: %s", summary['chunks'] + 1, err)
+                summary['errors'].append(f"チャンク {summary['chunks'] + 1}: {err}")
+                conn.rollback()
+                logger.warning("トランザクションをロールバックしました。このチャンクの raw_api_data は未処理のまま残ります。")
+                break
+
+            summary['chunks'] += 1
+            summary['products_processed'] += chunk_merged
+            metrics.incr('chunks')
+            metrics.incr('products_processed', chunk_merged)
+            metrics.incr('products_unchanged', result['products_unchanged'])
+            metrics.incr('products_upserted', result['products_written'])
+            metrics.incr('categories_created', result['categories_created'])
+            metrics.incr('links_inserted', result['links_inserted'])
+            metrics.incr('links_deleted', result['links_deleted'])
+            logger.info(
+                "チャンク %s をコミットしました: 製品 %s 件 (変更なし %s 件), 新規カテゴリ %s 件, 紐付け 追加 %s 件 / 削除 %s 件, raw行 %s 件。",
+                summary['chunks'], chunk_merged, result['products_unchanged'],
+                result['categories_created'], result['links_inserted'], result['links_deleted'], result['raw_rows_marked'],
+            )
+
+        if exhausted and not summary['errors']:
+            logger.info("バックフィルが完了しました。総計 %s 件の製品を %s チャンクで処理しました。", summary['products_processed'], summary['chunks'])
+        elif stop.reason is not None:
+            logger.info(
+                "%s によりバックフィルを停止しました。%s 件の製品を %s チャンクで処理しました。次回の実行でキー %s の続きから再開します。",
+                stop.reason, summary['products_processed'], summary['chunks'], checkpoint.after_key,
+            )
+        if checkpoint.resumed or stop.reason is not None:
+            logger.info("実行 %s の累計: %s", checkpoint.run_id, checkpoint.counters)
+
+    except mysql.connector.Error as err:
+        logger.error("MySQL接続またはクエリ実行エラー: %s", err)
+        summary['errors'].append(f"MySQL接続またはクエリ実行エラー: {err}")
+        if conn is not None and conn.is_connected():
+            conn.rollback()
+    except Exception as e:
+        logger.error("バックフィルを中断しました: %s", e)
+        summary['errors'].append(f"バックフィルを中断しました: {e}")
+        if conn is not None and conn.is_connected():
+            conn.rollback()
+    finally:
+        if conn is not None:
+            if conn.is_connected():
+                if checkpoint is not None:
+                    if summary['errors']:
+                        summary['status'] = STATUS_FAILED
+                    elif exhausted:
+                        summary['status'] = STATUS_COMPLETED
+                    else:
+                        summary['status'] = STATUS_STOPPED
+                    try:
+                        update_run_status(cursor, checkpoint, summary['status'])
+                        conn.commit()
+                    except mysql.connector.Error as err:
+                        logger.error("実行 %s の状態を更新できませんでした: %s", checkpoint.run_id, err)
+                drop_staging_tables(cursor)
+                cursor.close()
+            release_connection(conn)
+        if keep_files:
+            logger.info("作業ファイルを残しました: %s", work_dir)
+        else:
+            shutil.rmtree(work_dir, ignore_errors=True)
+        metrics.finish()
+        metrics.log_summary(logger)
+        summary['metrics'] = metrics.to_dict()
+    return summary
+
+
+# ==============================================================================
+# メイン処理
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="LOAD DATA LOCAL INFILE で raw_api_data から products / categories を一括生成します。")
+    parser.add_argument('--chunk-products', type=int, default=DEFAULT_CHUNK_PRODUCTS,
+                        help="1回の LOAD DATA とコミットで反映する製品数の目安")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help="未処理キューの1ページで取得するユニークな製品IDの数")
+    parser.add_argument('--tmp-dir', default=None,
+                        help="TSV ファイルを書き出すディレクトリ (デフォルト: システムの一時ディレクトリ)")
+    parser.add_argument('--keep-files', action='store_true',
+                        help="終了後に TSV ファイルを削除しない (調査用。最後のチャンクの分だけが残る)")
+    parser.add_argument('--link-mode', choices=LINK_MODES, default=DEFAULT_LINK_MODE,
+                        help="product_categories の書き込み方法 (append: 追加のみ, sync: 書き込んだ製品の紐付けを差分で追加・削除。"
+                             "他の経路で追加した紐付けも削除される)")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="処理時間の上限 (秒)。超えると書き出し中のチャンクを反映・コミットして終了し、次回の実行で続きから再開する")
+    parser.add_argument('--fresh', action='store_true',
+                        help="完了していない実行のチェックポイントから再開せず、新しい実行として最初から処理する")
+    parser.add_argument('--metrics-json', default=None,
+                        help="実行終了時にステージ別の所要時間とカウンタを JSON で書き出すファイルパス")
+    parser.add_argument('--metrics-prom', default=None,
+                        help="実行終了時にメトリクスを Prometheus textfile collector 形式 (.prom) で書き出すファイルパス")
+    args = parser.parse_args()
+
+    setup_queue_logging(logger, log_file_path)
+    run_metrics = RunMetrics(METRICS_JOB_NAME)
+    # SIGTERM / SIGINT では書き出し中のチャンクを反映・コミットしてから終了する
+    stop = GracefulStop(args.time_budget).install()
+    try:
+        summary = run_load_data_backfill(
+            chunk_products=max(1, args.chunk_products),
+            page_size=args.page_size,
+            tmp_dir=args.tmp_dir,
+            keep_files=args.keep_files,
+            link_mode=args.link_mode,
+            resume=not args.fresh,
+            stop=stop,
+            metrics=run_metrics,
+        )
+    finally:
+        stop.restore()
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        run_metrics.write_prometheus_textfile(args.metrics_prom)
+    sys.exit(1 if summary['errors'] else 0)
@@ -0,0 +1,291 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import random
+import resource
+import sys
+import time
+from datetime import datetime
+
+import mysql.connector
+
+from db_bulk import bulk_insert_on_duplicate_update
+from db_connection import DB_CONFIG, get_connection, release_connection
+from duga_payloads import generate_product_raw_rows
+from merge_state import CREATE_MERGE_STATE_TABLE_SQL, MERGE_STATE_TABLE
+from work_lease import CREATE_LEASE_TABLE_SQL, LEASE_TABLE
+
+# ==============================================================================
+# エンドツーエンド負荷試験ハーネス
+# = docker-compose の mysql サービス上の負荷試験用データベースに合成 Duga データを投入し、
+#   populate_products_and_categories_main_loop を未処理キューが空になるまで実行して、
+#   規模ごとの所要時間・発行ステートメント数・行/秒・ピーク RSS を報告する。
+#   規模を変えて実行し、製品あたりの所要時間がほぼ一定 (= 線形にスケール) であることを確認する。
+#
+#   負荷試験用データベース (デフォルト: <DB_NAME>_loadtest) のテーブルは本番スキーマ (DB_NAME) から
+#   CREATE TABLE ... LIKE で作成し、規模ごとに TRUNCATE する。本番のテーブルには書き込まない。
+#   (CREATE TABLE ... LIKE は外部キーを複製しないため、外部キー検査のコストは含まれない)
+#   populate が実行時に作成するテーブル (product_merge_state / product_work_leases) は本番にまだない場合があるため、
+#   各モジュールの CREATE TABLE 文で作成する。これらも規模ごとに TRUNCATE し、前の規模の状態を引き継がない。
+#
+#   使い方:
+#     python app/cli/load_harness.py --scales 10000 100000 1000000 --snapshots 3 --bulk-size 500
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SCALES = (10000, 100000, 1000000)
+DEFAULT_SNAPSHOTS = 3
+SEED_BATCH_PRODUCTS = 500 # 投入時に一度に生成・INSERT する製品数
+LOAD_TEST_TABLES = ('raw_api_data', 'products', 'categories', 'product_categories')
+# populate が実行時に作成するテーブルと、その CREATE TABLE 文
+RUNTIME_TABLES = {
+    MERGE_STATE_TABLE: CREATE_MERGE_STATE_TABLE_SQL,
+    LEASE_TABLE: CREATE_LEASE_TABLE_SQL,
+}
+RAW_SEED_COLUMNS = ('product_id', 'api_response_data', 'source_api', 'fetched_at', 'updated_at')
+
+# 実行前後の差分を取る SHOW GLOBAL STATUS の項目
+STATUS_VARIABLES = (
+    'Questions', 'Com_select', 'Com_insert', 'Com_update', 'Com_delete', 'Com_commit',
+    'Innodb_rows_read', 'Innodb_rows_inserted', 'Innodb_rows_updated',
+)
+
+def prepare_load_test_database(cursor, source_database: str, load_test_database: str):
+    """
+    負荷試験用データベースを作成し、本番スキーマからテーブル定義を複製する。
+    populate が実行時に作成するテーブルも作成し、接続の既定のデータベースを負荷試験用に切り替える。
+    """
+    if load_test_database == source_database:
+        raise ValueError("負荷試験用データベースに本番データベースと同じ名前は指定できません。")
+    cursor.execute(f"CREATE DATABASE IF NOT EXISTS `{load_test_database}` CHARACTER SET utf8mb4 COLLATE utf8mb4_unicode_ci")
+    for table_name in LOAD_TEST_TABLES:
+        cursor.execute(f"CREATE TABLE IF NOT EXISTS `{load_test_database}`.`{table_name}` LIKE `{source_database}`.`{table_name}`")
+    cursor.execute(f"USE `{load_test_database}`")
+    for create_table_sql in RUNTIME_TABLES.values():
+        cursor.execute(create_table_sql)
+
+
+def reset_load_test_tables(cursor, load_test_database: str):
+    """負荷試験用データベースのテーブルを空にする。"""
+    for table_name in LOAD_TEST_TABLES + tuple(RUNTIME_TABLES):
+        cursor.execute(f"TRUNCATE TABLE `{load_test_database}`.`{table_name}`")
+
+
+def seed_raw_api_data(conn, cursor, product_count: int, snapshots_per_product: int, seed: int, item_options: dict) -> int:
+    """
+    合成 Duga データを product_count 製品 × snapshots_per_product 行だけ raw_api_data に投入する。
+    メモリ使用量を抑えるため SEED_BATCH_PRODUCTS 製品ずつ生成してコミットする。投入した行数を返す。
+    """
+    rng = random.Random(seed)
+    inserted_rows = 0
+    started = time.monotonic()
+    for first_product_index in range(0, product_count, SEED_BATCH_PRODUCTS):
+        batch_products = min(SEED_BATCH_PRODUCTS, product_count - first_product_index)
+        raw_rows_by_key = generate_product_raw_rows(
+            rng, batch_products, snapshots_per_product, first_product_index=first_product_index, **item_options,
+        )
+        rows = [
+            (product_id, api_response_data, source_api, fetched_at, fetched_at)
+            for (product_id, source_api), raw_rows in raw_rows_by_key.items()
+            for _, api_response_data, fetched_at in raw_rows
+        ]
+        bulk_insert_on_duplicate_update(cursor, 'raw_api_data', RAW_SEED_COLUMNS, rows, ())
+        conn.commit()
+        inserted_rows += len(rows)
+        if (first_product_index // SEED_BATCH_PRODUCTS) % 200 == 0:
+            logger.info("  raw_api_data 投入中: %s / %s 行", inserted_rows, product_count * snapshots_per_product)
+    elapsed = time.monotonic() - started
+    logger.info("raw_api_data に %s 行を投入しました (%.1f 秒, %.0f 行/秒)。", inserted_rows, elapsed, inserted_rows / elapsed if elapsed > 0 else 0)
+    return inserted_rows
+
+
+def fetch_global_status(cursor) -> dict:
+    placeholders = ", ".join(["%s"] * len(STATUS_VARIABLES))
+    cursor.execute(f"SHOW GLOBAL STATUS WHERE Variable_name IN ({placeholders})", STATUS_VARIABLES)
+    return {name: int(value) for name, value in cursor.fetchall()}
+
+
+def count_unprocessed_raw_rows(cursor) -> int:
+    cursor.execute("SELECT COUNT(*) FROM raw_api_data WHERE processed_at IS NULL")
+    return cursor.fetchone()[0]
+
+
+def run_pipeline_in_child(load_test_database: str, log_file_path: str, loop_options: dict, workers: int, result_conn):
+    """
+    子プロセスのエントリポイント。populate を負荷試験用データベースに向けて最後まで実行し、
+    所要時間・処理結果・ピーク RSS を result_conn に送る。
+    規模ごとにピーク RSS を測れるよう、計測対象の処理は毎回新しいプロセスで実行する。
+    """
+    import populate_products_and_categories as populate
+    from log_setup import setup_queue_logging, stop_queue_logging
+
+    # 本番のログファイルに負荷試験のログが混ざらないよう、ハーネス用のログファイルに切り替える
+    stop_queue_logging(populate.log_listener)
+    listener = setup_queue_logging(populate.logger, log_file_path)
+    # 共通プールは最初の get_connection() で作成されるため、その前に接続先を切り替える
+    populate.DB_CONFIG['database'] = load_test_database
+    try:
+        started = time.monotonic()
+        if workers > 1:
+            summaries = populate.run_sharded_main_loop(workers, **loop_options)
+            products_processed = sum(summary['products_processed'] for summary in summaries)
+            errors = sum(len(summary['errors']) for summary in summaries)
+        else:
+            summary = populate.populate_products_and_categories_main_loop(**loop_options)
+            products_processed = summary['products_processed']
+            errors = len(summary['errors'])
+        wall_seconds = time.monotonic() - started
+    finally:
+        stop_queue_logging(listener)
+
+    # ru_maxrss は Linux では KB 単位。並列実行時はワーカープロセスの最大値も見る
+    peak_rss_kb = max(
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss,
+    )
+    result_conn.send({
+        'wall_seconds': wall_seconds,
+        'products_processed': products_processed,
+        'errors': errors,
+        'peak_rss_mb': peak_rss_kb / 1024,
+    })
+    result_conn.close()
+
+
+def run_scale_point(conn, cursor, load_test_database: str, product_count: int, args, loop_options: dict) -> dict:
+    """1つの規模について投入・実行・計測を行い、結果の辞書を返す。"""
+    logger.info("=== %s 製品 × %s スナップショット ===", product_count, args.snapshots)
+    reset_load_test_tables(cursor, load_test_database)
+    conn.commit()
+    item_options = {'categories': args.categories, 'performers': args.performers}
+    raw_rows = seed_raw_api_data(conn, cursor, product_count, args.snapshots, args.seed, item_options)
+
+    status_before = fetch_global_status(cursor)
+    context = multiprocessing.get_context('spawn')
+    parent_conn, child_conn = context.Pipe(duplex=False)
+    process = context.Process(
+        target=run_pipeline_in_child,
+        args=(load_test_database, args.log_file, loop_options, args.workers, child_conn),
+    )
+    process.start()
+    child_conn.close()
+    try:
+        child_result = parent_conn.recv()
+    except EOFError:
+        child_result = None
+    process.join()
+    status_after = fetch_global_status(cursor)
+    if child_result is None:
+        raise RuntimeError(f"populate の子プロセスが結果を返さずに終了しました (終了コード: {process.exitcode})。")
+
+    status_delta = {name: status_after.get(name, 0) - status_before.get(name, 0) for name in STATUS_VARIABLES}
+    wall_seconds = child_result['wall_seconds']
+    result = {
+        'products': product_count,
+        'raw_rows': raw_rows,
+        'products_processed': child_result['products_processed'],
+        'errors': child_result['errors'],
+        'unprocessed_raw_rows_remaining': count_unprocessed_raw_rows(cursor),
+        'wall_seconds': wall_seconds,
+        # Questions にはハーネス自身の SHOW GLOBAL STATUS なども数件含まれる
+        'statements': status_delta['Questions'],
+        'statements_per_product': status_delta['Questions'] / product_count if product_count else 0.0,
+        'raw_rows_per_second': raw_rows / wall_seconds if wall_seconds > 0 else 0.0,
+        'products_per_second': child_result['products_processed'] / wall_seconds if wall_seconds > 0 else 0.0,
+        'microseconds_per_product': wall_seconds * 1e6 / product_count if product_count else 0.0,
+        'peak_rss_mb': child_result['peak_rss_mb'],
+        'status_delta': status_delta,
+    }
+    logger.info(
+        "%s 製品: %.1f 秒, %s ステートメント (%.1f/製品), %.0f raw行/秒, %.0f 製品/秒, ピーク RSS %.1f MB, 未処理残り %s 行",
+        product_count, wall_seconds, result['statements'], result['statements_per_product'],
+        result['raw_rows_per_second'], result['products_per_second'], result['peak_rss_mb'],
+        result['unprocessed_raw_rows_remaining'],
+    )
+    return result
+
+
+def print_report(results):
+    """規模ごとの結果を表にし、最小規模に対する製品あたり所要時間の比 (1.0 に近いほど線形) を表示する。"""
+    print()
+    print(f"{'products':>10} {'raw rows':>10} {'wall[s]':>9} {'stmts':>11} {'stmt/prod':>9} "
+          f"{'raw rows/s':>11} {'prod/s':>9} {'us/prod':>9} {'vs min':>7} {'RSS[MB]':>8} {'left':>6}")
+    base = results[0]['microseconds_per_product'] if results else 0.0
+    for result in results:
+        ratio = result['microseconds_per_product'] / base if base else 0.0
+        print(f"{result['products']:>10} {result['raw_rows']:>10} {result['wall_seconds']:>9.1f} {result['statements']:>11} "
+              f"{result['statements_per_product']:>9.2f} {result['raw_rows_per_second']:>11.0f} {result['products_per_second']:>9.0f} "
+              f"{result['microseconds_per_product']:>9.0f} {ratio:>7.2f} {result['peak_rss_mb']:>8.1f} "
+              f"{result['unprocessed_raw_rows_remaining']:>6}")
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    parser = argparse.ArgumentParser(description="合成データで populate のエンドツーエンドのスループットを規模別に計測します。")
+    parser.add_argument('--scales', type=int, nargs='+', default=list(DEFAULT_SCALES), help="計測する製品数 (複数指定可)")
+    parser.add_argument('--snapshots', type=int, default=DEFAULT_SNAPSHOTS, help="1製品あたりのスナップショット (raw_api_data 行) 数")
+    parser.add_argument('--categories', type=int, default=3, help="1スナップショットあたりの category エントリ数")
+    parser.add_argument('--performers', type=int, default=2, help="1スナップショットあたりの performer エントリ数")
+    parser.add_argument('--seed', type=int, default=42, help="ペイロード生成の乱数シード")
+    parser.add_argument('--database', default=None,
+                        help="負荷試験用データベース名 (デフォルト: <DB_NAME>_loadtest)。規模ごとに TRUNCATE される")
+    parser.add_argument('--log-file', default='/var/www/html/app/logs/load_harness_populate.log',
+                        help="計測対象の populate が書き出すログファイル")
+    parser.add_argument('--output-json', default=None, help="結果を書き出す JSON ファイルのパス")
+    # populate_products_and_categories_main_loop に渡すオプション
+    parser.add_argument('--bulk-size', type=int, default=0, help="populate の --bulk-size")
+    parser.add_argument('--link-flush-size', type=int, default=None, help="populate の --link-flush-size")
+    parser.add_argument('--page-size', type=int, default=None, help="populate の --page-size")
+    parser.add_argument('--commit-every', type=int, default=1, help="populate の --commit-every")
+    parser.add_argument('--commit-interval-ms', type=int, default=None, help="populate の --commit-interval-ms")
+    parser.add_argument('--workers', type=int, default=1, help="populate の --workers")
+    parser.add_argument('--lease', action='store_true', help="populate の --lease")
+    args = parser.parse_args()
+
+    source_database = DB_CONFIG['database']
+    load_test_database = args.database or f"{source_database}_loadtest"
+    # 計測は常にキューが空になるまで行う (drain=True)
+    loop_options = {
+        'bulk_size': args.bulk_size,
+        'drain': True,
+        'commit_every': args.commit_every,
+        'commit_interval_ms': args.commit_interval_ms,
+        'lease': args.lease,
+    }
+    if args.link_flush_size is not None:
+        loop_options['link_flush_size'] = args.link_flush_size
+    if args.page_size is not None:
+        loop_options['page_size'] = args.page_size
+
+    results = []
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        prepare_load_test_database(cursor, source_database, load_test_database)
+        for product_count in sorted(args.scales):
+            results.append(run_scale_point(conn, cursor, load_test_database, product_count, args, loop_options))
+    except (mysql.connector.Error, RuntimeError, ValueError) as err:
+        logger.error("負荷試験の実行中にエラーが発生しました: %s", err)
+        sys.exit(1)
+    finally:
+        if conn is not None:
+            if conn.is_connected():
+                cursor.close()
+            release_connection(conn)
+
+    print_report(results)
+    if args.output_json:
+        with open(args.output_json, 'w', encoding='utf-8') as f:
+            json.dump({
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'database': load_test_database,
+                'snapshots': args.snapshots,
+                'loop_options': loop_options,
+                'workers': args.workers,
+                'results': results,
+            }, f, ensure_ascii=False, indent=2)
+        logger.info("結果を書き出しました: %s", args.output_json)
@@ -0,0 +1,85 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+
+# ==============================================================================
+# ロギング設定ヘルパー
+# = ログの書き込みを QueueHandler / QueueListener でバックグラウンドスレッドに任せ、
+#   処理ループがコンソールやファイルへの I/O で待たされないようにする。
+#   ログレベルとローテーションの設定は環境変数で変更できる。
+#     LOG_LEVEL         : DEBUG / INFO / WARNING / ERROR (デフォルト: INFO)
+#     LOG_MAX_BYTES     : ログファイル1つあたりの最大サイズ (デフォルト: 50MB)
+#     LOG_BACKUP_COUNT  : ローテーションで残す世代数 (デフォルト: 5)
+# ==============================================================================
+
+DEFAULT_LOG_LEVEL = 'INFO'
+DEFAULT_LOG_MAX_BYTES = 50 * 1024 * 1024
+DEFAULT_LOG_BACKUP_COUNT = 5
+
+CONSOLE_FORMAT = '%(levelname)s: %(message)s'
+FILE_FORMAT = '%(asctime)s - %(levelname)s - %(message)s'
+
+# 開始済みで未停止の QueueListener
+_running_listeners = set()
+
+
+def log_level_from_env(env_name: str = 'LOG_LEVEL', default: str = DEFAULT_LOG_LEVEL) -> int:
+    """環境変数からログレベルを読み取る。不正な値の場合は default を使う。"""
+    level = logging.getLevelName(os.getenv(env_name, default).strip().upper())
+    if not isinstance(level, int):
+        level = logging.getLevelName(default)
+    return level
+
+
+def setup_queue_logging(logger, log_file_path: str, level=None, max_bytes=None, backup_count=None):
+    """
+    logger に QueueHandler を設定し、コンソールとサイズ上限付きのローテーションファイルへの書き込みを
+    QueueListener (バックグラウンドスレッド) で行う。開始した QueueListener を返す。
+    既存のハンドラは取り除くため、ログファイルを切り替える場合は再度呼び出せばよい。
+    level / max_bytes / backup_count を省略した場合は環境変数 (LOG_LEVEL など) の値を使う。
+    """
+    if level is None:
+        level = log_level_from_env()
+    if max_bytes is None:
+        max_bytes = int(os.getenv('LOG_MAX_BYTES', DEFAULT_LOG_MAX_BYTES))
+    if backup_count is None:
+        backup_count = int(os.getenv('LOG_BACKUP_COUNT', DEFAULT_LOG_BACKUP_COUNT))
+
+    for handler in logger.handlers[:]:
+        logger.removeHandler(handler)
+        handler.close()
+
+    console_handler = logging.StreamHandler(sys.stdout)
+    console_handler.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+
+    # ディレクトリが存在しない場合に作成
+    os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
+    file_handler = logging.handlers.RotatingFileHandler(
+        log_file_path, mode='a', maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8',
+    )
+    file_handler.setFormatter(logging.Formatter(FILE_FORMAT))
+
+    # キューは上限なし (put が処理ループを待たせることはない)
+    log_queue = queue.SimpleQueue()
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+
+    listener = logging.handlers.QueueListener(log_queue, console_handler, file_handler)
+    listener.start()
+    _running_listeners.add(listener)
+    # 終了時にキューに残ったログを書き出してからファイルを閉じる
+    atexit.register(stop_queue_logging, listener)
+    return listener
+
+
+def stop_queue_logging(listener):
+    """QueueListener を停止し、キューに残ったログを書き出してハンドラを閉じる。二重に呼んでもよい。"""
+    if listener not in _running_listeners:
+        return
+    _running_listeners.discard(listener)
+    listener.stop()
+    for handler in listener.handlers:
+        handler.close()
@@ -0,0 +1,162 @@
+import json
+import logging
+from datetime import datetime
+
+from db_bulk import bulk_insert_on_duplicate_update, chunked
+from json_codec import loads
+from raw_data import product_id_collation_key
+
+# ==============================================================================
+# 製品ごとの統合状態 (product_merge_state)
+# = 製品の統合は未処理 (processed_at IS NULL) の raw 行だけを読むため、そのままでは
+#   過去のスナップショットで収集したジャンル・女優・シリーズが新しいスナップショットの処理で失われる。
+#   ここでは (product_id, source_api) ごとに、これまでに処理した全スナップショットの
+#   カテゴリ集合と画像URL候補を product_merge_state に保存しておき、新しいスナップショットは
+#   保存済みの状態に畳み込む。処理済みの raw 行を読み直す必要がないため、1製品あたりのコストは
+#   クロール回数に依存せず、新しいデータの量だけで決まる。
+#
+#   状態がまだない既存の製品は products の genres_json / actresses_json / series_json / main_image_url から
+#   初期状態を作る。populate_products_and_categories.py (1製品ずつ / バルク)、pipelined_populate.py、
+#   load_data_backfill.py はいずれも raw 行を処理済みにするのと同じトランザクションで状態を保存する。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+MERGE_STATE_TABLE = 'product_merge_state'
+# 保存する画像URL候補の最大数 (新しいスナップショットの候補が優先され、先頭がメイン画像になる)
+MAX_IMAGE_CANDIDATES = 8
+# 1クエリで IN (...) に渡す product_id の最大数
+STATE_LOAD_CHUNK_SIZE = 500
+
+MERGE_STATE_COLUMNS = (
+    'product_id', 'source_api', 'genres_json', 'actresses_json', 'series_json', 'image_candidates_json',
+    'last_raw_api_data_id', 'snapshots_merged', 'updated_at',
+)
+MERGE_STATE_UPDATE_COLUMNS = MERGE_STATE_COLUMNS[2:]
+
+CREATE_MERGE_STATE_TABLE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS `{MERGE_STATE_TABLE}` (
+        `product_id` VARCHAR(255) NOT NULL COMMENT 'API側のプロダクトID (raw_api_data.product_id)',
+        `source_api` VARCHAR(50) NOT NULL COMMENT 'データの取得元API',
+        `genres_json` JSON NULL COMMENT 'これまでに処理した全スナップショットのジャンル名 (JSON配列)',
+        `actresses_json` JSON NULL COMMENT 'これまでに処理した全スナップショットの女優名 (JSON配列)',
+        `series_json` JSON NULL COMMENT 'これまでに処理した全スナップショットのシリーズ名 (JSON配列)',
+        `image_candidates_json` JSON NULL COMMENT '画像URL候補 (新しいスナップショット順、JSON配列)',
+        `last_raw_api_data_id` INT NULL COMMENT '最後に畳み込んだスナップショットのメイン行 (raw_api_data.id)',
+        `snapshots_merged` INT NOT NULL DEFAULT 0 COMMENT '畳み込んだ raw_api_data の行数',
+        `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+        PRIMARY KEY (`product_id`, `source_api`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='製品ごとのカテゴリ集合と画像URL候補の統合状態'
+"""
+
+
+class ProductMergeState:
+    """1製品 ((product_id, source_api)) 分の統合状態。"""
+
+    __slots__ = ('product_id', 'source_api', 'genres', 'actresses', 'series_names', 'image_candidates',
+                 'last_raw_api_data_id', 'snapshots_merged')
+
+    def __init__(self, product_id: str, source_api: str, genres=(), actresses=(), series_names=(), image_candidates=(),
+                 last_raw_api_data_id=None, snapshots_merged: int = 0):
+        self.product_id = product_id
+        self.source_api = source_api
+        self.genres = set(genres)
+        self.actresses = set(actresses)
+        self.series_names = set(series_names)
+        self.image_candidates = list(image_candidates)[:MAX_IMAGE_CANDIDATES]
+        self.last_raw_api_data_id = last_raw_api_data_id
+        self.snapshots_merged = snapshots_merged
+
+    def row_values(self, now) -> tuple:
+        """MERGE_STATE_COLUMNS 順のタプルを返す (集合はソートして保存する)。"""
+        return (
+            self.product_id, self.source_api,
+            _dump_json_list(sorted(self.genres)), _dump_json_list(sorted(self.actresses)), _dump_json_list(sorted(self.series_names)),
+            _dump_json_list(self.image_candidates),
+            self.last_raw_api_data_id, self.snapshots_merged, now,
+        )
+
+
+def _dump_json_list(values):
+    return json.dumps(values, ensure_ascii=False) if values else None
+
+
+def _load_json_list(value) -> list:
+    if value is None:
+        return []
+    decoded = loads(value)
+    return decoded if isinstance(decoded, list) else [decoded]
+
+
+def ensure_merge_state_table_exists(cursor, conn, database_name: str):
+    """product_merge_state テーブルが存在することを確認し、なければ作成する。"""
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+        (database_name, MERGE_STATE_TABLE),
+    )
+    if cursor.fetchone() is None:
+        logger.info("%s テーブルを作成します...", MERGE_STATE_TABLE)
+        cursor.execute(CREATE_MERGE_STATE_TABLE_SQL)
+        conn.commit()
+        logger.info("%s テーブルが正常に作成されました。", MERGE_STATE_TABLE)
+
+
+def load_merge_states(cursor, product_keys, chunk_size: int = STATE_LOAD_CHUNK_SIZE) -> dict:
+    """
+    (product_id, source_api) のリストに対応する統合状態を {(product_id, source_api): ProductMergeState} で返す。
+    状態がなく products に同じ source_api の製品がある場合は、products の *_json と main_image_url から初期状態を作る。
+    どちらにもない (新規の) 製品は辞書に含まれない。
+    照合順序が大文字小文字を区別しないため、返った行は load_unprocessed_raw_rows_for_keys と同じく要求したキーの側にまとめる。
+    """
+    product_ids_by_source = {}
+    for product_api_id, source_api_name in product_keys:
+        product_ids_by_source.setdefault(source_api_name, []).append(product_api_id)
+
+    states = {}
+    for source_api_name, product_ids in product_ids_by_source.items():
+        for chunk in chunked(list(dict.fromkeys(product_ids)), chunk_size):
+            requested_ids = {}
+            for product_api_id in chunk:
+                requested_ids.setdefault(product_id_collation_key(product_api_id), product_api_id)
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"""
+                SELECT product_id, genres_json, actresses_json, series_json, image_candidates_json, last_raw_api_data_id, snapshots_merged
+                FROM `{MERGE_STATE_TABLE}`
+                WHERE source_api = %s AND product_id IN ({placeholders})
+            """, [source_api_name] + chunk)
+            for product_api_id, genres_json, actresses_json, series_json, image_candidates_json, last_raw_api_data_id, snapshots_merged in cursor.fetchall():
+                product_api_id = requested_ids.get(product_id_collation_key(product_api_id), product_api_id)
+                states[(product_api_id, source_api_name)] = ProductMergeState(
+                    product_api_id, source_api_name,
+                    _load_json_list(genres_json), _load_json_list(actresses_json), _load_json_list(series_json),
+                    _load_json_list(image_candidates_json), last_raw_api_data_id, snapshots_merged,
+                )
+
+            # 状態のない既存製品は products の統合結果を初期状態にする
+            missing_product_ids = [product_api_id for product_api_id in chunk if (product_api_id, source_api_name) not in states]
+            if not missing_product_ids:
+                continue
+            placeholders = ", ".join(["%s"] * len(missing_product_ids))
+            cursor.execute(f"""
+                SELECT product_id, genres_json, actresses_json, series_json, main_image_url, raw_api_data_id
+                FROM products
+                WHERE source_api = %s AND product_id IN ({placeholders})
+            """, [source_api_name] + missing_product_ids)
+            for product_api_id, genres_json, actresses_json, series_json, main_image_url, raw_api_data_id in cursor.fetchall():
+                product_api_id = requested_ids.get(product_id_collation_key(product_api_id), product_api_id)
+                states[(product_api_id, source_api_name)] = ProductMergeState(
+                    product_api_id, source_api_name,
+                    _load_json_list(genres_json), _load_json_list(actresses_json), _load_json_list(series_json),
+                    [main_image_url] if main_image_url else [], raw_api_data_id,
+                )
+    return states
+
+
+def save_merge_states(cursor, states) -> int:
+    """統合状態をまとめて UPSERT する。トランザクション管理は呼び出し元で行う。"""
+    now = datetime.now()
+    return bulk_insert_on_duplicate_update(
+        cursor, MERGE_STATE_TABLE, MERGE_STATE_COLUMNS,
+        [state.row_values(now) for state in states],
+        MERGE_STATE_UPDATE_COLUMNS,
+    )
@@ -0,0 +1,255 @@
+import argparse
+import json
+import logging
+import sys
+import time
+from datetime import datetime, timedelta
+
+import mysql.connector
+
+from db_connection import DB_CONFIG, get_connection, release_connection
+from raw_data import BACKLOG_AGE_INDEX_NAME, ensure_backlog_age_index_exists
+
+# ==============================================================================
+# パイプラインの稼働状況
+# = raw_api_data / products の件数と、未処理キューの滞留 (バックログ)・取り込みの遅れ・直近のスループットを
+#   大きなテーブルでも1秒以内に表示する。全件の COUNT(*) や、インデックスのない ORDER BY は使わない。
+#     - テーブルの行数        : INFORMATION_SCHEMA.TABLES の推定値 (information_schema_stats_expiry = 0 で最新の統計を読む)
+#     - バックログ            : processed_at IS NULL の行を backlog_exact_limit 件まで数え、超える場合はオプティマイザの推定値
+#     - 取り込みの遅れ        : 未処理で最も古い fetched_at (idx_raw_processed_fetched の先頭1件)
+#     - 処理のスループット    : 直近 window_minutes 分に processed_at が設定された行数 (processed_at のインデックスの範囲スキャン)
+#     - 取り込みのスループット: 直近 window_minutes 分に取得された行数。id と fetched_at がほぼ同じ順に増えることを前提に、
+#                               主キーの二分探索で期間の先頭の id を求めて推定する
+#
+#   使い方:
+#     python app/cli/pipeline_status.py
+#     python app/cli/pipeline_status.py --json --window-minutes 60
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+STATUS_TABLES = ('raw_api_data', 'products', 'categories', 'product_categories')
+DEFAULT_WINDOW_MINUTES = 15
+DEFAULT_BACKLOG_EXACT_LIMIT = 100000
+
+
+def fetch_table_row_estimates(cursor, database_name: str) -> dict:
+    """INFORMATION_SCHEMA.TABLES から {テーブル名: 推定行数} を返す (InnoDB の統計に基づく概算値)。"""
+    # MySQL 8.0 は INFORMATION_SCHEMA の統計を既定で24時間キャッシュするため、このセッションだけ無効にする
+    try:
+        cursor.execute("SET SESSION information_schema_stats_expiry = 0")
+    except mysql.connector.Error as err:
+        logger.debug("information_schema_stats_expiry を設定できませんでした (MySQL 5.7 以前): %s", err)
+    placeholders = ", ".join(["%s"] * len(STATUS_TABLES))
+    cursor.execute(
+        f"SELECT TABLE_NAME, TABLE_ROWS FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME IN ({placeholders})",
+        (database_name,) + STATUS_TABLES,
+    )
+    return {table_name: table_rows for table_name, table_rows in cursor.fetchall()}
+
+
+def fetch_backlog_size(cursor, exact_limit: int = DEFAULT_BACKLOG_EXACT_LIMIT) -> dict:
+    """
+    未処理の raw_api_data の行数を返す。exact_limit 件までは正確に数え、
+    それを超える場合は EXPLAIN の推定行数を返す (is_estimate=True)。
+    """
+    cursor.execute(
+        "SELECT COUNT(*) FROM (SELECT 1 FROM raw_api_data WHERE processed_at IS NULL LIMIT %s) AS backlog",
+        (exact_limit + 1,),
+    )
+    count = cursor.fetchone()[0]
+    if count <= exact_limit:
+        return {'rows': count, 'is_estimate': False}
+
+    cursor.execute("EXPLAIN SELECT id FROM raw_api_data WHERE processed_at IS NULL")
+    columns = [description[0] for description in cursor.description]
+    plan_rows = cursor.fetchall()
+    estimate = max((row[columns.index('rows')] or 0 for row in plan_rows), default=0)
+    return {'rows': max(int(estimate), count), 'is_estimate': True}
+
+
+def backlog_age_index_exists(cursor, database_name: str) -> bool:
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'raw_api_data' AND INDEX_NAME = %s LIMIT 1",
+        (database_name, BACKLOG_AGE_INDEX_NAME),
+    )
+    return cursor.fetchone() is not None
+
+
+def fetch_oldest_unprocessed_fetched_at(cursor):
+    """未処理の raw_api_data のうち最も古い fetched_at を返す (未処理がなければ None)。"""
+    cursor.execute(
+        f"SELECT MIN(fetched_at) FROM raw_api_data FORCE INDEX (`{BACKLOG_AGE_INDEX_NAME}`) WHERE processed_at IS NULL"
+    )
+    return cursor.fetchone()[0]
+
+
+def fetch_processed_since(cursor, since) -> int:
+    """since 以降に processed_at が設定された raw_api_data の行数を返す。"""
+    cursor.execute("SELECT COUNT(*) FROM raw_api_data WHERE processed_at >= %s", (since,))
+    return cursor.fetchone()[0]
+
+
+def estimate_fetched_since(cursor, since) -> int:
+    """
+    since 以降に取得された raw_api_data の行数を推定する。
+    id と fetched_at がほぼ同じ順に増えることを前提に、fetched_at >= since となる最小の id を
+    主キーの二分探索 (1回あたり主キーの1行参照) で求め、MAX(id) との差を返す。
+    """
+    cursor.execute("SELECT MIN(id), MAX(id) FROM raw_api_data")
+    min_id, max_id = cursor.fetchone()
+    if max_id is None:
+        return 0
+    low, high = min_id, max_id + 1
+    while low < high:
+        middle = (low + high) // 2
+        # 削除済みの id を飛ばすため、middle 以上で最初の行の fetched_at を見る
+        cursor.execute("SELECT id, fetched_at FROM raw_api_data WHERE id >= %s ORDER BY id LIMIT 1", (middle,))
+        row = cursor.fetchone()
+        if row is None or (row[1] is not None and row[1] >= since):
+            high = middle
+        else:
+            low = row[0] + 1
+    return max(0, max_id - low + 1)
+
+
+def collect_pipeline_status(cursor, database_name: str, window_minutes: int = DEFAULT_WINDOW_MINUTES,
+                            backlog_exact_limit: int = DEFAULT_BACKLOG_EXACT_LIMIT) -> dict:
+    """稼働状況をまとめた辞書を返す。"""
+    started = time.monotonic()
+    now = datetime.now()
+    since = now - timedelta(minutes=window_minutes)
+    status = {'checked_at': now, 'database': database_name, 'window_minutes': window_minutes}
+
+    status['table_rows_estimate'] = fetch_table_row_estimates(cursor, database_name)
+    status['backlog'] = fetch_backlog_size(cursor, backlog_exact_limit)
+
+    if backlog_age_index_exists(cursor, database_name):
+        oldest_fetched_at = fetch_oldest_unprocessed_fetched_at(cursor)
+        status['oldest_unprocessed_fetched_at'] = oldest_fetched_at
+        status['ingest_lag_seconds'] = (now - oldest_fetched_at).total_seconds() if oldest_fetched_at else 0.0
+    else:
+        # インデックスがない場合は未処理キュー全体を走査することになるため求めない
+        status['oldest_unprocessed_fetched_at'] = None
+        status['ingest_lag_seconds'] = None
+        status['warnings'] = [f"{BACKLOG_AGE_INDEX_NAME} がないため取り込みの遅れは表示しません (--ensure-indexes で作成できます)。"]
+
+    processed_rows = fetch_processed_since(cursor, since)
+    fetched_rows = estimate_fetched_since(cursor, since)
+    status['throughput'] = {
+        'processed_rows': processed_rows,
+        'processed_rows_per_minute': processed_rows / window_minutes,
+        'fetched_rows_estimate': fetched_rows,
+        'fetched_rows_per_minute_estimate': fetched_rows / window_minutes,
+    }
+
+    # 最新の数件は主キーの降順で取得する (updated_at にはインデックスがないため使わない)
+    cursor.execute("SELECT id, source_api, product_id, fetched_at, processed_at FROM raw_api_data ORDER BY id DESC LIMIT 5")
+    status['latest_raw_api_data'] = cursor.fetchall()
+    cursor.execute("SELECT id, product_id, title, source_api, updated_at FROM products ORDER BY id DESC LIMIT 5")
+    status['latest_products'] = cursor.fetchall()
+
+    status['elapsed_seconds'] = time.monotonic() - started
+    return status
+
+
+def format_duration(seconds) -> str:
+    if seconds is None:
+        return "不明"
+    seconds = int(seconds)
+    hours, remainder = divmod(seconds, 3600)
+    minutes, seconds = divmod(remainder, 60)
+    return f"{hours}時間{minutes:02d}分{seconds:02d}秒"
+
+
+def print_status(status: dict):
+    """稼働状況を人が読める形式で標準出力に表示する。"""
+    print(f"データベース: {status['database']} ({status['checked_at']:%Y-%m-%d %H:%M:%S} 時点)")
+    print("\nテーブルの行数 (推定値):")
+    for table_name in STATUS_TABLES:
+        table_rows = status['table_rows_estimate'].get(table_name)
+        table_rows_label = f"{table_rows:,}" if table_rows is not None else "(テーブルなし)"
+        print(f"  {table_name:<20} {table_rows_label:>14}")
+
+    backlog = status['backlog']
+    backlog_label = "約 " if backlog['is_estimate'] else ""
+    print(f"\n未処理の raw_api_data (バックログ): {backlog_label}{backlog['rows']:,} 行")
+    oldest = status['oldest_unprocessed_fetched_at']
+    if oldest is not None:
+        print(f"取り込みの遅れ: {format_duration(status['ingest_lag_seconds'])} (最古の未処理 fetched_at: {oldest})")
+    elif status['ingest_lag_seconds'] == 0.0:
+        print("取り込みの遅れ: なし (未処理の行はありません)")
+    else:
+        print("取り込みの遅れ: 不明")
+
+    throughput = status['throughput']
+    print(f"\n直近 {status['window_minutes']} 分のスループット:")
+    print(f"  処理済みにした raw 行: {throughput['processed_rows']:,} 行 ({throughput['processed_rows_per_minute']:,.1f} 行/分)")
+    print(f"  取得した raw 行 (推定): {throughput['fetched_rows_estimate']:,} 行 ({throughput['fetched_rows_per_minute_estimate']:,.1f} 行/分)")
+
+    print("\nraw_api_data の最新の5件:")
+    for raw_id, source_api, product_id, fetched_at, processed_at in status['latest_raw_api_data']:
+        print(f"  ID: {raw_id}, source_api: {source_api}, product_id: {product_id}, fetched_at: {fetched_at}, processed_at: {processed_at}")
+    print("\nproducts の最新の5件:")
+    for product_db_id, product_id, title, source_api, updated_at in status['latest_products']:
+        print(f"  ID: {product_db_id}, product_id: {product_id}, Title: {title}, Source API: {source_api}, updated_at: {updated_at}")
+
+    for warning in status.get('warnings', []):
+        print(f"\n警告: {warning}")
+    print(f"\n(所要時間: {status['elapsed_seconds'] * 1000:.0f} ms)")
+
+
+def check_pipeline_status(window_minutes: int = DEFAULT_WINDOW_MINUTES, backlog_exact_limit: int = DEFAULT_BACKLOG_EXACT_LIMIT,
+                          as_json: bool = False, ensure_indexes: bool = False) -> int:
+    """稼働状況を表示し、終了コード (0: 正常, 1: エラー) を返す。"""
+    conn = None
+    cursor = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        if ensure_indexes:
+            ensure_backlog_age_index_exists(cursor, conn, DB_CONFIG['database'])
+        status = collect_pipeline_status(cursor, DB_CONFIG['database'], window_minutes, backlog_exact_limit)
+        if as_json:
+            print(json.dumps(status, ensure_ascii=False, indent=2, default=str))
+        else:
+            print_status(status)
+        return 0
+    except mysql.connector.Error as err:
+        print(f"MySQL接続エラー: {err}", file=sys.stderr)
+        return 1
+    finally:
+        if cursor is not None:
+            cursor.close()
+        release_connection(conn)
+
+
+def build_argument_parser() -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="raw_api_data / products の件数と、未処理キューの滞留・取り込みの遅れ・スループットを表示します。")
+    parser.add_argument('--window-minutes', type=int, default=DEFAULT_WINDOW_MINUTES,
+                        help="スループットを集計する直近の期間 (分)")
+    parser.add_argument('--backlog-exact-limit', type=int, default=DEFAULT_BACKLOG_EXACT_LIMIT,
+                        help="バックログをこの行数までは正確に数え、超える場合は推定値を表示する")
+    parser.add_argument('--json', action='store_true',
+                        help="JSON で出力する (監視スクリプトからの利用向け)")
+    parser.add_argument('--ensure-indexes', action='store_true',
+                        help=f"取り込みの遅れを求める {BACKLOG_AGE_INDEX_NAME} インデックスがなければ作成する (ALTER TABLE を実行する)")
+    return parser
+
+
+def main(argv=None) -> int:
+    args = build_argument_parser().parse_args(argv)
+    return check_pipeline_status(
+        window_minutes=max(1, args.window_minutes),
+        backlog_exact_limit=max(0, args.backlog_exact_limit),
+        as_json=args.json,
+        ensure_indexes=args.ensure_indexes,
+    )
+
+
+# ==============================================================================
+# メイン処理
+# ==============================================================================
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,318 @@
+import argparse
+import asyncio
+import logging
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import mysql.connector
+
+import populate_products_and_categories as populate
+from association_buffer import DEFAULT_FLUSH_SIZE as DEFAULT_LINK_FLUSH_SIZE, DEFAULT_LINK_MODE, LINK_MODES, create_link_writer
+from category_cache import CategoryResolver
+from db_bulk import chunked
+from db_connection import get_connection, release_connection
+from log_setup import setup_queue_logging
+from merge_state import load_merge_states
+from raw_data import DEFAULT_PAGE_SIZE, RawProcessedMarker, iter_unprocessed_key_pages, load_unprocessed_raw_rows_for_keys
+from run_metrics import RunMetrics
+
+# ==============================================================================
+# パイプライン実行 (読み込み・統合・書き込みの並行処理)
+# = 通常のメインループは「raw 行の取得 → JSON デコードと統合 → 書き込み → コミット」を順番に行うため、
+#   統合 (CPU) の間は DB が、DB 待ちの間は CPU が遊んでいる。
+#   ここでは asyncio で3つのステージを並行に動かし、上限付きのキューでつなぐ。
+#     - reader : 未処理キューをキーセットページングで辿り、次のバッチの raw 行と統合状態を先読みする (専用の接続)
+#     - merge  : merge_product_keys で JSON デコードと統合を行う (DB にはアクセスしない)
+#     - writer : write_merged_products で書き込み、紐付けと processed_at を反映してバッチ単位でコミットする (専用の接続)
+#   mysql.connector は同期ドライバのため、各ステージのブロッキング処理はステージ専用のスレッド (1スレッド) で実行する。
+#   DB の待ち時間中は GIL が解放されるため、統合の CPU 処理と読み込み・書き込みの待ち時間が重なる。
+#   キューが満杯になると前段のステージは待機するため (バックプレッシャー)、メモリ上の raw 行は
+#   最大で (queue_depth × 2 + 3) バッチ分に収まる。
+#
+#   書き込み内容はバルクモード (--bulk-size) と同じ:
+#     - content_hash が既存の製品と一致する製品は書き込まない
+#     - スキップした製品の raw 行も処理済みにする
+#     - 統合で例外が発生した製品はエラーとして記録し、その raw 行だけを未処理のまま残して処理を続ける
+#     - 書き込みに失敗したバッチはロールバックし、raw_api_data は未処理のまま残る (次回の実行で再試行される)
+#
+#   使い方:
+#     python app/cli/pipelined_populate.py --batch-size 500 --queue-depth 4
+#     python app/cli/pipelined_populate.py --time-budget 3000 --metrics-json /tmp/pipelined.json
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+log_file_path = '/var/www/html/app/logs/pipelined_populate.log'
+
+METRICS_JOB_NAME = 'pipelined_populate'
+DEFAULT_BATCH_SIZE = 500
+DEFAULT_QUEUE_DEPTH = 4
+
+# キューの終端を表す番兵
+END_OF_STREAM = None
+
+
+class PipelineStage:
+    """
+    1ステージ分のブロッキング処理を専用スレッドで実行する。
+    mysql.connector の接続はスレッドセーフではないため、接続を使うステージは常に同じスレッドから使う。
+    """
+
+    def __init__(self, name: str):
+        self.name = name
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f"pipeline-{name}")
+
+    async def run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True)
+
+
+class PipelineReader:
+    """reader ステージ: 未処理キューのキーを辿り、batch_size 件ずつ raw 行と統合状態 (product_merge_state) を取得する。"""
+
+    def __init__(self, conn, page_size: int, batch_size: int, time_budget_seconds=None, metrics=None):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.batch_size = batch_size
+        self.metrics = metrics
+        self.key_pages = iter_unprocessed_key_pages(self.cursor, page_size, time_budget_seconds)
+        self.pending_batches = iter(())
+
+    def read_next_batch(self):
+        """次のバッチの (product_keys, raw_rows_by_key, merge_states) を返す。キューの末尾に達した場合は END_OF_STREAM を返す。"""
+        product_keys = next(self.pending_batches, None)
+        if product_keys is None:
+            with self.metrics.stage('key_scan'):
+                key_page = next(self.key_pages, None)
+            if key_page is None:
+                return END_OF_STREAM
+            self.metrics.incr('pages')
+            self.pending_batches = iter(list(chunked(key_page, self.batch_size)))
+            product_keys = next(self.pending_batches)
+        with self.metrics.stage('raw_fetch'):
+            raw_rows_by_key = load_unprocessed_raw_rows_for_keys(self.cursor, product_keys)
+        with self.metrics.stage('state_load'):
+            # 同じ実行内でキーが重複することはないため、先読みした状態が writer の書き込みで古くなることはない
+            merge_states = load_merge_states(self.cursor, product_keys)
+            # 読み取り専用のトランザクションをバッチごとに終了し、古い読み取りビューを保持し続けないようにする
+            self.conn.commit()
+        return product_keys, raw_rows_by_key, merge_states
+
+    def close(self):
+        self.cursor.close()
+
+
+class PipelineWriter:
+    """writer ステージ: 統合済みのバッチを書き込み、バッチ単位でコミットする。"""
+
+    def __init__(self, conn, link_flush_size: int = DEFAULT_LINK_FLUSH_SIZE, link_mode: str = DEFAULT_LINK_MODE, metrics=None, errors=None):
+        self.conn = conn
+        self.cursor = conn.cursor()
+        self.metrics = metrics
+        self.errors = errors if errors is not None else []
+        self.category_resolver = CategoryResolver()
+        self.link_buffer = create_link_writer(link_mode, link_flush_size)
+        self.processed_marker = RawProcessedMarker()
+
+    def prepare(self):
+        """必要なカラム・インデックスを確認し、categories をメモリに読み込む。"""
+        populate.ensure_schema_for_run(self.cursor, self.conn, bulk_size=1, drain=True)
+        self.category_resolver.preload(self.cursor)
+
+    def write_batch(self, product_keys, merged_products, raw_ids) -> int:
+        """1バッチを書き込んでコミットし、処理した製品数を返す。失敗した場合はロールバックして 0 を返す。"""
+        metrics = self.metrics
+        try:
+            self.processed_marker.add(raw_ids)
+            populate.write_merged_products(self.cursor, self.conn, merged_products, self.category_resolver, self.link_buffer, metrics)
+            with metrics.stage('link_flush'):
+                self.link_buffer.flush(self.cursor)
+            with metrics.stage('mark_processed'):
+                self.processed_marker.flush(self.cursor)
+            with metrics.stage('commit'):
+                self.conn.commit()
+            self.category_resolver.on_commit()
+            self.link_buffer.reset()
+            logger.info("%s 件の製品IDの書き込みとコミットが完了しました。", len(product_keys))
+            return len(merged_products)
+        except Exception as e:
+            logger.error("バッチの書き込み中にエラーが発生しました (先頭の製品ID: %s): %s", product_keys[0][0], e)
+            self.errors.append(f"バッチの書き込み (先頭の製品ID: {product_keys[0][0]}): {e}")
+            metrics.incr('batches_failed')
+            if self.conn.is_connected():
+                self.conn.rollback()
+                logger.warning("トランザクションをロールバックしました。")
+            self.category_resolver.on_rollback()
+            self.link_buffer.discard()
+            self.processed_marker.discard()
+            # このバッチの raw_api_data は processed_at が更新されないため、次回の実行で再度試行される
+            return 0
+
+    def close(self):
+        self.cursor.close()
+
+
+async def read_stage(reader: PipelineReader, stage: PipelineStage, raw_queue: asyncio.Queue):
+    try:
+        while True:
+            batch = await stage.run(reader.read_next_batch)
+            # キューが満杯の場合は merge ステージが追いつくまでここで待つ
+            await raw_queue.put(batch)
+            if batch is END_OF_STREAM:
+                return
+    except Exception:
+        # 読み込み済みのバッチは後段で最後まで処理させる
+        await raw_queue.put(END_OF_STREAM)
+        raise
+
+
+async def merge_stage(stage: PipelineStage, raw_queue: asyncio.Queue, merged_queue: asyncio.Queue, metrics, errors: list):
+    try:
+        while True:
+            batch = await raw_queue.get()
+            if batch is END_OF_STREAM:
+                await merged_queue.put(END_OF_STREAM)
+                return
+            product_keys, raw_rows_by_key, merge_states = batch
+            # 統合に失敗した製品は errors に記録してバッチから除き (raw 行は未処理のまま残る)、パイプラインは止めない
+            merged_products, raw_ids = await stage.run(
+                populate.merge_product_keys, product_keys, raw_rows_by_key, metrics, merge_states, errors,
+            )
+            await merged_queue.put((product_keys, merged_products, raw_ids))
+    except Exception:
+        await merged_queue.put(END_OF_STREAM)
+        raise
+
+
+async def write_stage(writer: PipelineWriter, stage: PipelineStage, merged_queue: asyncio.Queue, summary: dict):
+    while True:
+        batch = await merged_queue.get()
+        if batch is END_OF_STREAM:
+            return
+        product_keys, merged_products, raw_ids = batch
+        products_processed = await stage.run(writer.write_batch, product_keys, merged_products, raw_ids)
+        writer.metrics.incr('products_processed', products_processed)
+        summary['products_processed'] += products_processed
+        summary['batches'] += 1
+
+
+async def run_stages(reader: PipelineReader, writer: PipelineWriter, queue_depth: int, summary: dict, metrics):
+    """
+    3つのステージを並行に実行する。いずれかのステージで例外が発生した場合は、
+    それより前段のステージを止め、後段のステージにはキューに残ったバッチを処理させてから例外を再送出する。
+    """
+    raw_queue = asyncio.Queue(maxsize=queue_depth)
+    merged_queue = asyncio.Queue(maxsize=queue_depth)
+    stages = [PipelineStage('reader'), PipelineStage('merge'), PipelineStage('writer')]
+    tasks = [
+        asyncio.ensure_future(read_stage(reader, stages[0], raw_queue)),
+        asyncio.ensure_future(merge_stage(stages[1], raw_queue, merged_queue, metrics, summary['errors'])),
+        asyncio.ensure_future(write_stage(writer, stages[2], merged_queue, summary)),
+    ]
+    try:
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        failed_index = next(
+            (index for index, task in enumerate(tasks) if task.done() and not task.cancelled() and task.exception() is not None),
+            None,
+        )
+        if failed_index is not None:
+            for task in tasks[:failed_index]:
+                task.cancel()
+        await asyncio.wait(tasks)
+        if failed_index is not None:
+            raise tasks[failed_index].exception()
+    finally:
+        # 実行中のブロッキング処理 (SQL など) の完了を待ってから接続を返却する
+        for stage in stages:
+            stage.shutdown()
+
+
+def run_pipelined_populate(page_size: int = DEFAULT_PAGE_SIZE, batch_size: int = DEFAULT_BATCH_SIZE,
+                           queue_depth: int = DEFAULT_QUEUE_DEPTH, time_budget_seconds=None,
+                           link_flush_size: int = DEFAULT_LINK_FLUSH_SIZE, link_mode: str = DEFAULT_LINK_MODE, metrics=None) -> dict:
+    """
+    未処理キューを最後まで (または time_budget_seconds に達するまで) パイプライン実行で処理する。
+    reader と writer はそれぞれ共通プールから専用の接続を借りる。
+    処理件数・バッチ数・エラーメッセージと、ステージ別の所要時間 (RunMetrics.to_dict()) をまとめた辞書を返す。
+    """
+    if metrics is None:
+        metrics = RunMetrics(METRICS_JOB_NAME)
+    summary = {'products_processed': 0, 'batches': 0, 'errors': []}
+    reader_conn = None
+    writer_conn = None
+    reader = None
+    writer = None
+    try:
+        writer_conn = get_connection()
+        writer = PipelineWriter(writer_conn, link_flush_size, link_mode, metrics, summary['errors'])
+        writer.prepare()
+        reader_conn = get_connection()
+        reader = PipelineReader(reader_conn, page_size, batch_size, time_budget_seconds, metrics)
+
+        logger.info("パイプライン実行を開始します (バッチサイズ: %s, キューの深さ: %s)。", batch_size, queue_depth)
+        asyncio.run(run_stages(reader, writer, queue_depth, summary, metrics))
+
+        logger.info("パイプライン実行が完了しました。総計 %s 件の製品を %s バッチで処理しました。", summary['products_processed'], summary['batches'])
+        logger.info("product_categories 書き込み統計: %s", writer.link_buffer.stats())
+
+    except mysql.connector.Error as err:
+        logger.error("MySQL接続またはクエリ実行エラー: %s", err)
+        summary['errors'].append(f"MySQL接続またはクエリ実行エラー: {err}")
+    except Exception as e:
+        logger.error("予期せぬエラーが発生しました: %s", e)
+        summary['errors'].append(f"予期せぬエラー: {e}")
+    finally:
+        for stage_object, conn in ((reader, reader_conn), (writer, writer_conn)):
+            if conn is None:
+                continue
+            if stage_object is not None and conn.is_connected():
+                stage_object.close()
+            # 未完了のトランザクションは release_connection がロールバックする
+            release_connection(conn)
+        metrics.finish()
+        metrics.log_summary(logger)
+        summary['metrics'] = metrics.to_dict()
+    return summary
+
+# ==============================================================================
+# メイン処理
+# ==============================================================================
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="raw_api_data の読み込み・統合・書き込みを並行に実行して products / categories を生成します。")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help="未処理キューの1ページで取得するユニークな製品IDの数")
+    parser.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE,
+                        help="ステージ間で受け渡し、1回のバルクUPSERTとコミットで書き込む製品数")
+    parser.add_argument('--queue-depth', type=int, default=DEFAULT_QUEUE_DEPTH,
+                        help="ステージ間のキューに保持する最大バッチ数 (メモリ使用量の上限)")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="処理時間の上限 (秒)。超えると次のページを取得せずに終了する")
+    parser.add_argument('--link-flush-size', type=int, default=DEFAULT_LINK_FLUSH_SIZE,
+                        help="product_categories への INSERT / DELETE 1回あたりの最大行数")
+    parser.add_argument('--link-mode', choices=LINK_MODES, default=DEFAULT_LINK_MODE,
+                        help="product_categories の書き込み方法 (append: INSERT IGNORE で追加のみ, sync: 現在の紐付けとの差分を追加・削除。"
+                             "他の経路で追加した紐付けも削除される)")
+    parser.add_argument('--metrics-json', default=None,
+                        help="実行終了時にステージ別の所要時間とカウンタを JSON で書き出すファイルパス")
+    parser.add_argument('--metrics-prom', default=None,
+                        help="実行終了時にメトリクスを Prometheus textfile collector 形式 (.prom) で書き出すファイルパス")
+    args = parser.parse_args()
+
+    setup_queue_logging(logger, log_file_path)
+    run_metrics = RunMetrics(METRICS_JOB_NAME)
+    summary = run_pipelined_populate(
+        page_size=args.page_size,
+        batch_size=max(1, args.batch_size),
+        queue_depth=max(1, args.queue_depth),
+        time_budget_seconds=args.time_budget,
+        link_flush_size=args.link_flush_size,
+        link_mode=args.link_mode,
+        metrics=run_metrics,
+    )
+    if args.metrics_json:
+        run_metrics.write_json(args.metrics_json)
+    if args.metrics_prom:
+        run_metrics.write_prometheus_textfile(args.metrics_prom)
+    sys.exit(1 if summary['errors'] else 0)
@@ -2,67 +2,53 @@ import os
 import mysql.connector
 import json
 from datetime import datetime
-import sys
+import argparse
 import logging # loggingモジュールを追加
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from association_buffer import DEFAULT_FLUSH_SIZE as DEFAULT_LINK_FLUSH_SIZE, DEFAULT_LINK_MODE, LINK_MODES, create_link_writer
+from category_cache import CategoryResolver
+from db_connection import DB_CONFIG, get_connection, release_connection
+from field_map import FieldSpec, compile_field_map
+from db_bulk import bulk_insert_on_duplicate_update, chunked, fetch_id_map
+from group_commit import GroupCommitter
+from log_setup import setup_queue_logging, stop_queue_logging
+from run_metrics import NULL_METRICS, RunMetrics
+from json_codec import decode_raw_rows
+from merge_state import MAX_IMAGE_CANDIDATES, ProductMergeState, ensure_merge_state_table_exists, load_merge_states, save_merge_states
+from product_hash import compute_product_content_hash, ensure_content_hash_column_exists, fetch_product_hashes
+from raw_data import (
+    DEFAULT_PAGE_SIZE, RawProcessedMarker, ensure_work_queue_index_exists, iter_unprocessed_key_pages,
+    load_unprocessed_raw_rows_for_keys, mark_raw_rows_processed, resolve_requested_product_ids, shard_condition,
+)
+from work_lease import (
+    DEFAULT_LEASE_SECONDS, LeaseHeartbeat, ensure_work_lease_table_exists, iter_leased_key_pages, make_lease_owner,
+    purge_stale_leases,
+)
+
+# Dotenvライブラリを使って.envファイルをロード (LOG_LEVEL などのロギング設定も .env から読むため先に行う)
+from dotenv import load_dotenv
+load_dotenv()
 
 # ==============================================================================
 # ロギング設定
 # ==============================================================================
 # ロガーを初期化
+# ログレベルは環境変数 LOG_LEVEL (デフォルト: INFO) で指定する。DEBUG にすると SQL やitem_dataも出力される。
+# 書き込みは QueueListener のバックグラウンドスレッドで行い、ファイルは LOG_MAX_BYTES ごとにローテーションする。
 logger = logging.getLogger(__name__)
-logger.setLevel(logging.DEBUG) # 全てのデバッグレベルのログを出力
-
-# コンソールハンドラー
-console_handler = logging.StreamHandler(sys.stdout)
-console_handler.setLevel(logging.DEBUG)
-console_formatter = logging.Formatter('%(levelname)s: %(message)s')
-console_handler.setFormatter(console_formatter)
-logger.addHandler(console_handler)
-
-# ファイルハンドラー
 log_file_path = '/var/www/html/app/logs/populate_script.log'
-# ディレクトリが存在しない場合に作成
-os.makedirs(os.path.dirname(log_file_path), exist_ok=True)
-file_handler = logging.FileHandler(log_file_path, mode='a', encoding='utf-8')
-file_handler.setLevel(logging.DEBUG)
-file_formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
-file_handler.setFormatter(file_formatter)
-logger.addHandler(file_handler)
-
-logger.info("populate_products_and_categories.py スクリプト開始。")
+log_listener = setup_queue_logging(logger, log_file_path)
 
-# Dotenvライブラリを使って.envファイルをロード
-from dotenv import load_dotenv
-load_dotenv()
+# 実行メトリクスのジョブ名 (Prometheus のメトリクス名の接頭辞にもなる)
+METRICS_JOB_NAME = 'populate_products'
 
-# MySQL接続情報
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'mysql'),
-    'user': os.getenv('DB_USER', 'root'),
-    'password': os.getenv('DB_PASS', 'password'),
-    'database': os.getenv('DB_NAME', 'tiper')
-}
+logger.info("populate_products_and_categories.py スクリプト開始。")
 
 # ==============================================================================
 # ヘルパー関数群
 # ==============================================================================
 
-def get_safe_value(data, path, default=None):
-    """
-    ネストされたJSONデータから安全に値を取得する。
-    例: get_safe_value(item_data, ['item', 'title'])
-    例: get_safe_value(item_data, ['posterimage', 0, 'large'])
-    """
-    current_data = data
-    for key in path:
-        if isinstance(current_data, dict) and key in current_data:
-            current_data = current_data[key]
-        elif isinstance(current_data, list) and isinstance(key, int) and len(current_data) > key:
-            current_data = current_data[key]
-        else:
-            return default
-    return current_data
-
 def parse_date(date_str):
     """日付文字列をYYYY-MM-DD形式に変換。無効な場合はNone。"""
     if not date_str:
@@ -103,6 +89,89 @@ def convert_to_float(value, default=0.0):
     except (ValueError, TypeError):
         return default
 
+def flatten_category_entries(categories_raw) -> list:
+    """
+    Duga API の 'category' / 'performer' の値から {'name': ...} を持つ data 辞書をリストで取り出す。
+    [{'data': {...}}, ...] / [{'data': [{...}, ...]}] / {'data': [...]} / {'data': {...}} の各形式に対応する。
+    """
+    entries = []
+    if isinstance(categories_raw, list):
+        for entry in categories_raw:
+            if isinstance(entry, dict) and 'data' in entry:
+                if isinstance(entry['data'], dict) and 'name' in entry['data']:
+                    entries.append(entry['data'])
+                elif isinstance(entry['data'], list):
+                    entries.extend(entry['data'])
+    elif isinstance(categories_raw, dict) and 'data' in categories_raw:
+        if isinstance(categories_raw['data'], list):
+            entries.extend(categories_raw['data'])
+        elif isinstance(categories_raw['data'], dict) and 'name' in categories_raw['data']:
+            entries.append(categories_raw['data'])
+    return entries
+
+def collect_category_names(entries, collected: set):
+    """flatten_category_entries の結果から空でない name を collected に追加する。"""
+    for entry in entries:
+        if isinstance(entry, dict) and 'name' in entry:
+            name = clean_string(entry['name'])
+            if name:
+                collected.add(name)
+
+def collect_image_candidates(item_data, candidates: list):
+    """
+    posterimage → jacketimage の先頭要素から large > midium > small の順に画像URLを candidates に追加する。
+    """
+    candidates.extend(image_url for image_url in DUGA_IMAGE_CANDIDATE_PLAN(item_data) if image_url)
+
+def is_blank(value) -> bool:
+    """clean_string した結果が None (None / 空文字列 / 空白のみ) かどうか。"""
+    return clean_string(value) is None
+
+def clean_date(value):
+    """clean_string してから parse_date する。"""
+    return parse_date(clean_string(value))
+
+# ==============================================================================
+# フィールドマップ (Duga API の item → products のカラム)
+# = field_map.compile_field_map で1回だけコンパイルし、item 1件から全カラムを1パスで取り出す
+# ==============================================================================
+
+# メイン (最新) のスナップショットから取り出す products のカラム
+DUGA_PRODUCT_FIELDS = (
+    FieldSpec('title', ('title',), normalize=clean_string),
+    FieldSpec('original_title', ('originaltitle',), normalize=clean_string),
+    FieldSpec('caption', ('caption',), normalize=clean_string),
+    # releasedate を優先し、空なら opendate を使用
+    FieldSpec('release_date', ('releasedate',), ('opendate',), normalize=clean_date, empty=is_blank),
+    FieldSpec('maker_name', ('makername',), normalize=clean_string),
+    FieldSpec('item_no', ('itemno',), normalize=clean_string),
+    FieldSpec('price', ('price',), normalize=convert_to_float, default='0'),
+    FieldSpec('volume', ('volume',), normalize=convert_to_int),
+    FieldSpec('url', ('url',), normalize=clean_string),
+    FieldSpec('affiliate_url', ('affiliateurl',), normalize=clean_string),
+    FieldSpec('sample_movie_url', ('samplemovie', 0, 'midium', 'movie'), normalize=clean_string),
+    FieldSpec('sample_movie_capture_url', ('samplemovie', 0, 'midium', 'capture'), normalize=clean_string),
+)
+
+# 画像URLの候補 (posterimage → jacketimage の先頭要素、それぞれ large > midium > small の順で優先)
+DUGA_IMAGE_CANDIDATE_FIELDS = tuple(
+    FieldSpec(f"{image_key}_{size}", (image_key, 0, size))
+    for image_key in ('posterimage', 'jacketimage')
+    for size in ('large', 'midium', 'small')
+)
+
+# 全スナップショットから集めるカテゴリ・シリーズ・画像候補
+DUGA_SNAPSHOT_FIELDS = (
+    FieldSpec('category', ('category',)),
+    FieldSpec('performer', ('performer',)),
+    FieldSpec('series_name', ('series', 'name'), normalize=clean_string),
+) + DUGA_IMAGE_CANDIDATE_FIELDS
+
+DUGA_PRODUCT_PLAN = compile_field_map(DUGA_PRODUCT_FIELDS, 'DugaProductRecord')
+DUGA_SNAPSHOT_PLAN = compile_field_map(DUGA_SNAPSHOT_FIELDS, 'DugaSnapshotRecord')
+DUGA_IMAGE_CANDIDATE_PLAN = compile_field_map(DUGA_IMAGE_CANDIDATE_FIELDS, 'DugaImageCandidateRecord')
+DUGA_IMAGE_CANDIDATE_SLICE = slice(len(DUGA_SNAPSHOT_FIELDS) - len(DUGA_IMAGE_CANDIDATE_FIELDS), None)
+
 # ==============================================================================
 # データベース操作関数
 # ==============================================================================
@@ -114,30 +183,30 @@ def get_or_create_category(cursor, conn, category_type: str, category_name: str)
     独自のコミットやロールバックは行いません。
     """
     sql = "SELECT id FROM categories WHERE type = %s AND name = %s"
-    logger.debug(f"DEBUG SQL: get_or_create_category SELECT: SQL='{sql}', Params=(''{category_type}'', ''{category_name}'')")
+    logger.debug("DEBUG SQL: get_or_create_category SELECT: SQL='%s', Params=(''%s'', ''%s'')", sql, category_type, category_name)
     cursor.execute(sql, (category_type, category_name))
     result = cursor.fetchone()
     if result:
         return result[0]
     else:
-        logger.info(f"DEBUG: 新しいカテゴリを作成します: Type='{category_type}', Name='{category_name}'")
+        logger.info("DEBUG: 新しいカテゴリを作成します: Type='%s', Name='%s'", category_type, category_name)
         insert_sql = "INSERT INTO categories (type, name) VALUES (%s, %s)"
-        logger.debug(f"DEBUG SQL: get_or_create_category INSERT: SQL='{insert_sql}', Params=(''{category_type}'', ''{category_name}'')")
+        logger.debug("DEBUG SQL: get_or_create_category INSERT: SQL='%s', Params=(''%s'', ''%s'')", insert_sql, category_type, category_name)
         try:
             cursor.execute(insert_sql, (category_type, category_name))
             return cursor.lastrowid
         except mysql.connector.Error as err:
             if err.errno == 1062: # Duplicate entry for key 'uk_type_name'
                 # 重複エラーの場合、すでに存在するので再取得を試みる
-                logger.warning(f"DEBUG: カテゴリ '{category_type}' - '{category_name}' は既に存在するため、再取得します。")
-                logger.debug(f"DEBUG SQL: get_or_create_category SELECT (after retry): SQL='{sql}', Params=(''{category_type}'', ''{category_name}'')")
+                logger.warning("DEBUG: カテゴリ '%s' - '%s' は既に存在するため、再取得します。", category_type, category_name)
+                logger.debug("DEBUG SQL: get_or_create_category SELECT (after retry): SQL='%s', Params=(''%s'', ''%s'')", sql, category_type, category_name)
                 cursor.execute(sql, (category_type, category_name))
                 result_after_retry = cursor.fetchone()
                 if result_after_retry:
                     return result_after_retry[0]
                 else:
                     # ここに到達することは稀だが、もし再取得も失敗したらエラー
-                    logger.error(f"ERROR: カテゴリ '{category_type}' - '{category_name}' の重複作成後の再取得に失敗しました。")
+                    logger.error("ERROR: カテゴリ '%s' - '%s' の重複作成後の再取得に失敗しました。", category_type, category_name)
                     raise
             else:
                 raise # その他のDBエラーは再スロー
@@ -148,7 +217,7 @@ def associate_product_with_category(cursor, conn, product_db_id: int, category_i
     重複挿入を避ける。
     """
     insert_sql = "INSERT IGNORE INTO product_categories (product_id, category_id) VALUES (%s, %s)"
-    logger.debug(f"DEBUG SQL: associate_product_with_category INSERT: SQL='{insert_sql}', Params=({product_db_id}, {category_id})")
+    logger.debug("DEBUG SQL: associate_product_with_category INSERT: SQL='%s', Params=(%s, %s)", insert_sql, product_db_id, category_id)
     cursor.execute(insert_sql, (product_db_id, category_id))
     # conn.commit() は populate_products_and_categories_main_loop の main commit でまとめて行う (変更なし)
 
@@ -169,168 +238,156 @@ def ensure_processed_at_column_exists(cursor, conn):
             logger.info("processed_atカラムは既に存在します。")
     except mysql.connector.Error as err:
         if "Duplicate column name 'processed_at'" not in str(err):
-            logger.error(f"processed_atカラムの確認または追加エラー: {err}")
+            logger.error("processed_atカラムの確認または追加エラー: %s", err)
             raise # その他のエラーは再スローする
 
-def process_single_product_id_batch(cursor, conn, product_api_id: str, source_api_name: str):
-    """
-    特定の product_id (API側) と source_api に関連するraw_api_data全てを処理し、
-    productsテーブルを更新、カテゴリを統合して紐付ける。
+# 未処理のraw_api_dataを製品単位で取得するSQL (新しい順)
+SELECT_UNPROCESSED_RAW_SQL = """
+    SELECT id, api_response_data, fetched_at
+    FROM raw_api_data
+    WHERE product_id = %s AND source_api = %s AND processed_at IS NULL
+    ORDER BY fetched_at DESC, id DESC
+"""
+
+# バルクUPSERTで products に書き込むカラム (順序は product_row_values と一致させる)
+PRODUCT_UPSERT_COLUMNS = (
+    'product_id', 'title', 'original_title', 'caption', 'release_date', 'maker_name',
+    'item_no', 'price', 'volume', 'url', 'affiliate_url',
+    'main_image_url', 'og_image_url', 'sample_movie_url', 'sample_movie_capture_url',
+    'actresses_json', 'genres_json', 'series_json',
+    'source_api', 'raw_api_data_id', 'content_hash', 'created_at', 'updated_at',
+)
+# 重複時 (既存製品) に更新するカラム。product_id と created_at は既存の値を保持する。
+PRODUCT_UPDATE_COLUMNS = tuple(col for col in PRODUCT_UPSERT_COLUMNS if col not in ('product_id', 'created_at'))
+# content_hash の計算対象カラム。
+# raw_api_data_id はスナップショットごとに変わり、*_json は set の反復順序で変わるため除外する
+# (カテゴリ集合はハッシュにソート済みで含める)。
+PRODUCT_HASH_COLUMNS = tuple(
+    col for col in PRODUCT_UPSERT_COLUMNS
+    if col not in ('actresses_json', 'genres_json', 'series_json', 'raw_api_data_id', 'content_hash', 'created_at', 'updated_at')
+)
+
+
+def ensure_product_id_unique_key_exists(cursor, conn):
     """
-    # 関連するraw_api_dataを全て取得 (processed_atがNULLのもの)
-    select_raw_sql = """
-        SELECT id, api_response_data, fetched_at
-        FROM raw_api_data
-        WHERE product_id = %s AND source_api = %s AND processed_at IS NULL
-        ORDER BY fetched_at DESC, id DESC
+    products.product_id に UNIQUE KEY が存在することを確認し、なければ追加する。
+    バルクUPSERT (INSERT ... ON DUPLICATE KEY UPDATE) はこのキーで既存製品を判定する。
+    既存の products に同じ product_id の行が複数ある場合は UNIQUE KEY を追加できないため、
+    重複している product_id の例を含むメッセージで RuntimeError を送出する。
     """
-    logger.debug(f"DEBUG SQL: process_single_product_id_batch SELECT RAW: SQL='{select_raw_sql}', Params=(''{product_api_id}'', ''{source_api_name}'')")
-    cursor.execute(select_raw_sql, (product_api_id, source_api_name))
-    all_raw_data_for_product = cursor.fetchall()
+    try:
+        cursor.execute("""
+            SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS
+            WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'products' AND COLUMN_NAME = 'product_id'
+              AND NON_UNIQUE = 0 AND SEQ_IN_INDEX = 1
+        """, (DB_CONFIG['database'],))
+        if cursor.fetchone() is None:
+            cursor.execute("""
+                SELECT product_id, COUNT(*) FROM products
+                GROUP BY product_id
+                HAVING COUNT(*) > 1
+                LIMIT 5
+            """)
+            duplicates = cursor.fetchall()
+            if duplicates:
+                examples = ", ".join(f"{product_api_id} ({count} 行)" for product_api_id, count in duplicates)
+                raise RuntimeError(
+                    "products.product_id に重複があるため UNIQUE KEY uk_products_product_id を追加できません "
+                    f"(例: {examples})。重複している行を1行にまとめてから再実行するか、--bulk-size 0 で実行してください。"
+                    "重複の一覧: SELECT product_id, COUNT(*) FROM products GROUP BY product_id HAVING COUNT(*) > 1"
+                )
+            logger.info("productsテーブルのproduct_idにUNIQUE KEYを追加します...")
+            cursor.execute("ALTER TABLE `products` ADD UNIQUE KEY `uk_products_product_id` (`product_id`)")
+            conn.commit()
+            logger.info("uk_products_product_id が正常に追加されました。")
+        else:
+            logger.info("products.product_id のUNIQUE KEYは既に存在します。")
+    except mysql.connector.Error as err:
+        if "Duplicate key name" not in str(err):
+            logger.error("products.product_id のUNIQUE KEY確認または追加エラー: %s", err)
+            raise
 
-    if not all_raw_data_for_product:
-        logger.debug(f"DEBUG: 処理すべきraw_api_dataが見つかりませんでした。Product ID: {product_api_id}, Source: {source_api_name}")
-        return 0 # 処理すべきデータがなければ0を返す
+def merge_raw_rows_for_product(product_api_id: str, source_api_name: str, all_raw_data_for_product, decoded_raw_rows=None, prior_state=None):
+    """
+    1製品分のraw_api_data行 (fetched_at DESC, id DESC 順) を統合し、
+    productsテーブルに書き込む値とカテゴリ集合を辞書で返す。
+    product_id またはタイトルが空でスキップすべき場合は None を返す。
+    decoded_raw_rows に decode_raw_rows() の結果を渡した場合はデコードを省略する。
+    prior_state (ProductMergeState) を渡した場合は、過去のスナップショットのカテゴリ集合と画像URL候補に
+    今回の行を畳み込む (画像は今回の行の候補を優先する)。畳み込んだ状態は戻り値の 'merge_state' に入る。
+    """
+    # 各raw行のJSONは1回だけデコードし、メイン行の選択とカテゴリ・画像の収集で共有する
+    if decoded_raw_rows is None:
+        decoded_raw_rows = decode_raw_rows(all_raw_data_for_product)
 
     # productsテーブルを更新するための「メイン」となる生データを選択
     # ここでは最新の fetched_at を持つものをメインとする
-    main_raw_data_row = all_raw_data_for_product[0]
+    main_raw_data_row = decoded_raw_rows[0]
     main_raw_api_data_id = main_raw_data_row[0]
 
-    main_raw_json_data = json.loads(main_raw_data_row[1])
     # PHPスクリプトが'item'キーの中身を直接raw_api_data.api_response_dataに保存しているため、それを直接使用
-    main_item_data = main_raw_json_data 
+    main_item_data = main_raw_data_row[1]
 
-    logger.debug(f"DEBUG: メインのitem_data (product_id: {product_api_id}): {main_item_data}")
+    logger.debug("DEBUG: メインのitem_data (product_id: %s): %s", product_api_id, main_item_data)
 
-    # 全てのraw_api_dataレコードからカテゴリ情報を収集
-    collected_genres = set()
-    collected_actresses = set()
-    collected_series_names = set() # シリーズ名は文字列で収集
+    # 全てのraw_api_dataレコードからカテゴリ情報を収集 (過去のスナップショットの統合状態があればそこから始める)
+    collected_genres = set(prior_state.genres) if prior_state is not None else set()
+    collected_actresses = set(prior_state.actresses) if prior_state is not None else set()
+    collected_series_names = set(prior_state.series_names) if prior_state is not None else set() # シリーズ名は文字列で収集
 
     # 画像URLの候補を収集 (優先順位: large -> medium -> small)
     main_image_candidates = []
     og_image_candidates = [] # OGP画像もメイン画像と同じロジックで収集
 
-    for raw_data_row in all_raw_data_for_product:
-        current_raw_json_data = json.loads(raw_data_row[1])
+    for raw_data_row in decoded_raw_rows:
         # PHPスクリプトが'item'キーの中身を直接raw_api_data.api_response_dataに保存しているため、それを直接使用
-        current_item_data = current_raw_json_data 
+        current_item_data = raw_data_row[1]
 
-        logger.debug(f"DEBUG: カテゴリ収集元のitem_data: {current_item_data}")
+        logger.debug("DEBUG: カテゴリ収集元のitem_data: %s", current_item_data)
+        snapshot = DUGA_SNAPSHOT_PLAN(current_item_data)
 
         # ジャンル収集 (Duga APIの 'category' -> 'data' に対応)
-        categories_raw = get_safe_value(current_item_data, ['category'])
-        genres_to_process = []
-
-        if isinstance(categories_raw, list):
-            for entry in categories_raw:
-                if isinstance(entry, dict) and 'data' in entry:
-                    if isinstance(entry['data'], dict) and 'name' in entry['data']:
-                        genres_to_process.append(entry['data'])
-                    elif isinstance(entry['data'], list):
-                        genres_to_process.extend(entry['data'])
-        elif isinstance(categories_raw, dict) and 'data' in categories_raw:
-            if isinstance(categories_raw['data'], list):
-                genres_to_process.extend(categories_raw['data'])
-            elif isinstance(categories_raw['data'], dict) and 'name' in categories_raw['data']:
-                genres_to_process.append(categories_raw['data'])
-
-        logger.debug(f"DEBUG: 抽出された genres_data (from category.data processing): {genres_to_process} (タイプ: {type(genres_to_process)})")
-        if genres_to_process:
-            for genre_entry in genres_to_process:
-                if isinstance(genre_entry, dict) and 'name' in genre_entry:
-                    genre_name = clean_string(genre_entry['name'])
-                    if genre_name:
-                        collected_genres.add(genre_name)
+        genres_to_process = flatten_category_entries(snapshot.category)
+        logger.debug("DEBUG: 抽出された genres_data (from category.data processing): %s (タイプ: %s)", genres_to_process, type(genres_to_process))
+        collect_category_names(genres_to_process, collected_genres)
 
         # 女優収集 (Duga APIの 'performer' -> 'data' に対応)
-        performers_raw = get_safe_value(current_item_data, ['performer'])
-        actresses_to_process = []
-
-        if isinstance(performers_raw, list):
-            for entry in performers_raw:
-                if isinstance(entry, dict) and 'data' in entry:
-                    if isinstance(entry['data'], dict) and 'name' in entry['data']:
-                        actresses_to_process.append(entry['data'])
-                    elif isinstance(entry['data'], list):
-                        actresses_to_process.extend(entry['data'])
-        elif isinstance(performers_raw, dict) and 'data' in performers_raw:
-            if isinstance(performers_raw['data'], list):
-                actresses_to_process.extend(performers_raw['data'])
-            elif isinstance(performers_raw['data'], dict) and 'name' in performers_raw['data']:
-                actresses_to_process.append(performers_raw['data'])
-
-        logger.debug(f"DEBUG: 抽出された actresses_data (from performer.data processing): {actresses_to_process} (タイプ: {type(actresses_to_process)})")
-        if actresses_to_process:
-            for actress_entry in actresses_to_process:
-                if isinstance(actress_entry, dict) and 'name' in actress_entry:
-                    actress_name = clean_string(actress_entry['name'])
-                    if actress_name:
-                        collected_actresses.add(actress_name)
+        actresses_to_process = flatten_category_entries(snapshot.performer)
+        logger.debug("DEBUG: 抽出された actresses_data (from performer.data processing): %s (タイプ: %s)", actresses_to_process, type(actresses_to_process))
+        collect_category_names(actresses_to_process, collected_actresses)
 
         # シリーズ収集 (Duga APIの 'series' -> 'name' に対応)
-        series_name_from_item = clean_string(get_safe_value(current_item_data, ['series', 'name']))
-        if series_name_from_item:
-            collected_series_names.add(series_name_from_item)
-
-        # 画像URL候補の収集
-        # posterimageとjacketimageから各サイズのURLを収集し、優先順位をつけて追加
-        # large > medium > small の順で優先
-        
-        # posterimageからの候補
-        poster_images = get_safe_value(current_item_data, ['posterimage'], [])
-        if poster_images and isinstance(poster_images, list) and len(poster_images) > 0:
-            if get_safe_value(poster_images[0], ['large']): main_image_candidates.append(get_safe_value(poster_images[0], ['large']))
-            if get_safe_value(poster_images[0], ['midium']): main_image_candidates.append(get_safe_value(poster_images[0], ['midium']))
-            if get_safe_value(poster_images[0], ['small']): main_image_candidates.append(get_safe_value(poster_images[0], ['small']))
-
-        # jacketimageからの候補
-        jacket_images = get_safe_value(current_item_data, ['jacketimage'], [])
-        if jacket_images and isinstance(jacket_images, list) and len(jacket_images) > 0:
-            if get_safe_value(jacket_images[0], ['large']): main_image_candidates.append(get_safe_value(jacket_images[0], ['large']))
-            if get_safe_value(jacket_images[0], ['midium']): main_image_candidates.append(get_safe_value(jacket_images[0], ['midium']))
-            if get_safe_value(jacket_images[0], ['small']): main_image_candidates.append(get_safe_value(jacket_images[0], ['small']))
-        
+        if snapshot.series_name:
+            collected_series_names.add(snapshot.series_name)
+
+        # 画像URL候補の収集 (posterimage → jacketimage、それぞれ large > medium > small の順で優先)
+        main_image_candidates.extend(image_url for image_url in snapshot[DUGA_IMAGE_CANDIDATE_SLICE] if image_url)
+
         # OGP画像は、メイン画像と同じ候補リストを使用 (Duga APIに専用OGPフィールドがないため)
         og_image_candidates.extend(main_image_candidates)
 
+    # 過去のスナップショットの画像URL候補は今回の行の候補より後ろに並べる
+    if prior_state is not None:
+        main_image_candidates.extend(prior_state.image_candidates)
+        og_image_candidates.extend(prior_state.image_candidates)
 
-    logger.debug(f"DEBUG: 最終的に収集されたジャンル: {collected_genres}")
-    logger.debug(f"DEBUG: 最終的に収集された女優: {collected_actresses}")
-    logger.debug(f"DEBUG: 最終的に収集されたシリーズ: {collected_series_names}")
+    logger.debug("DEBUG: 最終的に収集されたジャンル: %s", collected_genres)
+    logger.debug("DEBUG: 最終的に収集された女優: %s", collected_actresses)
+    logger.debug("DEBUG: 最終的に収集されたシリーズ: %s", collected_series_names)
 
     # productsテーブルに挿入するデータをメインの生データから抽出
-    title = clean_string(get_safe_value(main_item_data, ['title']))
-    logger.debug(f"DEBUG: 抽出されたタイトル (product_id: {product_api_id}): '{title}'")
+    # (カラムと JSON パスの対応は DUGA_PRODUCT_FIELDS を参照)
+    product_fields = DUGA_PRODUCT_PLAN(main_item_data)
+    title = product_fields.title
+    logger.debug("DEBUG: 抽出されたタイトル (product_id: %s): '%s'", product_api_id, title)
     # 「タイトルなし」をデフォルト値として使用
     if not title:
         title = "タイトルなし"
 
-    original_title = clean_string(get_safe_value(main_item_data, ['originaltitle']))
-    caption = clean_string(get_safe_value(main_item_data, ['caption']))
-
-    # release_date を優先し、なければ opendate を使用
-    release_date_str = clean_string(get_safe_value(main_item_data, ['releasedate']))
-    if not release_date_str:
-        release_date_str = clean_string(get_safe_value(main_item_data, ['opendate']))
-    release_date = parse_date(release_date_str)
-
-    maker_name = clean_string(get_safe_value(main_item_data, ['makername']))
-    item_no = clean_string(get_safe_value(main_item_data, ['itemno']))
-
-    price = convert_to_float(get_safe_value(main_item_data, ['price'], default='0'))
-    volume = convert_to_int(get_safe_value(main_item_data, ['volume']), default=0)
-    url = clean_string(get_safe_value(main_item_data, ['url']))
-    affiliate_url = clean_string(get_safe_value(main_item_data, ['affiliateurl']))
-
-    sample_movie_url = clean_string(get_safe_value(main_item_data, ['samplemovie', 0, 'midium', 'movie']))
-    sample_movie_capture_url = clean_string(get_safe_value(main_item_data, ['samplemovie', 0, 'midium', 'capture']))
-
     # メイン画像URLの選定 (重複を排除し、順番を保持)
     main_image_url = None
     if main_image_candidates:
-        main_image_candidates_unique = list(dict.fromkeys(main_image_candidates)) 
+        main_image_candidates_unique = list(dict.fromkeys(main_image_candidates))
         main_image_url = clean_string(main_image_candidates_unique[0])
 
     # OGP画像URLの選定
@@ -339,39 +396,176 @@ def process_single_product_id_batch(cursor, conn, product_api_id: str, source_ap
         og_image_candidates_unique = list(dict.fromkeys(og_image_candidates))
         og_image_url = clean_string(og_image_candidates_unique[0])
 
-    source_api_for_products = source_api_name
-
     if not product_api_id:
-        logger.warning(f"警告: product_id (raw_api_data.product_id) が空のためスキップします (Source: {source_api_name}).")
-        for raw_data_row in all_raw_data_for_product:
-            update_raw_processed_sql = "UPDATE raw_api_data SET processed_at = %s WHERE id = %s"
-            logger.debug(f"DEBUG SQL: Skipping product - UPDATE RAW PROCESSED: SQL='{update_raw_processed_sql}', Params=(''{datetime.now()}'', {raw_data_row[0]})")
-            cursor.execute(update_raw_processed_sql, (datetime.now(), raw_data_row[0]))
-        return 0
+        logger.warning("警告: product_id (raw_api_data.product_id) が空のためスキップします (Source: %s).", source_api_name)
+        return None
 
     if not title: # titleがNoneまたは空文字列の場合もスキップ
-        logger.warning(f"警告: 製品タイトルが空のためスキップします。Product ID: {product_api_id} (Source: {source_api_name}).")
-        for raw_data_row in all_raw_data_for_product:
-            update_raw_processed_sql = "UPDATE raw_api_data SET processed_at = %s WHERE id = %s"
-            logger.debug(f"DEBUG SQL: Skipping product - UPDATE RAW PROCESSED: SQL='{update_raw_processed_sql}', Params=(''{datetime.now()}'', {raw_data_row[0]})")
-            cursor.execute(update_raw_processed_sql, (datetime.now(), raw_data_row[0]))
+        logger.warning("警告: 製品タイトルが空のためスキップします。Product ID: %s (Source: %s).", product_api_id, source_api_name)
+        return None
+
+    # JSONデータを文字列として準備
+    genres_json_str = json.dumps(list(collected_genres), ensure_ascii=False) if collected_genres else None
+    actresses_json_str = json.dumps(list(collected_actresses), ensure_ascii=False) if collected_actresses else None
+    series_json_str = json.dumps(list(collected_series_names), ensure_ascii=False) if collected_series_names else None
+
+    merged = {
+        'product_id': product_api_id,
+        'title': title,
+        'original_title': product_fields.original_title,
+        'caption': product_fields.caption,
+        'release_date': product_fields.release_date,
+        'maker_name': product_fields.maker_name,
+        'item_no': product_fields.item_no,
+        'price': product_fields.price,
+        'volume': product_fields.volume,
+        'url': product_fields.url,
+        'affiliate_url': product_fields.affiliate_url,
+        'main_image_url': main_image_url,
+        'og_image_url': og_image_url,
+        'sample_movie_url': product_fields.sample_movie_url,
+        'sample_movie_capture_url': product_fields.sample_movie_capture_url,
+        'actresses_json': actresses_json_str,
+        'genres_json': genres_json_str,
+        'series_json': series_json_str,
+        'source_api': source_api_name,
+        'raw_api_data_id': main_raw_api_data_id,
+        'genres': collected_genres,
+        'actresses': collected_actresses,
+        'series_names': collected_series_names,
+    }
+    merged['content_hash'] = product_content_hash(merged)
+    merged['merge_state'] = ProductMergeState(
+        product_api_id, source_api_name, collected_genres, collected_actresses, collected_series_names,
+        list(dict.fromkeys(main_image_candidates))[:MAX_IMAGE_CANDIDATES], main_raw_api_data_id,
+        (prior_state.snapshots_merged if prior_state is not None else 0) + len(decoded_raw_rows),
+    )
+    return merged
+
+def product_row_values(merged: dict, now) -> tuple:
+    """merge_raw_rows_for_product の結果を PRODUCT_UPSERT_COLUMNS 順のタプルに変換する。"""
+    return tuple(now if col in ('created_at', 'updated_at') else merged[col] for col in PRODUCT_UPSERT_COLUMNS)
+
+def product_content_hash(merged: dict) -> str:
+    """統合済みの製品の PRODUCT_HASH_COLUMNS とカテゴリ集合から content_hash を計算する。"""
+    return compute_product_content_hash(
+        {col: merged[col] for col in PRODUCT_HASH_COLUMNS},
+        category_keys_for_product(merged),
+    )
+
+def category_keys_for_product(merged: dict) -> list:
+    """
+    統合済みの製品から紐付けるカテゴリの (type, name) を
+    ジャンル → 女優 → レーベル (maker_name) → シリーズ の順で返す。
+    """
+    keys = [("ジャンル", genre_name) for genre_name in merged['genres']]
+    keys.extend(("女優", actress_name) for actress_name in merged['actresses'])
+    if merged['maker_name']:
+        keys.append(("レーベル", merged['maker_name']))
+    keys.extend(("シリーズ", series_name) for series_name in merged['series_names'])
+    return keys
+
+def link_product_categories(cursor, conn, product_db_id: int, merged: dict, category_resolver=None, link_buffer=None, metrics=NULL_METRICS):
+    """
+    統合済みのジャンル・女優・レーベル・シリーズを categories/product_categories に紐付ける。
+    category_resolver (CategoryResolver) が渡された場合はカテゴリIDをメモリキャッシュから解決し、
+    未登録のものだけをまとめて作成する。
+    link_buffer (ProductCategoryLinkBuffer / ProductCategoryLinkSync) が渡された場合は製品の紐付けの集合を登録し、
+    書き込みは link_buffer.flush() でまとめて行う (ProductCategoryLinkSync の場合は集合にない既存の紐付けを削除する)。
+    """
+    product_api_id = merged['product_id']
+    category_keys = category_keys_for_product(merged)
+    logger.debug("DEBUG: カテゴリを categories/product_categories に紐付けます。収集済み: %s", category_keys)
+
+    with metrics.stage('category_resolve'):
+        if category_resolver is not None:
+            category_ids = category_resolver.resolve_many(cursor, category_keys)
+        else:
+            category_ids = {key: get_or_create_category(cursor, conn, key[0], key[1]) for key in category_keys}
+
+    with metrics.stage('link_write'):
+        if link_buffer is not None:
+            link_buffer.set_product_links(cursor, product_db_id, [category_ids[key] for key in category_keys])
+        for category_type, category_name in category_keys:
+            if link_buffer is None:
+                associate_product_with_category(cursor, conn, product_db_id, category_ids[(category_type, category_name)])
+            logger.debug("  製品ID %s に%s '%s' を紐付けました。", product_api_id, category_type, category_name)
+
+def mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker=None):
+    """
+    1製品分のraw_api_data行を処理済みにする。
+    processed_marker (RawProcessedMarker) が渡された場合はIDを追加するだけで、
+    UPDATE はコミット直前の processed_marker.flush() でまとめて行う。
+    """
+    raw_ids = [raw_data_row[0] for raw_data_row in all_raw_data_for_product]
+    if processed_marker is not None:
+        processed_marker.add(raw_ids)
+    else:
+        logger.debug("DEBUG SQL: UPDATE RAW PROCESSED: raw_api_data.id IN %s", raw_ids)
+        mark_raw_rows_processed(cursor, raw_ids)
+
+def process_single_product_id_batch(cursor, conn, product_api_id: str, source_api_name: str, category_resolver=None, link_buffer=None, processed_marker=None,
+                                    preloaded_raw_rows=None, metrics=NULL_METRICS, merge_states=None):
+    """
+    特定の product_id (API側) と source_api に関連するraw_api_data全てを処理し、
+    productsテーブルを更新、カテゴリを統合して紐付ける。
+    preloaded_raw_rows が渡された場合は load_unprocessed_raw_rows_for_keys で
+    取得済みの行を使い、製品ごとの SELECT を省略する。
+    merge_states に load_merge_states の結果を渡した場合は、製品ごとの統合状態の SELECT を省略する。
+    metrics (RunMetrics) が渡された場合はステージごとの所要時間と件数を記録する。
+    """
+    if preloaded_raw_rows is not None:
+        all_raw_data_for_product = preloaded_raw_rows
+    else:
+        # 関連するraw_api_dataを全て取得 (processed_atがNULLのもの)
+        logger.debug("DEBUG SQL: process_single_product_id_batch SELECT RAW: SQL='%s', Params=(''%s'', ''%s'')", SELECT_UNPROCESSED_RAW_SQL, product_api_id, source_api_name)
+        with metrics.stage('raw_fetch'):
+            cursor.execute(SELECT_UNPROCESSED_RAW_SQL, (product_api_id, source_api_name))
+            all_raw_data_for_product = cursor.fetchall()
+
+    if not all_raw_data_for_product:
+        logger.debug("DEBUG: 処理すべきraw_api_dataが見つかりませんでした。Product ID: %s, Source: %s", product_api_id, source_api_name)
+        return 0 # 処理すべきデータがなければ0を返す
+    metrics.incr('raw_rows', len(all_raw_data_for_product))
+
+    if merge_states is None:
+        with metrics.stage('state_load'):
+            merge_states = load_merge_states(cursor, [(product_api_id, source_api_name)])
+
+    with metrics.stage('json_decode'):
+        decoded_raw_rows = decode_raw_rows(all_raw_data_for_product)
+    with metrics.stage('merge'):
+        merged = merge_raw_rows_for_product(product_api_id, source_api_name, all_raw_data_for_product, decoded_raw_rows,
+                                            merge_states.get((product_api_id, source_api_name)))
+
+    if merged is None:
+        # スキップした製品のraw行も処理済みとしてマークする
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
+        metrics.incr('products_skipped')
         return 0
 
+    title = merged['title']
 
     # データベースに製品が存在するか確認
-    select_product_sql = "SELECT id FROM products WHERE product_id = %s"
-    logger.debug(f"DEBUG SQL: SELECT PRODUCT: SQL='{select_product_sql}', Params=(''{product_api_id}'')")
-    cursor.execute(select_product_sql, (product_api_id,))
-    existing_product = cursor.fetchone()
+    select_product_sql = "SELECT id, content_hash FROM products WHERE product_id = %s"
+    logger.debug("DEBUG SQL: SELECT PRODUCT: SQL='%s', Params=(''%s'')", select_product_sql, product_api_id)
+    with metrics.stage('product_lookup'):
+        cursor.execute(select_product_sql, (product_api_id,))
+        existing_product = cursor.fetchone()
 
     now = datetime.now()
     product_db_id = None
 
-    # JSONデータを文字列として準備
-    genres_json_str = json.dumps(list(collected_genres), ensure_ascii=False) if collected_genres else None
-    actresses_json_str = json.dumps(list(collected_actresses), ensure_ascii=False) if collected_actresses else None
-    series_json_str = json.dumps(list(collected_series_names), ensure_ascii=False) if collected_series_names else None
+    # 統合状態は raw 行を処理済みにするのと同じトランザクションで保存する
+    with metrics.stage('state_write'):
+        save_merge_states(cursor, [merged['merge_state']])
 
+    if existing_product and existing_product[1] == merged['content_hash']:
+        # 前回から内容が変わっていないため、UPDATE と紐付けの書き込みを省略してraw行のみ処理済みにする
+        logger.info("製品に変更がないため更新をスキップしました: Product ID=%s", product_api_id)
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
+        metrics.incr('products_unchanged')
+        return 1
 
     if existing_product:
         product_db_id = existing_product[0]
@@ -381,20 +575,17 @@ def process_single_product_id_batch(cursor, conn, product_api_id: str, source_ap
                 item_no = %s, price = %s, volume = %s, url = %s, affiliate_url = %s,
                 main_image_url = %s, og_image_url = %s, sample_movie_url = %s, sample_movie_capture_url = %s,
                 actresses_json = %s, genres_json = %s, series_json = %s,
-                source_api = %s, raw_api_data_id = %s, updated_at = %s
+                source_api = %s, raw_api_data_id = %s, content_hash = %s, updated_at = %s
             WHERE product_id = %s
         """
-        params = (
-            title, original_title, caption, release_date, maker_name,
-            item_no, price, volume, url, affiliate_url,
-            main_image_url, og_image_url, sample_movie_url, sample_movie_capture_url,
-            actresses_json_str, genres_json_str, series_json_str, # JSONカラム
-            source_api_for_products, main_raw_api_data_id, now, product_api_id
-        )
-        logger.debug(f"DEBUG SQL: UPDATE PRODUCT: SQL='{update_query}', Params={params}")
-        logger.debug(f"DEBUG SQL: UPDATE PRODUCT PARAM TYPES: {[type(p).__name__ for p in params]}") # パラメータの型をログ出力
-        cursor.execute(update_query, params)
-        logger.info(f"製品を更新しました: Product ID={product_api_id}, Title='{title}'")
+        params = product_row_values(merged, now)[1:-2] + (now, product_api_id)
+        logger.debug("DEBUG SQL: UPDATE PRODUCT: SQL='%s', Params=%s", update_query, params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("DEBUG SQL: UPDATE PRODUCT PARAM TYPES: %s", [type(p).__name__ for p in params]) # パラメータの型をログ出力
+        with metrics.stage('product_write'):
+            cursor.execute(update_query, params)
+        metrics.incr('products_updated')
+        logger.info("製品を更新しました: Product ID=%s, Title='%s'", product_api_id, title)
     else:
         insert_query = """
             INSERT INTO products (
@@ -402,159 +593,522 @@ def process_single_product_id_batch(cursor, conn, product_api_id: str, source_ap
                 item_no, price, volume, url, affiliate_url,
                 main_image_url, og_image_url, sample_movie_url, sample_movie_capture_url,
                 actresses_json, genres_json, series_json,
-                source_api, raw_api_data_id, created_at, updated_at
+                source_api, raw_api_data_id, content_hash, created_at, updated_at
             ) VALUES (
-                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
+                %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s, %s
             )
         """
-        params = (
-            product_api_id, title, original_title, caption, release_date, maker_name,
-            item_no, price, volume, url, affiliate_url,
-            main_image_url, og_image_url, sample_movie_url, sample_movie_capture_url,
-            actresses_json_str, genres_json_str, series_json_str, # JSONカラム
-            source_api_for_products, main_raw_api_data_id, now, now
-        )
-        logger.debug(f"DEBUG SQL: INSERT PRODUCT: SQL='{insert_query}', Params={params}")
-        logger.debug(f"DEBUG SQL: INSERT PRODUCT PARAM TYPES: {[type(p).__name__ for p in params]}") # パラメータの型をログ出力
-        cursor.execute(insert_query, params)
+        params = product_row_values(merged, now)
+        logger.debug("DEBUG SQL: INSERT PRODUCT: SQL='%s', Params=%s", insert_query, params)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("DEBUG SQL: INSERT PRODUCT PARAM TYPES: %s", [type(p).__name__ for p in params]) # パラメータの型をログ出力
+        with metrics.stage('product_write'):
+            cursor.execute(insert_query, params)
+        metrics.incr('products_inserted')
         product_db_id = cursor.lastrowid
-        logger.info(f"新しい製品を挿入しました: Product ID={product_api_id}, Title='{title}'")
+        logger.info("新しい製品を挿入しました: Product ID=%s, Title='%s'", product_api_id, title)
 
     # カテゴリの分類と紐付け (products.id が確定した後に行う)
     if product_db_id:
-        # 収集したジャンルを紐付け
-        if collected_genres:
-            logger.debug(f"DEBUG: ジャンルを categories/product_categories に紐付けます。収集済み: {collected_genres}")
-        for genre_name in collected_genres:
-            category_id = get_or_create_category(cursor, conn, "ジャンル", genre_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            logger.info(f"  製品ID {product_api_id} にジャンル '{genre_name}' を紐付けました。")
-
-        # 収集した女優を紐付け
-        if collected_actresses:
-            logger.debug(f"DEBUG: 女優を categories/product_categories に紐付けます。収集済み: {collected_actresses}")
-        for actress_name in collected_actresses:
-            category_id = get_or_create_category(cursor, conn, "女優", actress_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            logger.info(f"  製品ID {product_api_id} に女優 '{actress_name}' を紐付けました。")
-
-        # レーベル (maker_name) を紐付け (メインデータから取得)
-        if maker_name:
-            logger.debug(f"DEBUG: レーベルを categories/product_categories に紐付けます。名前: '{maker_name}'")
-            category_id = get_or_create_category(cursor, conn, "レーベル", maker_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            logger.info(f"  製品ID {product_api_id} にレーベル '{maker_name}' を紐付けました。")
-
-        # 収集したシリーズを紐付け
-        if collected_series_names: # シリーズ名セットを使用
-            logger.debug(f"DEBUG: シリーズを categories/product_categories に紐付けます。収集済み: {collected_series_names}")
-        for series_name in collected_series_names:
-            category_id = get_or_create_category(cursor, conn, "シリーズ", series_name)
-            associate_product_with_category(cursor, conn, product_db_id, category_id)
-            logger.info(f"  製品ID {product_api_id} にシリーズ '{series_name}' を紐付けました。")
+        link_product_categories(cursor, conn, product_db_id, merged, category_resolver, link_buffer, metrics)
 
         # 処理済みのraw_api_dataレコードにマークを付ける
-        for raw_data_row in all_raw_data_for_product:
-            update_raw_processed_sql = "UPDATE raw_api_data SET processed_at = %s WHERE id = %s"
-            logger.debug(f"DEBUG SQL: UPDATE RAW PROCESSED: SQL='{update_raw_processed_sql}', Params=(''{datetime.now()}'', {raw_data_row[0]})")
-            cursor.execute(update_raw_processed_sql, (datetime.now(), raw_data_row[0]))
+        mark_product_raw_rows_processed(cursor, all_raw_data_for_product, processed_marker)
 
     return 1 # 処理した製品数を返すため
 
+def merge_product_keys(product_keys, raw_rows_by_key, metrics=NULL_METRICS, merge_states=None, errors=None) -> tuple:
+    """
+    load_unprocessed_raw_rows_for_keys で取得済みの raw 行から、複数の (product_id, source_api) を統合する。
+    merge_states (load_merge_states の結果) の統合状態があれば、そこに今回の行を畳み込む。
+    DB にはアクセスしない (CPU処理のみ) ため、パイプライン実行では読み込み・書き込みと並行して実行できる。
+    (統合済みの製品のリスト, 処理済みにする raw_api_data.id のリスト) を返す。
+    スキップした製品の raw 行も処理済みにする対象に含める (従来処理と同じ)。
+    errors にリストを渡すと、統合中に例外が発生した製品はエラーメッセージを追加して除外し、
+    その raw 行は未処理のまま残す (省略した場合は例外をそのまま送出する)。
+    """
+    merged_products = []
+    raw_ids = []
+    for product_api_id, source_api_name in product_keys:
+        all_raw_data_for_product = raw_rows_by_key.get((product_api_id, source_api_name))
+        if not all_raw_data_for_product:
+            continue
+        metrics.incr('raw_rows', len(all_raw_data_for_product))
+
+        try:
+            with metrics.stage('json_decode'):
+                decoded_raw_rows = decode_raw_rows(all_raw_data_for_product)
+            with metrics.stage('merge'):
+                merged = merge_raw_rows_for_product(product_api_id, source_api_name, all_raw_data_for_product, decoded_raw_rows,
+                                                    merge_states.get((product_api_id, source_api_name)) if merge_states else None)
+        except Exception as e:
+            if errors is None:
+                raise
+            metrics.incr('products_failed')
+            logger.error("製品ID %s の統合中にエラーが発生しました: %s", product_api_id, e)
+            errors.append(f"製品ID {product_api_id}: {e}")
+            # この製品の raw_api_data は processed_at が更新されないため、次回の実行で再度試行される
+            continue
+        raw_ids.extend(raw_data_row[0] for raw_data_row in all_raw_data_for_product)
+        if merged is not None:
+            merged_products.append(merged)
+        else:
+            metrics.incr('products_skipped')
+    return merged_products, raw_ids
 
-def populate_products_and_categories_main_loop():
+def write_merged_products(cursor, conn, merged_products, category_resolver=None, link_buffer=None, metrics=NULL_METRICS):
     """
-    raw_api_data から未処理のユニークな product_id, source_api の組み合わせを取得し、
-    それぞれを process_single_product_id_batch で処理するメインループ。
+    統合済みの製品を1本の INSERT ... ON DUPLICATE KEY UPDATE で書き込み、カテゴリを紐付ける。
+    content_hash が既存の値と一致する製品は書き込みを省略する (統合状態は全製品分を保存する)。
+    products.id はバッチ全体で1回のクエリで解決する。トランザクション管理は呼び出し元で行う。
     """
-    conn = None
-    total_products_processed = 0
-    try:
-        conn = mysql.connector.connect(**DB_CONFIG)
-        cursor = conn.cursor()
+    with metrics.stage('state_write'):
+        save_merge_states(cursor, [merged['merge_state'] for merged in merged_products])
+
+    # 既存製品の content_hash をまとめて取得し、変更のない製品を書き込み対象から除く
+    with metrics.stage('product_lookup'):
+        existing_hashes = fetch_product_hashes(cursor, [merged['product_id'] for merged in merged_products])
+    changed_products = [
+        merged for merged in merged_products
+        if existing_hashes.get(merged['product_id'], (None, None))[1] != merged['content_hash']
+    ]
+    if len(changed_products) < len(merged_products):
+        logger.info("変更のない %s 件の製品の更新をスキップしました。", len(merged_products) - len(changed_products))
+        metrics.incr('products_unchanged', len(merged_products) - len(changed_products))
+
+    if changed_products:
+        now = datetime.now()
+        with metrics.stage('product_write'):
+            affected_rows = bulk_insert_on_duplicate_update(
+                cursor, 'products', PRODUCT_UPSERT_COLUMNS,
+                [product_row_values(merged, now) for merged in changed_products],
+                PRODUCT_UPDATE_COLUMNS,
+            )
+        metrics.incr('products_upserted', len(changed_products))
+        logger.info("products に %s 件をバルクUPSERTしました (affected rows: %s)。", len(changed_products), affected_rows)
+
+        # products.id をバッチ全体で1回のクエリで解決
+        with metrics.stage('product_lookup'):
+            product_db_ids = fetch_id_map(
+                cursor, 'products', 'product_id', [merged['product_id'] for merged in changed_products],
+                resolve_keys=resolve_requested_product_ids,
+            )
+        # バッチ内の未登録カテゴリはここでまとめて作成しておく
+        if category_resolver is not None:
+            with metrics.stage('category_resolve'):
+                category_resolver.resolve_many(cursor, [key for merged in changed_products for key in category_keys_for_product(merged)])
+        for merged in changed_products:
+            product_db_id = product_db_ids.get(merged['product_id'])
+            if product_db_id:
+                link_product_categories(cursor, conn, product_db_id, merged, category_resolver, link_buffer, metrics)
+            else:
+                logger.error("バルクUPSERT後に products.id を解決できませんでした: Product ID=%s", merged['product_id'])
 
-        # autocommitをFalseに設定し、明示的にトランザクションを管理
-        conn.autocommit = False 
+def process_product_keys_bulk(cursor, conn, product_keys, category_resolver=None, link_buffer=None, processed_marker=None, metrics=NULL_METRICS):
+    """
+    複数の (product_id, source_api) をまとめて処理するバルクモード。
+    raw 行の取得 → merge_product_keys で統合 → write_merged_products で書き込み の順に行う。
+    トランザクション管理 (コミット/ロールバック) は呼び出し元で行う。
+    """
+    # バッチ内の全製品の未処理raw行を数回のクエリでまとめて取得
+    with metrics.stage('raw_fetch'):
+        raw_rows_by_key = load_unprocessed_raw_rows_for_keys(cursor, product_keys)
+    with metrics.stage('state_load'):
+        merge_states = load_merge_states(cursor, product_keys)
 
-        # raw_api_dataテーブルにprocessed_atカラムが存在することを確認し、なければ追加する
-        ensure_processed_at_column_exists(cursor, conn)
-        
-        # 未処理のユニークな (product_id, source_api) の組み合わせを取得
-        select_distinct_sql = """
-            SELECT DISTINCT product_id, source_api
-            FROM raw_api_data
-            WHERE processed_at IS NULL
-            LIMIT 1000 
-        """
-        logger.debug(f"DEBUG SQL: SELECT DISTINCT PRODUCTS TO PROCESS: SQL='{select_distinct_sql}'")
-        cursor.execute(select_distinct_sql)
-        unique_product_ids_to_process = cursor.fetchall()
+    merged_products, raw_ids = merge_product_keys(product_keys, raw_rows_by_key, metrics, merge_states)
+    # スキップされた製品のraw行も処理済みとしてマークする (従来処理と同じ)
+    if processed_marker is not None:
+        processed_marker.add(raw_ids)
+    elif raw_ids:
+        mark_raw_rows_processed(cursor, raw_ids)
 
-        if not unique_product_ids_to_process:
-            logger.info("処理すべきユニークな製品データが見つかりませんでした。")
-            return
+    write_merged_products(cursor, conn, merged_products, category_resolver, link_buffer, metrics)
+    return len(merged_products)
 
-        logger.info(f"raw_api_dataから {len(unique_product_ids_to_process)} 件のユニークな製品IDを処理します。")
 
-        # 各ユニークな製品IDについて処理を実行
-        for product_api_id, source_api_name in unique_product_ids_to_process:
+def retry_bulk_batch_per_product(cursor, conn, product_keys, category_resolver, link_buffer, processed_marker,
+                                 errors=None, metrics=NULL_METRICS) -> int:
+    """
+    失敗したバルクのバッチを1製品ずつ SAVEPOINT 内で処理し直し、まとめて1回コミットする (GroupCommitter と同じ方式)。
+    例外が発生した製品だけをセーブポイントまで取り消すため、不正なデータを含む製品の raw_api_data だけが未処理のまま残り、
+    同じバッチの他の製品は書き込まれる。処理した製品数を返す。
+    """
+    group_committer = GroupCommitter(
+        conn, cursor, category_resolver, link_buffer, processed_marker, commit_every=len(product_keys), metrics=metrics,
+    )
+    products_processed = 0
+    for product_key in product_keys:
+        try:
+            with group_committer.product():
+                products_processed += process_product_keys_bulk(
+                    cursor, conn, [product_key], category_resolver, link_buffer, processed_marker, metrics,
+                )
+        except Exception as e:
+            metrics.incr('products_failed')
+            logger.error("製品ID %s の処理中にエラーが発生しました: %s", product_key[0], e)
+            if errors is not None:
+                errors.append(f"製品ID {product_key[0]}: {e}")
+            continue
+        group_committer.product_done()
+    if not group_committer.commit_pending():
+        # コミットに失敗した場合は全製品が未処理に戻る
+        if errors is not None:
+            errors.append(f"バルク処理の再試行のコミット (先頭の製品ID: {product_keys[0][0]})")
+        return 0
+    return products_processed
+
+def process_key_page(cursor, conn, unique_product_ids_to_process, bulk_size: int, category_resolver, link_buffer, processed_marker,
+                     errors=None, group_committer=None, metrics=NULL_METRICS) -> int:
+    """
+    (product_id, source_api) のリスト1ページ分を処理し、処理した製品数を返す。
+    bulk_size > 0 の場合は bulk_size 件ずつ process_product_keys_bulk でまとめて処理してバッチ単位でコミットし
+    (失敗したバッチは retry_bulk_batch_per_product で1製品ずつ処理し直す)、
+    それ以外は1製品ずつ process_single_product_id_batch で処理し、group_committer (GroupCommitter) の設定に従って
+    1製品ごと、または N製品 / T ミリ秒ごとにまとめてコミットする。
+    エラーが発生したバッチ/製品はロールバックされ、raw_api_data は未処理のまま残る。
+    errors にリストを渡すと、エラーメッセージを追加する。
+    """
+    total_products_processed = 0
+    if bulk_size > 0:
+        # バルクモード: bulk_size 件ずつまとめて処理し、バッチ単位でコミット
+        for product_keys in chunked(unique_product_ids_to_process, bulk_size):
             try:
-                processed_this_product = process_single_product_id_batch(cursor, conn, product_api_id, source_api_name)
-                if processed_this_product:
-                    total_products_processed += processed_this_product
-                conn.commit() # 各製品IDの処理後にコミット
-                logger.info(f"製品ID {product_api_id} の処理とコミットが完了しました。")
+                total_products_processed += process_product_keys_bulk(cursor, conn, product_keys, category_resolver, link_buffer, processed_marker, metrics)
+                with metrics.stage('link_flush'):
+                    link_buffer.flush(cursor)
+                with metrics.stage('mark_processed'):
+                    processed_marker.flush(cursor) # バッチ内のraw行は同じタイムスタンプで1回の UPDATE
+                with metrics.stage('commit'):
+                    conn.commit()
+                category_resolver.on_commit()
+                link_buffer.reset()
+                logger.info("%s 件の製品IDのバルク処理とコミットが完了しました。", len(product_keys))
             except Exception as e:
-                logger.error(f"製品ID {product_api_id} の処理中にエラーが発生しました: {e}")
+                metrics.incr('batches_failed')
                 if conn and conn.is_connected():
                     conn.rollback()
                     logger.warning("トランザクションをロールバックしました。")
+                category_resolver.on_rollback()
+                link_buffer.discard()
+                processed_marker.discard()
+                if len(product_keys) == 1 or not (conn and conn.is_connected()):
+                    logger.error("バルク処理中にエラーが発生しました (先頭の製品ID: %s): %s", product_keys[0][0], e)
+                    if errors is not None:
+                        errors.append(f"バルク処理 (先頭の製品ID: {product_keys[0][0]}): {e}")
+                    # このバッチの raw_api_data は processed_at が更新されないため、次回の実行で再度試行される
+                    continue
+                # 1製品の不正なデータでバッチ全体が失敗し続けないよう、1製品ずつ処理し直して失敗した製品だけを残す
+                logger.warning("バルク処理中にエラーが発生したため、%s 件を1製品ずつ処理し直します (先頭の製品ID: %s): %s",
+                               len(product_keys), product_keys[0][0], e)
+                total_products_processed += retry_bulk_batch_per_product(
+                    cursor, conn, product_keys, category_resolver, link_buffer, processed_marker, errors, metrics,
+                )
+    else:
+        if group_committer is None:
+            group_committer = GroupCommitter(conn, cursor, category_resolver, link_buffer, processed_marker, metrics=metrics)
+
+        # ページ内の全製品の未処理raw行を数回のクエリでまとめて取得しておく
+        with metrics.stage('raw_fetch'):
+            raw_rows_by_key = load_unprocessed_raw_rows_for_keys(cursor, unique_product_ids_to_process)
+        with metrics.stage('state_load'):
+            merge_states = load_merge_states(cursor, unique_product_ids_to_process)
+
+        # 各ユニークな製品IDについて処理を実行
+        for product_api_id, source_api_name in unique_product_ids_to_process:
+            try:
+                # グループコミット時は SAVEPOINT 内で処理し、失敗した製品だけを取り消す
+                with group_committer.product():
+                    processed_this_product = process_single_product_id_batch(
+                        cursor, conn, product_api_id, source_api_name, category_resolver, link_buffer, processed_marker,
+                        preloaded_raw_rows=raw_rows_by_key.get((product_api_id, source_api_name), []), metrics=metrics,
+                        merge_states=merge_states,
+                    )
+            except Exception as e:
+                metrics.incr('products_failed')
+                logger.error("製品ID %s の処理中にエラーが発生しました: %s", product_api_id, e)
+                if errors is not None:
+                    errors.append(f"製品ID {product_api_id}: {e}")
                 # エラーが発生した product_id の raw_api_data は processed_at が更新されないため、次回の実行で再度試行される
+                continue
+            if processed_this_product:
+                total_products_processed += processed_this_product
+            if group_committer.product_done():
+                logger.info("製品ID %s までの処理とコミットが完了しました。", product_api_id)
+        # ページの終わりで未コミットの製品をコミットする (コミットの失敗は group_committer がログに出力する)
+        group_committer.commit_pending()
+    return total_products_processed
+
+def ensure_schema_for_run(cursor, conn, bulk_size: int, drain: bool, lease: bool = False):
+    """メインループの実行に必要なカラム・インデックス・テーブルが存在することを確認し、なければ追加する。"""
+    # raw_api_dataテーブルにprocessed_atカラムが存在することを確認し、なければ追加する
+    ensure_processed_at_column_exists(cursor, conn)
+    ensure_content_hash_column_exists(cursor, conn, DB_CONFIG['database'])
+    ensure_merge_state_table_exists(cursor, conn, DB_CONFIG['database'])
+    if bulk_size > 0:
+        ensure_product_id_unique_key_exists(cursor, conn)
+    if drain or lease:
+        ensure_work_queue_index_exists(cursor, conn, DB_CONFIG['database'])
+    if lease:
+        ensure_work_lease_table_exists(cursor, conn, DB_CONFIG['database'])
+
+def populate_products_and_categories_main_loop(bulk_size: int = 0, link_flush_size: int = DEFAULT_LINK_FLUSH_SIZE,
+                                               drain: bool = False, page_size: int = DEFAULT_PAGE_SIZE, time_budget_seconds=None,
+                                               shard=None, ensure_schema: bool = True,
+                                               commit_every: int = 1, commit_interval_ms=None, link_mode: str = DEFAULT_LINK_MODE,
+                                               lease: bool = False, lease_seconds: int = DEFAULT_LEASE_SECONDS,
+                                               metrics=None) -> dict:
+    """
+    raw_api_data から未処理のユニークな product_id, source_api の組み合わせを取得し、
+    それぞれを process_single_product_id_batch で処理するメインループ。
+    bulk_size > 0 の場合は bulk_size 件ずつ process_product_keys_bulk でまとめて処理し、
+    バッチ単位でコミットする。
+    product_categories への紐付けは link_flush_size 件ごとにまとめて書き込む。link_mode='append' (デフォルト) では
+    従来通り INSERT IGNORE で追加のみ行い、link_mode='sync' では現在の紐付けとの差分だけを追加・削除する。
+    drain=True の場合は未処理キューを (source_api, product_id) のキーセットページングで
+    page_size 件ずつ、キューが空になるか time_budget_seconds に達するまで処理し続ける。
+    shard = (shard_index, shard_count) を指定した場合は、そのシャードに属する product_id だけを処理する。
+    lease=True の場合は product_work_leases でキーのリースを取得しながら page_size 件ずつ処理する (work_lease.py)。
+    複数のホスト・プロセスで同時に実行でき、各ランナーは重ならないキーを処理する。この場合 shard は使わない。
+    bulk_size = 0 のとき、commit_every / commit_interval_ms を指定すると N製品ごと / T ミリ秒ごとにまとめてコミットする
+    (各製品は SAVEPOINT 内で処理される)。
+    処理件数・ページ数・エラーメッセージと、ステージ別の所要時間 (RunMetrics.to_dict()) をまとめた辞書を返す。
+    metrics を省略した場合はこの呼び出し用の RunMetrics を作成する。
+    """
+    conn = None
+    heartbeat = None
+    total_products_processed = 0
+    if metrics is None:
+        metrics = RunMetrics(METRICS_JOB_NAME)
+    summary = {'shard': shard, 'products_processed': 0, 'pages': 0, 'errors': []}
+    try:
+        # 共通プールの接続は autocommit = False (DB_AUTOCOMMIT) で、トランザクションは明示的に管理する
+        conn = get_connection()
+        cursor = conn.cursor()
 
-        logger.info(f"products および categories テーブルへのデータ投入が完了しました。総計 {total_products_processed} 件の製品を処理しました。")
+        # 並列実行時はコーディネーターが事前に一度だけ確認するため、ワーカーでは省略する
+        if ensure_schema:
+            ensure_schema_for_run(cursor, conn, bulk_size, drain, lease)
+
+        # categories を全件メモリに読み込み、以降のカテゴリID解決はキャッシュから行う
+        category_resolver = CategoryResolver()
+        category_resolver.preload(cursor)
+        link_buffer = create_link_writer(link_mode, link_flush_size)
+        processed_marker = RawProcessedMarker()
+        group_committer = GroupCommitter(
+            conn, cursor, category_resolver, link_buffer, processed_marker,
+            commit_every=commit_every, commit_interval_ms=commit_interval_ms, metrics=metrics,
+        )
+
+        if lease:
+            # リースモード: 他のランナーと重ならないキーをリースで取得しながら、取得できるキーがなくなるまで処理する
+            lease_owner = make_lease_owner()
+            summary['lease_owner'] = lease_owner
+            logger.info("リースモードで処理します (owner: %s, リース期間: %s 秒)。", lease_owner, lease_seconds)
+            purge_stale_leases(cursor, conn, lease_seconds)
+            heartbeat = LeaseHeartbeat(lease_owner, lease_seconds).start()
+            key_pages = iter_leased_key_pages(cursor, conn, lease_owner, page_size, lease_seconds, time_budget_seconds)
+        elif drain:
+            # 継続ドレインモード: キーセットページングで未処理キューを最後まで辿る
+            key_pages = iter_unprocessed_key_pages(cursor, page_size, time_budget_seconds, shard=shard)
+        else:
+            # 未処理のユニークな (product_id, source_api) の組み合わせを取得
+            shard_sql, shard_params = shard_condition(shard)
+            select_distinct_sql = f"""
+                SELECT DISTINCT product_id, source_api
+                FROM raw_api_data
+                WHERE processed_at IS NULL{shard_sql}
+                LIMIT 1000
+            """
+            logger.debug("DEBUG SQL: SELECT DISTINCT PRODUCTS TO PROCESS: SQL='%s'", select_distinct_sql)
+            cursor.execute(select_distinct_sql, shard_params)
+            unique_product_ids_to_process = cursor.fetchall()
+            key_pages = [unique_product_ids_to_process] if unique_product_ids_to_process else []
+
+        page_count = 0
+        key_page_iterator = iter(key_pages)
+        while True:
+            # 次ページのキー取得 (ドレインモードではキーセットページングのクエリ) の所要時間を計測する
+            with metrics.stage('key_scan'):
+                unique_product_ids_to_process = next(key_page_iterator, None)
+            if unique_product_ids_to_process is None:
+                break
+            page_count += 1
+            logger.info("raw_api_dataから %s 件のユニークな製品IDを処理します。(ページ %s)", len(unique_product_ids_to_process), page_count)
+            with metrics.stage('page'):
+                page_products_processed = process_key_page(
+                    cursor, conn, unique_product_ids_to_process, bulk_size, category_resolver, link_buffer, processed_marker,
+                    errors=summary['errors'], group_committer=group_committer, metrics=metrics,
+                )
+            total_products_processed += page_products_processed
+            metrics.incr('pages')
+            metrics.incr('products_processed', page_products_processed)
+            summary['products_processed'] = total_products_processed
+            summary['pages'] = page_count
+
+        if page_count == 0:
+            logger.info("処理すべきユニークな製品データが見つかりませんでした。")
+            return summary
+
+        logger.info("products および categories テーブルへのデータ投入が完了しました。総計 %s 件の製品を処理しました。", total_products_processed)
+        logger.info("product_categories 書き込み統計: %s", link_buffer.stats())
+        if bulk_size == 0:
+            logger.info("コミット統計: %s", group_committer.stats())
 
     except mysql.connector.Error as err:
-        logger.error(f"MySQL接続またはクエリ実行エラー: {err}")
+        logger.error("MySQL接続またはクエリ実行エラー: %s", err)
+        summary['errors'].append(f"MySQL接続またはクエリ実行エラー: {err}")
         if conn and conn.is_connected():
             conn.rollback()
             logger.warning("メインループ中にトランザクションをロールバックしました。")
     except Exception as e:
-        logger.error(f"予期せぬエラーが発生しました: {e}")
+        logger.error("予期せぬエラーが発生しました: %s", e)
+        summary['errors'].append(f"予期せぬエラー: {e}")
         if conn and conn.is_connected():
             conn.rollback()
             logger.warning("メインループ中にトランザクションをロールバックしました。")
     finally:
-        if conn and conn.is_connected():
-            cursor.close()
-            conn.close()
-            logger.info("MySQL接続を閉じました。")
+        # ハートビートを止めると、解放できなかったリース (エラーで中断したページ) は期限切れ後に他のランナーが再取得する
+        if heartbeat is not None:
+            heartbeat.stop()
+        if conn is not None:
+            if conn.is_connected():
+                cursor.close()
+            release_connection(conn)
+            logger.info("MySQL接続をプールに返却しました。")
+        metrics.finish()
+        metrics.log_summary(logger)
+        summary['metrics'] = metrics.to_dict()
+    return summary
+
+# ==============================================================================
+# 並列実行 (product_id のハッシュによるシャーディング)
+# ==============================================================================
+
+def run_shard_worker(shard_index: int, shard_count: int, loop_options: dict) -> dict:
+    """
+    ワーカープロセスのエントリポイント。独自のDB接続でメインループを実行し、
+    担当シャードの処理結果をコーディネーターに返す。
+    ログの書き込みスレッドは fork 後の子プロセスに引き継がれないため、
+    ワーカーごとのログファイル (populate_script.shardN.log) で起動し直す。
+    """
+    log_base, log_ext = os.path.splitext(log_file_path)
+    worker_log_listener = setup_queue_logging(logger, f"{log_base}.shard{shard_index}{log_ext}")
+    try:
+        logger.info("ワーカー %s/%s を開始します (PID: %s)。", shard_index + 1, shard_count, os.getpid())
+        # リースモードではキーの分担をリースで行うため、シャードは割り当てない
+        shard = None if loop_options.get('lease') else (shard_index, shard_count)
+        return populate_products_and_categories_main_loop(shard=shard, ensure_schema=False, **loop_options)
+    finally:
+        # ワーカープロセスは atexit を実行せずに終了するため、ここでキューに残ったログを書き出す
+        stop_queue_logging(worker_log_listener)
+
+def run_sharded_main_loop(workers: int, metrics=None, **loop_options) -> list:
+    """
+    未処理キューを product_id のハッシュで workers 個のシャードに分割し、
+    シャードごとに1プロセスでメインループを並列実行するコーディネーター。
+    スキーマの確認は競合を避けるためワーカー起動前に一度だけ行う。
+    各ワーカーの処理件数・エラーを集計してログに出力し、ワーカーごとの結果のリストを返す。
+    metrics (RunMetrics) を渡すと、各ワーカーのステージ別所要時間とカウンタをそこに合算する。
+    """
+    conn = None
+    try:
+        conn = get_connection()
+        cursor = conn.cursor()
+        ensure_schema_for_run(
+            cursor, conn, loop_options.get('bulk_size', 0), loop_options.get('drain', False), loop_options.get('lease', False),
+        )
+    except (mysql.connector.Error, RuntimeError) as err:
+        logger.error("並列実行前のスキーマ確認中にエラーが発生しました: %s", err)
+        return []
+    finally:
+        if conn is not None:
+            if conn.is_connected():
+                cursor.close()
+            release_connection(conn)
+    # ワーカーは fork 後に自身のプールを作成するため、ここで借りた接続は引き継がれない
+
+    summaries = []
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(run_shard_worker, shard_index, workers, loop_options): shard_index
+            for shard_index in range(workers)
+        }
+        for future in as_completed(futures):
+            shard_index = futures[future]
+            try:
+                summary = future.result()
+            except Exception as e:
+                # ワーカープロセス自体が異常終了した場合
+                summary = {'shard': (shard_index, workers), 'products_processed': 0, 'pages': 0, 'errors': [f"ワーカー異常終了: {e}"]}
+            summaries.append(summary)
+            if metrics is not None and summary.get('metrics'):
+                metrics.merge(summary['metrics'])
+            logger.info(
+                f"ワーカー {shard_index + 1}/{workers} 完了: {summary['products_processed']} 件処理, "
+                f"{summary['pages']} ページ, エラー {len(summary['errors'])} 件"
+            )
+            for message in summary['errors'][:10]:
+                logger.warning("  ワーカー %s/%s のエラー: %s", shard_index + 1, workers, message)
+
+    total_processed = sum(summary['products_processed'] for summary in summaries)
+    total_errors = sum(len(summary['errors']) for summary in summaries)
+    logger.info("並列実行が完了しました。%s ワーカーで総計 %s 件の製品を処理しました (エラー %s 件)。", workers, total_processed, total_errors)
+    if metrics is not None:
+        metrics.finish()
+        metrics.log_summary(logger)
+    return summaries
 
 # ==============================================================================
 # メイン処理
 # ==============================================================================
 
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="raw_api_data から products / categories を生成します。")
+    parser.add_argument('--bulk-size', type=int, default=0,
+                        help="N件ずつまとめてバルクUPSERTする (0の場合は従来通り1製品ずつ処理)")
+    parser.add_argument('--link-flush-size', type=int, default=DEFAULT_LINK_FLUSH_SIZE,
+                        help="product_categories への INSERT / DELETE 1回あたりの最大行数")
+    parser.add_argument('--link-mode', choices=LINK_MODES, default=DEFAULT_LINK_MODE,
+                        help="product_categories の書き込み方法 (append: INSERT IGNORE で追加のみ, sync: 現在の紐付けとの差分を追加・削除。"
+                             "他の経路で追加した紐付けも削除される)")
+    parser.add_argument('--drain', action='store_true',
+                        help="未処理キューが空になるまでキーセットページングで処理し続ける")
+    parser.add_argument('--page-size', type=int, default=DEFAULT_PAGE_SIZE,
+                        help="--drain / --lease 時に1ページで取得するユニークな製品IDの数")
+    parser.add_argument('--time-budget', type=float, default=None,
+                        help="--drain / --lease 時の処理時間の上限 (秒)。超えると次のページを取得せずに終了する")
+    parser.add_argument('--lease', action='store_true',
+                        help="product_work_leases でキーのリースを取得しながら処理する (複数ホストで同時に実行できる)")
+    parser.add_argument('--lease-seconds', type=int, default=DEFAULT_LEASE_SECONDS,
+                        help="--lease 時のリースの有効期間 (秒)。処理中は期間の1/3ごとに延長される")
+    parser.add_argument('--commit-every', type=int, default=1,
+                        help="N製品ごとにまとめてコミットする (各製品は SAVEPOINT 内で処理。1の場合は従来通り1製品ごと)")
+    parser.add_argument('--commit-interval-ms', type=int, default=None,
+                        help="前回のコミットから T ミリ秒経過したらコミットする (--commit-every と併用可)")
+    parser.add_argument('--workers', type=int, default=1,
+                        help="product_id のハッシュで未処理キューを分割し、N プロセスで並列処理する (1の場合は従来通り単一プロセス)")
+    parser.add_argument('--metrics-json', default=None,
+                        help="実行終了時にステージ別の所要時間とカウンタを JSON で書き出すファイルパス")
+    parser.add_argument('--metrics-prom', default=None,
+                        help="実行終了時にメトリクスを Prometheus textfile collector 形式 (.prom) で書き出すファイルパス")
+    args = parser.parse_args()
+
     # スクリプト実行前に既存のログファイルをクリア
     try:
         if os.path.exists(log_file_path):
+            # 書き込みスレッドを止めてファイルを閉じてから削除し、新しいファイルで起動し直す
+            stop_queue_logging(log_listener)
             os.remove(log_file_path)
-            # ロガーのハンドラをリセットして、新しいファイルに書き込めるようにする
-            for handler in logger.handlers[:]: # リストをコピーしてイテレート
-                if isinstance(handler, logging.FileHandler):
-                    handler.close()
-                    logger.removeHandler(handler)
-            # ファイルハンドラを再設定
-            new_file_handler = logging.FileHandler(log_file_path, mode='a', encoding='utf-8')
-            new_file_handler.setLevel(logging.DEBUG)
-            new_file_handler.setFormatter(file_formatter)
-            logger.addHandler(new_file_handler)
-            logger.info(f"既存のログファイル '{log_file_path}' をクリアしました。")
+            log_listener = setup_queue_logging(logger, log_file_path)
+            logger.info("既存のログファイル '%s' をクリアしました。", log_file_path)
     except OSError as e:
-        logger.error(f"ログファイルのクリア中にエラーが発生しました: {e}")
+        logger.error("ログファイルのクリア中にエラーが発生しました: %s", e)
 
+    # ダミーデータの確認と本処理は共通プールの同じ接続を使い回す (接続を2回張らない)
     conn_check = None
     try:
-        conn_check = mysql.connector.connect(**DB_CONFIG)
+        conn_check = get_connection()
         cursor_check = conn_check.cursor()
 
         # raw_api_dataテーブルにprocessed_atカラムが存在することを確認し、なければ追加する
@@ -662,15 +1216,40 @@ if __name__ == "__main__":
         else:
             logger.info("raw_api_dataテーブルに処理すべき'duga'データが既に存在します。")
     except Exception as e:
-        logger.error(f"ダミーデータ挿入チェックまたは挿入エラー: {e}")
+        logger.error("ダミーデータ挿入チェックまたは挿入エラー: %s", e)
     finally:
-        if conn_check and conn_check.is_connected():
-            cursor_check.close()
-            conn_check.close()
-            logger.info("MySQL接続を閉じました。(ダミーデータチェック)")
+        if conn_check is not None:
+            if conn_check.is_connected():
+                cursor_check.close()
+            release_connection(conn_check)
+            logger.info("MySQL接続をプールに返却しました。(ダミーデータチェック)")
 
     # products および categories テーブルへのデータ投入を実行
-    populate_products_and_categories_main_loop()
+    loop_options = {
+        'bulk_size': args.bulk_size,
+        'link_flush_size': args.link_flush_size,
+        'link_mode': args.link_mode,
+        'drain': args.drain,
+        'page_size': args.page_size,
+        'time_budget_seconds': args.time_budget,
+        'commit_every': args.commit_every,
+        'commit_interval_ms': args.commit_interval_ms,
+        'lease': args.lease,
+        'lease_seconds': args.lease_seconds,
+    }
+    run_metrics = RunMetrics(METRICS_JOB_NAME)
+    if args.workers > 1:
+        run_sharded_main_loop(args.workers, metrics=run_metrics, **loop_options)
+    else:
+        populate_products_and_categories_main_loop(metrics=run_metrics, **loop_options)
+
+    try:
+        if args.metrics_json:
+            run_metrics.write_json(args.metrics_json)
+        if args.metrics_prom:
+            run_metrics.write_prometheus_textfile(args.metrics_prom)
+    except OSError as e:
+        logger.error("メトリクスの書き出し中にエラーが発生しました: %s", e)
 
 # insert_raw_api_data_dummy 関数は main ブロックでのみ使用される仮の関数です
 def insert_raw_api_data_dummy(conn, item_json_data, source_api_name, product_id_val):
@@ -685,7 +1264,7 @@ def insert_raw_api_data_dummy(conn, item_json_data, source_api_name, product_id_
         INSERT INTO raw_api_data (product_id, api_response_data, source_api, fetched_at, updated_at, processed_at)
         VALUES (%s, %s, %s, %s, %s, NULL)
     """
-    logger.debug(f"DEBUG SQL: INSERT RAW DUMMY: SQL='{insert_query}', Params=(''{product_id_val}'', ''{data_json_str[:100]}...'', ''{source_api_name}'', ''{now}'', ''{now}'')")
+    logger.debug("DEBUG SQL: INSERT RAW DUMMY: SQL='%s', Params=(''%s'', ''%s...'', ''%s'', ''%s'', ''%s'')", insert_query, product_id_val, data_json_str[:100], source_api_name, now, now)
     cursor.execute(insert_query, (product_id_val, data_json_str, source_api_name, now, now))
     conn.commit()
-    logger.info(f"raw_api_data (ダミー) を挿入しました (product_id: {product_id_val}, source_api: {source_api_name})。")
+    logger.info("raw_api_data (ダミー) を挿入しました (product_id: %s, source_api: %s)。", product_id_val, source_api_name)
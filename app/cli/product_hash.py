@@ -0,0 +1,68 @@
+import hashlib
+import json
+import logging
+
+from db_bulk import chunked
+from raw_data import resolve_requested_product_ids
+
+# ==============================================================================
+# 製品データの変更検知
+# = 統合済みの製品フィールドとカテゴリ集合から安定したハッシュを計算して products.content_hash に保存し、
+#   内容が前回と同じ製品の UPDATE と product_categories の書き込みを省略する
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+CONTENT_HASH_COLUMN_NAME = 'content_hash'
+
+
+def compute_product_content_hash(product_fields: dict, category_keys) -> str:
+    """
+    製品フィールドの辞書と (type, name) のカテゴリキーから SHA-256 の16進文字列を返す。
+    キー順・カテゴリの並び順・重複に依存しないよう正規化してからハッシュを取るため、
+    set の反復順序が実行ごとに変わっても同じ内容なら同じ値になる。
+    日付や Decimal は str() で文字列化する。
+    """
+    payload = json.dumps(
+        {'fields': product_fields, 'categories': sorted(set(category_keys))},
+        ensure_ascii=False, sort_keys=True, default=str, separators=(',', ':'),
+    )
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+def ensure_content_hash_column_exists(cursor, conn, database_name: str):
+    """
+    products に content_hash カラムが存在することを確認し、なければ追加する。
+    """
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'products' AND COLUMN_NAME = %s",
+        (database_name, CONTENT_HASH_COLUMN_NAME),
+    )
+    if cursor.fetchone() is None:
+        logger.info("productsテーブルに %s カラムを追加します...", CONTENT_HASH_COLUMN_NAME)
+        cursor.execute(
+            f"ALTER TABLE `products` ADD COLUMN `{CONTENT_HASH_COLUMN_NAME}` CHAR(64) NULL "
+            "COMMENT '統合済みの製品フィールドとカテゴリ集合のSHA-256 (変更検知用)'"
+        )
+        conn.commit()
+        logger.info("%s カラムが正常に追加されました。", CONTENT_HASH_COLUMN_NAME)
+
+
+def fetch_product_hashes(cursor, product_ids, chunk_size: int = 1000) -> dict:
+    """
+    products.product_id のリストから {product_id: (id, content_hash)} を IN (...) クエリでまとめて取得する。
+    存在しない製品は辞書に含まれない。
+    照合順序が大文字小文字などを区別しないため、返った行は要求した product_id の側に対応づける。
+    """
+    product_hashes = {}
+    for chunk in chunked(dict.fromkeys(product_ids), chunk_size):
+        placeholders = ", ".join(["%s"] * len(chunk))
+        cursor.execute(
+            f"SELECT product_id, id, content_hash FROM products WHERE product_id IN ({placeholders})",
+            chunk,
+        )
+        rows = cursor.fetchall()
+        requested_by_returned = resolve_requested_product_ids(cursor, chunk, [product_id for product_id, _, _ in rows])
+        for product_id, product_db_id, content_hash in rows:
+            product_hashes[requested_by_returned.get(product_id, product_id)] = (product_db_id, content_hash)
+    return product_hashes
@@ -0,0 +1,356 @@
+import logging
+import time
+import zlib
+from datetime import datetime
+
+from db_bulk import chunked
+
+# ==============================================================================
+# raw_api_data 操作ヘルパー
+# = 処理済みマーク (processed_at) の一括更新、未処理キューの走査など
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+# この件数までは WHERE id IN (...) の1ステートメントで更新し、
+# 超える場合は一時テーブル経由の UPDATE ... JOIN で更新する
+IN_LIST_MAX_IDS = 5000
+# 一時テーブルへIDを投入する際の1ステートメントあたりの行数
+TEMP_TABLE_INSERT_CHUNK_SIZE = 5000
+
+
+def mark_raw_rows_processed(cursor, raw_ids, processed_at=None) -> int:
+    """
+    raw_api_data の指定IDに processed_at をまとめて設定し、更新行数を返す。
+    全ての行に同じタイムスタンプ (processed_at、省略時は現在時刻) を設定する。
+    件数が多い場合は一時テーブルにIDを投入してから JOIN で1回の UPDATE を行う。
+    """
+    unique_ids = list(dict.fromkeys(raw_ids))
+    if not unique_ids:
+        return 0
+    if processed_at is None:
+        processed_at = datetime.now()
+
+    if len(unique_ids) <= IN_LIST_MAX_IDS:
+        placeholders = ", ".join(["%s"] * len(unique_ids))
+        cursor.execute(
+            f"UPDATE raw_api_data SET processed_at = %s WHERE id IN ({placeholders})",
+            [processed_at] + unique_ids,
+        )
+        return cursor.rowcount
+
+    # 大量のIDは一時テーブル経由で更新する (一時テーブルの作成は暗黙のコミットを発生させない)
+    cursor.execute("CREATE TEMPORARY TABLE IF NOT EXISTS tmp_processed_raw_ids (id INT NOT NULL PRIMARY KEY) ENGINE=MEMORY")
+    cursor.execute("DELETE FROM tmp_processed_raw_ids")
+    for chunk in chunked(unique_ids, TEMP_TABLE_INSERT_CHUNK_SIZE):
+        placeholders = ", ".join(["(%s)"] * len(chunk))
+        cursor.execute(f"INSERT IGNORE INTO tmp_processed_raw_ids (id) VALUES {placeholders}", chunk)
+    cursor.execute(
+        "UPDATE raw_api_data r JOIN tmp_processed_raw_ids t ON r.id = t.id SET r.processed_at = %s",
+        (processed_at,),
+    )
+    updated_rows = cursor.rowcount
+    cursor.execute("DELETE FROM tmp_processed_raw_ids")
+    logger.debug("一時テーブル経由で raw_api_data %d 件に processed_at を設定しました。", updated_rows)
+    return updated_rows
+
+
+class RawProcessedMarker:
+    """
+    1コミット分の raw_api_data.id を集め、コミット直前に
+    mark_raw_rows_processed でまとめて processed_at を設定するクラス。
+    同じコミットに含まれる行は全て同じタイムスタンプになる。
+    """
+
+    def __init__(self):
+        self._raw_ids = []
+        self.rows_marked = 0
+        self.statements_executed = 0
+
+    def __len__(self):
+        return len(self._raw_ids)
+
+    def add(self, raw_ids):
+        """処理済みにする raw_api_data.id を追加する。"""
+        self._raw_ids.extend(raw_ids)
+
+    def flush(self, cursor, processed_at=None) -> int:
+        """集めたIDに processed_at を設定し、更新行数を返す。"""
+        if not self._raw_ids:
+            return 0
+        updated_rows = mark_raw_rows_processed(cursor, self._raw_ids, processed_at)
+        self.rows_marked += updated_rows
+        self.statements_executed += 1
+        self._raw_ids = []
+        return updated_rows
+
+    def discard(self):
+        """ロールバック後に呼ぶ。未反映のIDを破棄する。"""
+        self._raw_ids = []
+
+    def mark(self):
+        """セーブポイントの作成時に呼び、rollback_to() に渡す位置を返す。"""
+        return (self._raw_ids, len(self._raw_ids))
+
+    def rollback_to(self, mark):
+        """ROLLBACK TO SAVEPOINT の後に呼び、セーブポイント以降に追加したIDを除く。"""
+        raw_ids, length = mark
+        self._raw_ids = raw_ids[:length]
+
+
+# ==============================================================================
+# 未処理キューのキーセットページング
+# ==============================================================================
+
+# (processed_at, source_api, product_id) の複合インデックス。
+# processed_at IS NULL を等価条件として、(source_api, product_id) 順に範囲スキャンできる。
+WORK_QUEUE_INDEX_NAME = 'idx_raw_processed_source_product'
+# (processed_at, fetched_at) の複合インデックス。未処理キューの最古の fetched_at (取り込みの遅れ) を
+# インデックスの先頭1件の参照だけで求めるために使う (pipeline_status.py)。
+BACKLOG_AGE_INDEX_NAME = 'idx_raw_processed_fetched'
+DEFAULT_PAGE_SIZE = 1000
+
+
+def shard_condition(shard) -> tuple:
+    """
+    shard = (shard_index, shard_count) に対応する WHERE 句の追加条件とパラメータを返す。
+    product_id のハッシュ (CRC32) で分割するため、同じ product_id は常に同じシャードに属し、
+    シャード間で products の行や product_categories の紐付けが重複しない。
+    照合順序が大文字小文字を区別しないため、LOWER() してからハッシュを取る。
+    shard が None の場合は条件なし。
+    """
+    if shard is None:
+        return "", ()
+    shard_index, shard_count = shard
+    return " AND MOD(CRC32(LOWER(product_id)), %s) = %s", (shard_count, shard_index)
+
+
+def ensure_work_queue_index_exists(cursor, conn, database_name: str):
+    """
+    raw_api_data にキーセットページング用の複合インデックスが存在することを確認し、なければ追加する。
+    """
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'raw_api_data' AND INDEX_NAME = %s LIMIT 1",
+        (database_name, WORK_QUEUE_INDEX_NAME),
+    )
+    if cursor.fetchone() is None:
+        logger.info("raw_api_dataテーブルに %s インデックスを追加します...", WORK_QUEUE_INDEX_NAME)
+        cursor.execute(
+            f"ALTER TABLE `raw_api_data` ADD INDEX `{WORK_QUEUE_INDEX_NAME}` (`processed_at`, `source_api`, `product_id`)"
+        )
+        conn.commit()
+        logger.info("%s インデックスが正常に追加されました。", WORK_QUEUE_INDEX_NAME)
+
+
+def ensure_backlog_age_index_exists(cursor, conn, database_name: str):
+    """
+    raw_api_data に未処理キューの最古の fetched_at を求めるための複合インデックスが存在することを確認し、なければ追加する。
+    """
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.STATISTICS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'raw_api_data' AND INDEX_NAME = %s LIMIT 1",
+        (database_name, BACKLOG_AGE_INDEX_NAME),
+    )
+    if cursor.fetchone() is None:
+        logger.info("raw_api_dataテーブルに %s インデックスを追加します...", BACKLOG_AGE_INDEX_NAME)
+        cursor.execute(
+            f"ALTER TABLE `raw_api_data` ADD INDEX `{BACKLOG_AGE_INDEX_NAME}` (`processed_at`, `fetched_at`)"
+        )
+        conn.commit()
+        logger.info("%s インデックスが正常に追加されました。", BACKLOG_AGE_INDEX_NAME)
+
+
+def fetch_unprocessed_key_page(cursor, after_key=None, page_size: int = DEFAULT_PAGE_SIZE, shard=None) -> list:
+    """
+    after_key = (source_api, product_id) より後ろにある未処理の (product_id, source_api) を
+    (source_api, product_id) 順に最大 page_size 件返す。
+    shard = (shard_index, shard_count) を指定した場合はそのシャードのキーだけを返す。
+    """
+    shard_sql, shard_params = shard_condition(shard)
+    if after_key is None:
+        cursor.execute(f"""
+            SELECT DISTINCT product_id, source_api
+            FROM raw_api_data
+            WHERE processed_at IS NULL{shard_sql}
+            ORDER BY source_api, product_id
+            LIMIT %s
+        """, shard_params + (page_size,))
+    else:
+        last_source_api, last_product_id = after_key
+        cursor.execute(f"""
+            SELECT DISTINCT product_id, source_api
+            FROM raw_api_data
+            WHERE processed_at IS NULL
+              AND (source_api > %s OR (source_api = %s AND product_id > %s)){shard_sql}
+            ORDER BY source_api, product_id
+            LIMIT %s
+        """, (last_source_api, last_source_api, last_product_id) + shard_params + (page_size,))
+    return cursor.fetchall()
+
+
+def iter_unprocessed_key_pages(cursor, page_size: int = DEFAULT_PAGE_SIZE, time_budget_seconds=None, after_key=None, shard=None):
+    """
+    未処理キューをキーセットページングで先頭から末尾まで辿り、
+    (product_id, source_api) のリストをページ単位で返すジェネレータ。
+    処理に失敗して未処理のまま残ったキーは同じ実行内では再取得しない。
+    time_budget_seconds を超えた時点で次のページを取得せずに終了する。
+    shard を指定した場合はそのシャードのキーだけを辿る。
+    """
+    started = time.monotonic()
+    while True:
+        if time_budget_seconds is not None and time.monotonic() - started >= time_budget_seconds:
+            logger.info("時間予算 (%s 秒) に達したため、未処理キューの走査を終了します。", time_budget_seconds)
+            return
+        page = fetch_unprocessed_key_page(cursor, after_key, page_size, shard)
+        if not page:
+            return
+        yield page
+        last_product_id, last_source_api = page[-1]
+        after_key = (last_source_api, last_product_id)
+
+
+# ==============================================================================
+# 未処理raw行のページ単位一括取得
+# ==============================================================================
+
+# 1クエリで IN (...) に渡す product_id の最大数
+RAW_LOAD_CHUNK_SIZE = 500
+
+
+def product_id_collation_key(product_api_id: str) -> str:
+    """
+    照合順序 (utf8mb4_unicode_ci) で同じ値とみなされる product_id を Python 側でそろえるためのキー。
+    大文字小文字と末尾の空白 (PAD SPACE) を区別しない。
+    """
+    return product_api_id.casefold().rstrip(' ')
+
+
+def resolve_requested_product_ids(cursor, requested_ids, returned_ids) -> dict:
+    """
+    IN (...) などの照合で返った product_id を、それに一致した要求側の product_id に対応づけて {返った値: 要求した値} で返す。
+    大文字小文字と末尾の空白の違いは product_id_collation_key で Python 側で対応づけ、
+    それ以外 (アクセントやかなの違いなど) で一致した値だけを、要求した値の一覧と DB の照合順序で比べて対応づける。
+    どの要求とも一致しない値 (通常は発生しない) は対応に含めない。
+    """
+    requested_ids = list(dict.fromkeys(requested_ids))
+    requested_by_key = {}
+    for product_api_id in requested_ids:
+        requested_by_key.setdefault(product_id_collation_key(product_api_id), product_api_id)
+
+    resolved = {}
+    unresolved = []
+    for product_api_id in dict.fromkeys(returned_ids):
+        requested_id = requested_by_key.get(product_id_collation_key(product_api_id))
+        if requested_id is not None:
+            resolved[product_api_id] = requested_id
+        else:
+            unresolved.append(product_api_id)
+    if not unresolved or not requested_ids:
+        return resolved
+
+    # 要求した値の一覧を派生テーブルにして、返った値ごとに照合順序で等しいものを MySQL に選ばせる
+    requested_table = " UNION ALL ".join(["SELECT CONVERT(%s USING utf8mb4) AS requested_id"] * len(requested_ids))
+    for product_api_id in unresolved:
+        cursor.execute(f"""
+            SELECT k.requested_id
+            FROM ({requested_table}) k
+            WHERE k.requested_id COLLATE utf8mb4_unicode_ci = CONVERT(%s USING utf8mb4) COLLATE utf8mb4_unicode_ci
+            LIMIT 1
+        """, requested_ids + [product_api_id])
+        row = cursor.fetchone()
+        if row is not None:
+            resolved[product_api_id] = row[0]
+    return resolved
+
+
+def load_unprocessed_raw_rows_for_keys(cursor, product_keys, chunk_size: int = RAW_LOAD_CHUNK_SIZE) -> dict:
+    """
+    (product_id, source_api) のリストに対応する未処理のraw_api_data行をまとめて取得し、
+    {(product_id, source_api): [(id, api_response_data, fetched_at), ...]} の辞書で返す。
+    各リストは fetched_at DESC, id DESC 順 (製品単位の SELECT と同じ順序) に並ぶ。
+    source_api ごとに product_id IN (...) のクエリを発行するため、1ページ分でも数回のクエリで済む。
+    照合順序が大文字小文字を区別しないため、IN ('abc') は 'ABC' で保存された行も返す。
+    製品単位の SELECT と同じくそれらの行も処理できるよう、返った行は要求したキーの側にまとめる
+    (アクセントやかなの違いで一致した行も resolve_requested_product_ids で要求したキーに対応づけるため、
+    返った行が処理されずに残り続けることはない)。
+    """
+    product_ids_by_source = {}
+    for product_api_id, source_api_name in product_keys:
+        product_ids_by_source.setdefault(source_api_name, []).append(product_api_id)
+
+    raw_rows_by_key = {tuple(key): [] for key in product_keys}
+    for source_api_name, product_ids in product_ids_by_source.items():
+        for chunk in chunked(list(dict.fromkeys(product_ids)), chunk_size):
+            placeholders = ", ".join(["%s"] * len(chunk))
+            cursor.execute(f"""
+                SELECT id, api_response_data, fetched_at, product_id
+                FROM raw_api_data
+                WHERE source_api = %s AND product_id IN ({placeholders}) AND processed_at IS NULL
+                ORDER BY fetched_at DESC, id DESC
+            """, [source_api_name] + chunk)
+            rows = cursor.fetchall()
+            requested_by_returned = resolve_requested_product_ids(
+                cursor, chunk, [product_api_id for product_api_id in dict.fromkeys(row[3] for row in rows) if (product_api_id, source_api_name) not in raw_rows_by_key],
+            )
+            for raw_id, api_response_data, fetched_at, product_api_id in rows:
+                if (product_api_id, source_api_name) not in raw_rows_by_key:
+                    requested_id = requested_by_returned.get(product_api_id)
+                    if requested_id is not None:
+                        product_api_id = requested_id
+                    else:
+                        logger.warning("要求したどの product_id とも対応づけられない raw 行が返されました: %s (source: %s)", product_api_id, source_api_name)
+                raw_rows_by_key.setdefault((product_api_id, source_api_name), []).append((raw_id, api_response_data, fetched_at))
+    return raw_rows_by_key
+
+
+# ==============================================================================
+# 古いスナップショットの圧縮保存
+# ==============================================================================
+
+# zlib 圧縮した api_response_data を格納するカラム。
+# 圧縮した行は api_response_data を JSON の null にし、元の JSON 文字列はこのカラムにだけ保持する。
+# 圧縮するのは処理済み (processed_at IS NOT NULL) の古いスナップショットだけなので、
+# 未処理キューを読む populate / classify の処理には影響しない。
+PAYLOAD_ZLIB_COLUMN_NAME = 'api_response_data_zlib'
+PAYLOAD_ZLIB_LEVEL = 6
+
+
+def payload_zlib_column_exists(cursor, database_name: str) -> bool:
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_SCHEMA = %s AND TABLE_NAME = 'raw_api_data' AND COLUMN_NAME = %s",
+        (database_name, PAYLOAD_ZLIB_COLUMN_NAME),
+    )
+    return cursor.fetchone() is not None
+
+
+def ensure_payload_zlib_column_exists(cursor, conn, database_name: str):
+    """
+    raw_api_data に圧縮ペイロード用のカラムが存在することを確認し、なければ追加する。
+    (末尾への NULL 許容カラムの追加は MySQL 8.0 では INSTANT で行われ、テーブルの再構築は発生しない)
+    """
+    if not payload_zlib_column_exists(cursor, database_name):
+        logger.info("raw_api_dataテーブルに %s カラムを追加します...", PAYLOAD_ZLIB_COLUMN_NAME)
+        cursor.execute(
+            f"ALTER TABLE `raw_api_data` ADD COLUMN `{PAYLOAD_ZLIB_COLUMN_NAME}` LONGBLOB NULL "
+            "COMMENT 'zlib圧縮した api_response_data (圧縮済みの行は api_response_data が JSON の null)'"
+        )
+        conn.commit()
+        logger.info("%s カラムが正常に追加されました。", PAYLOAD_ZLIB_COLUMN_NAME)
+
+
+def compress_payload(api_response_data) -> bytes:
+    """api_response_data (JSON文字列) を zlib 圧縮する。"""
+    if isinstance(api_response_data, str):
+        api_response_data = api_response_data.encode('utf-8')
+    return zlib.compress(api_response_data, PAYLOAD_ZLIB_LEVEL)
+
+
+def read_raw_payload(api_response_data, api_response_data_zlib=None):
+    """
+    raw_api_data の行から元の JSON 文字列を返す。
+    圧縮済みの行 (api_response_data_zlib が NULL でない行) は展開して返す。
+    """
+    if api_response_data_zlib is not None:
+        return zlib.decompress(api_response_data_zlib).decode('utf-8')
+    if isinstance(api_response_data, (bytes, bytearray)):
+        return api_response_data.decode('utf-8')
+    return api_response_data
@@ -0,0 +1,186 @@
+import json
+import logging
+import os
+import signal
+import time
+import uuid
+from datetime import datetime
+
+from json_codec import loads
+
+# ==============================================================================
+# 長時間実行ジョブのチェックポイントと安全な停止
+# = load_data_backfill.py のような長時間のバックフィルがデプロイや OOM で止められても、
+#   次の実行が途中から再開できるよう、実行ID・キーセットの位置 (最後に反映したキー)・累計カウンタを
+#   run_checkpoints テーブルに保存する。チェックポイントはチャンクの反映と同じトランザクションで保存するため、
+#   コミット済みのチャンクと位置が食い違うことはない。
+#
+#   GracefulStop は SIGTERM / SIGINT を受け取ると停止要求のフラグを立てるだけで、処理中のチャンクは
+#   最後まで反映・コミットしてから終了できる。2回目のシグナルでは通常どおり即座に終了する。
+#   time_budget_seconds を指定すると、経過時間が予算に達した時点でも同じように停止を要求する。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_TABLE = 'run_checkpoints'
+
+STATUS_RUNNING = 'running'
+STATUS_STOPPED = 'stopped'
+STATUS_FAILED = 'failed'
+STATUS_COMPLETED = 'completed'
+# 再開の対象になる状態 (running のまま残っているのは異常終了した実行)
+RESUMABLE_STATUSES = (STATUS_RUNNING, STATUS_STOPPED, STATUS_FAILED)
+
+CREATE_CHECKPOINT_TABLE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS `{CHECKPOINT_TABLE}` (
+        `run_id` VARCHAR(64) NOT NULL COMMENT '実行ID (再開した実行も同じIDを引き継ぐ)',
+        `job_name` VARCHAR(64) NOT NULL COMMENT 'ジョブ名 (load_data_backfill など)',
+        `status` VARCHAR(20) NOT NULL COMMENT 'running / stopped / failed / completed',
+        `last_source_api` VARCHAR(50) NULL COMMENT 'キーセットの位置: 最後に反映したキーの source_api',
+        `last_product_id` VARCHAR(255) NULL COMMENT 'キーセットの位置: 最後に反映したキーの product_id',
+        `counters_json` JSON NULL COMMENT '実行全体の累計カウンタ',
+        `started_at` DATETIME NOT NULL COMMENT '最初の実行の開始日時',
+        `updated_at` DATETIME NOT NULL COMMENT 'チェックポイントの最終更新日時',
+        PRIMARY KEY (`run_id`),
+        INDEX `idx_run_checkpoints_job_status` (`job_name`, `status`, `updated_at`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='長時間実行ジョブの再開用チェックポイント'
+"""
+
+
+def ensure_checkpoint_table_exists(cursor, conn, database_name: str):
+    """run_checkpoints テーブルが存在することを確認し、なければ作成する。"""
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+        (database_name, CHECKPOINT_TABLE),
+    )
+    if cursor.fetchone() is None:
+        logger.info("%s テーブルを作成します...", CHECKPOINT_TABLE)
+        cursor.execute(CREATE_CHECKPOINT_TABLE_SQL)
+        conn.commit()
+        logger.info("%s テーブルが正常に作成されました。", CHECKPOINT_TABLE)
+
+
+class RunCheckpoint:
+    """1回の (再開を含む) 実行のチェックポイント。after_key は (source_api, product_id)。"""
+
+    def __init__(self, run_id: str, job_name: str, after_key=None, counters=None, started_at=None, resumed: bool = False):
+        self.run_id = run_id
+        self.job_name = job_name
+        self.after_key = after_key
+        self.counters = dict(counters or {})
+        self.started_at = started_at or datetime.now()
+        self.resumed = resumed
+
+    def incr(self, name: str, amount: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + amount
+
+
+def make_run_id(job_name: str) -> str:
+    """ジョブ名・開始日時・乱数からなる実行IDを返す。"""
+    return f"{job_name}-{datetime.now().strftime('%Y%m%d%H%M%S')}-{uuid.uuid4().hex[:6]}"
+
+
+def load_resumable_checkpoint(cursor, job_name: str):
+    """job_name の実行のうち完了していない最新のチェックポイントを返す。なければ None を返す。"""
+    placeholders = ", ".join(["%s"] * len(RESUMABLE_STATUSES))
+    cursor.execute(f"""
+        SELECT run_id, last_source_api, last_product_id, counters_json, started_at
+        FROM `{CHECKPOINT_TABLE}`
+        WHERE job_name = %s AND status IN ({placeholders})
+        ORDER BY updated_at DESC
+        LIMIT 1
+    """, (job_name,) + RESUMABLE_STATUSES)
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    run_id, last_source_api, last_product_id, counters_json, started_at = row
+    after_key = (last_source_api, last_product_id) if last_source_api is not None else None
+    counters = loads(counters_json) if counters_json is not None else {}
+    return RunCheckpoint(run_id, job_name, after_key, counters, started_at, resumed=True)
+
+
+def start_run(cursor, conn, job_name: str, resume: bool = True) -> RunCheckpoint:
+    """
+    resume=True の場合は完了していない最新の実行を再開し、なければ新しい実行を開始する。
+    resume=False の場合、完了していない実行は failed として閉じてから新しい実行を開始する。
+    どちらの場合もチェックポイントを running にしてコミットする。
+    """
+    checkpoint = load_resumable_checkpoint(cursor, job_name)
+    if checkpoint is not None and not resume:
+        logger.info("完了していない実行 %s を再開せずに破棄します。", checkpoint.run_id)
+        update_run_status(cursor, checkpoint, STATUS_FAILED)
+        checkpoint = None
+    if checkpoint is None:
+        checkpoint = RunCheckpoint(make_run_id(job_name), job_name)
+        logger.info("新しい実行 %s を開始します。", checkpoint.run_id)
+    else:
+        logger.info("実行 %s をキー %s の続きから再開します (累計: %s)。", checkpoint.run_id, checkpoint.after_key, checkpoint.counters)
+    save_checkpoint(cursor, checkpoint, STATUS_RUNNING)
+    conn.commit()
+    return checkpoint
+
+
+def save_checkpoint(cursor, checkpoint: RunCheckpoint, status: str = STATUS_RUNNING):
+    """チェックポイントを UPSERT する。チャンクの反映と同じトランザクションで呼び出し、コミットは呼び出し元で行う。"""
+    last_source_api, last_product_id = checkpoint.after_key if checkpoint.after_key is not None else (None, None)
+    cursor.execute(f"""
+        INSERT INTO `{CHECKPOINT_TABLE}`
+            (run_id, job_name, status, last_source_api, last_product_id, counters_json, started_at, updated_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        ON DUPLICATE KEY UPDATE
+            status = VALUES(status), last_source_api = VALUES(last_source_api), last_product_id = VALUES(last_product_id),
+            counters_json = VALUES(counters_json), updated_at = VALUES(updated_at)
+    """, (
+        checkpoint.run_id, checkpoint.job_name, status, last_source_api, last_product_id,
+        json.dumps(checkpoint.counters, ensure_ascii=False), checkpoint.started_at, datetime.now(),
+    ))
+
+
+def update_run_status(cursor, checkpoint: RunCheckpoint, status: str):
+    """位置とカウンタは変えずに実行の状態だけを更新する。コミットは呼び出し元で行う。"""
+    cursor.execute(
+        f"UPDATE `{CHECKPOINT_TABLE}` SET status = %s, updated_at = %s WHERE run_id = %s",
+        (status, datetime.now(), checkpoint.run_id),
+    )
+
+
+class GracefulStop:
+    """
+    SIGTERM / SIGINT と時間予算による停止要求を管理するクラス。
+    install() でシグナルハンドラを登録し (メインスレッドから呼ぶこと)、restore() で元に戻す。
+    処理側は区切りのよいところで requested() を確認し、True なら手元のバッファを反映・コミットしてから終了する。
+    """
+
+    SIGNALS = (signal.SIGTERM, signal.SIGINT)
+
+    def __init__(self, time_budget_seconds=None):
+        self.time_budget_seconds = time_budget_seconds
+        self.reason = None
+        self._started = time.monotonic()
+        self._previous_handlers = {}
+
+    def install(self):
+        for signum in self.SIGNALS:
+            self._previous_handlers[signum] = signal.signal(signum, self._handle_signal)
+        return self
+
+    def restore(self):
+        for signum, handler in self._previous_handlers.items():
+            signal.signal(signum, handler)
+        self._previous_handlers = {}
+
+    def _handle_signal(self, signum, frame):
+        if self.reason is not None and self.reason.startswith('signal'):
+            # 2回目のシグナルでは待たずに終了する (未コミットのチャンクはロールバックされ、最後のチェックポイントから再開する)
+            logger.warning("シグナル %s を再度受け取ったため、即座に終了します。", signum)
+            self.restore()
+            os.kill(os.getpid(), signum)
+            return
+        self.reason = f"signal {signal.Signals(signum).name}"
+        logger.warning("シグナル %s を受け取りました。処理中のチャンクを反映・コミットしてから終了します。", signal.Signals(signum).name)
+
+    def requested(self) -> bool:
+        if self.reason is None and self.time_budget_seconds is not None and time.monotonic() - self._started >= self.time_budget_seconds:
+            self.reason = 'time budget'
+            logger.info("時間予算 (%s 秒) に達しました。処理中のチャンクを反映・コミットしてから終了します。", self.time_budget_seconds)
+        return self.reason is not None
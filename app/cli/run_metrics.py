@@ -0,0 +1,222 @@
+import bisect
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+# ==============================================================================
+# 実行メトリクス
+# = 処理ステージごとの所要時間ヒストグラムと件数カウンタを集計し、
+#   実行終了時に JSON と Prometheus の textfile collector 形式 (.prom) で書き出す。
+#   ヒストグラムは固定バケットで集計するため、製品数に関わらずメモリ使用量は一定。
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+# ヒストグラムのバケット上限 (秒)。50µs から 10秒まで
+DEFAULT_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01,
+    0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class StageHistogram:
+    """1ステージ分の所要時間ヒストグラム。"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.bucket_counts = [0] * (len(self.buckets) + 1) # 最後は +Inf
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds: float):
+        self.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q: float) -> float:
+        """バケット内を線形補間して分位点 (秒) を推定する。"""
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        cumulative = 0
+        for index, bucket_count in enumerate(self.bucket_counts):
+            if cumulative + bucket_count >= rank and bucket_count > 0:
+                lower = self.buckets[index - 1] if index > 0 else 0.0
+                upper = self.buckets[index] if index < len(self.buckets) else self.max
+                return lower + (upper - lower) * (rank - cumulative) / bucket_count
+            cumulative += bucket_count
+        return self.max
+
+    def merge(self, data: dict):
+        """to_dict() の結果を加算する (並列実行時にワーカーの結果をまとめるため)。"""
+        for index, bucket_count in enumerate(data['bucket_counts']):
+            self.bucket_counts[index] += bucket_count
+        self.count += data['count']
+        self.sum += data['sum_seconds']
+        self.max = max(self.max, data['max_seconds'])
+
+    def to_dict(self) -> dict:
+        return {
+            'count': self.count,
+            'sum_seconds': self.sum,
+            'max_seconds': self.max,
+            'p50_seconds': self.quantile(0.5),
+            'p95_seconds': self.quantile(0.95),
+            'p99_seconds': self.quantile(0.99),
+            'buckets': list(self.buckets),
+            'bucket_counts': list(self.bucket_counts),
+        }
+
+
+class RunMetrics:
+    """
+    1回の実行分のステージ別所要時間とカウンタを集計するクラス。
+    with metrics.stage('merge'): ... で所要時間を計測し、metrics.incr('products_inserted') で件数を数える。
+    パイプライン実行 (pipelined_populate.py) では複数のスレッドから記録されるため、更新はロックで保護する。
+    """
+
+    def __init__(self, job_name: str):
+        self.job_name = job_name
+        self.started_at = datetime.now()
+        self._started = time.monotonic()
+        self.finished_at = None
+        self.wall_seconds = None
+        self.counters = {}
+        self.stages = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started)
+
+    def observe(self, name: str, seconds: float):
+        with self._lock:
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = StageHistogram()
+            histogram.observe(seconds)
+
+    def incr(self, name: str, value: int = 1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def finish(self):
+        """実行の終了時刻と経過時間を確定する。"""
+        self.finished_at = datetime.now()
+        self.wall_seconds = time.monotonic() - self._started
+
+    def merge(self, data: dict):
+        """別プロセスの to_dict() の結果をカウンタとヒストグラムに加算する。"""
+        for name, value in data['counters'].items():
+            self.incr(name, value)
+        for name, stage_data in data['stages'].items():
+            histogram = self.stages.get(name)
+            if histogram is None:
+                histogram = self.stages[name] = StageHistogram(stage_data['buckets'])
+            histogram.merge(stage_data)
+
+    def to_dict(self) -> dict:
+        wall_seconds = self.wall_seconds if self.wall_seconds is not None else time.monotonic() - self._started
+        products = self.counters.get('products_processed', 0)
+        return {
+            'job': self.job_name,
+            'started_at': self.started_at.isoformat(timespec='seconds'),
+            'finished_at': self.finished_at.isoformat(timespec='seconds') if self.finished_at else None,
+            'wall_seconds': wall_seconds,
+            'products_per_second': products / wall_seconds if wall_seconds > 0 else 0.0,
+            'counters': dict(self.counters),
+            'stages': {name: histogram.to_dict() for name, histogram in self.stages.items()},
+        }
+
+    def write_json(self, path: str):
+        """集計結果を JSON ファイルに書き出す。"""
+        _write_atomically(path, json.dumps(self.to_dict(), ensure_ascii=False, indent=2))
+        logger.info("メトリクスを JSON で書き出しました: %s", path)
+
+    def write_prometheus_textfile(self, path: str):
+        """
+        集計結果を Prometheus の textfile collector 形式で書き出す。
+        node_exporter が書き込み途中のファイルを読まないよう、一時ファイルに書いてからリネームする。
+        """
+        _write_atomically(path, self.to_prometheus_text())
+        logger.info("メトリクスを Prometheus textfile 形式で書き出しました: %s", path)
+
+    def to_prometheus_text(self) -> str:
+        data = self.to_dict()
+        prefix = self.job_name
+        lines = [
+            f"# HELP {prefix}_run_wall_seconds 直近の実行の所要時間",
+            f"# TYPE {prefix}_run_wall_seconds gauge",
+            f"{prefix}_run_wall_seconds {data['wall_seconds']:.6f}",
+            f"# HELP {prefix}_run_finished_timestamp_seconds 直近の実行の終了時刻 (UNIX時間)",
+            f"# TYPE {prefix}_run_finished_timestamp_seconds gauge",
+            f"{prefix}_run_finished_timestamp_seconds {time.time():.0f}",
+            f"# HELP {prefix}_run_products_per_second 直近の実行のスループット (製品/秒)",
+            f"# TYPE {prefix}_run_products_per_second gauge",
+            f"{prefix}_run_products_per_second {data['products_per_second']:.3f}",
+            f"# HELP {prefix}_run_count 直近の実行のカウンタ値",
+            f"# TYPE {prefix}_run_count gauge",
+        ]
+        for name, value in sorted(data['counters'].items()):
+            lines.append(f'{prefix}_run_count{{counter="{name}"}} {value}')
+
+        lines.append(f"# HELP {prefix}_stage_duration_seconds 直近の実行のステージ別所要時間")
+        lines.append(f"# TYPE {prefix}_stage_duration_seconds histogram")
+        for name, histogram in sorted(self.stages.items()):
+            labels = f'stage="{name}"'
+            cumulative = 0
+            for upper, bucket_count in zip(histogram.buckets, histogram.bucket_counts):
+                cumulative += bucket_count
+                lines.append(f'{prefix}_stage_duration_seconds_bucket{{{labels},le="{upper:g}"}} {cumulative}')
+            lines.append(f'{prefix}_stage_duration_seconds_bucket{{{labels},le="+Inf"}} {histogram.count}')
+            lines.append(f'{prefix}_stage_duration_seconds_sum{{{labels}}} {histogram.sum:.6f}')
+            lines.append(f'{prefix}_stage_duration_seconds_count{{{labels}}} {histogram.count}')
+        return "\n".join(lines) + "\n"
+
+    def log_summary(self, log=None):
+        """ステージごとの件数・合計時間・p99 をログに出力する。"""
+        log = log or logger
+        data = self.to_dict()
+        log.info("実行メトリクス: %.1f 秒, %.1f 製品/秒, カウンタ: %s", data['wall_seconds'], data['products_per_second'], data['counters'])
+        for name, stage_data in sorted(data['stages'].items(), key=lambda item: -item[1]['sum_seconds']):
+            log.info("  %-20s 回数=%d 合計=%.3f秒 p50=%.2fms p99=%.2fms",
+                     name, stage_data['count'], stage_data['sum_seconds'],
+                     stage_data['p50_seconds'] * 1000, stage_data['p99_seconds'] * 1000)
+
+
+class NullMetrics:
+    """メトリクスを集計しない場合に RunMetrics の代わりに渡すオブジェクト。"""
+
+    @contextmanager
+    def stage(self, name: str):
+        yield
+
+    def observe(self, name: str, seconds: float):
+        pass
+
+    def incr(self, name: str, value: int = 1):
+        pass
+
+
+NULL_METRICS = NullMetrics()
+
+
+def _write_atomically(path: str, content: str):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(content)
+    os.replace(tmp_path, path)
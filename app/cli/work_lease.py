@@ -0,0 +1,212 @@
+import logging
+import os
+import socket
+import threading
+import time
+import uuid
+
+from db_connection import get_connection, release_connection
+
+# ==============================================================================
+# 複数ホストでの未処理キューのリース
+# = 複数のアプリサーバーで populate_products_and_categories.py を同時に実行できるよう、
+#   (source_api, product_id) ごとのリースを product_work_leases テーブルで管理する。調整役は MySQL だけ。
+#     - 取得 (claim) : 未処理の raw_api_data のうち有効なリースのないキーを SELECT ... FOR UPDATE SKIP LOCKED で選び、
+#                     有効期限付きのリースを INSERT ... ON DUPLICATE KEY UPDATE で取得する。
+#                     同時に取得中の他のランナーがロックした行は待たずに飛ばすため、ランナー同士は互いを待たない。
+#                     同じキーを2つのランナーが選んだ場合も、リース行の主キーでどちらか一方だけが取得する。
+#     - ハートビート : 処理中はバックグラウンドのスレッドが専用の接続でリースの有効期限を延長する。
+#     - 解放 (release): ページの処理後、raw 行がすべて処理済みになったキーのリースを削除する。
+#                     処理に失敗したキーはリースの期限まで (どのランナーからも) 再取得されない。
+#     - 再取得 : ランナーが異常終了した場合、ハートビートが止まり、期限切れのリースは他のランナーが再取得する。
+#   時刻の比較はすべて DB の NOW() で行うため、ホスト間の時計のずれの影響を受けない。
+#
+#   使い方 (各アプリサーバーで実行する):
+#     python app/cli/populate_products_and_categories.py --lease --bulk-size 500
+# ==============================================================================
+
+logger = logging.getLogger(__name__)
+
+LEASE_TABLE = 'product_work_leases'
+DEFAULT_LEASE_SECONDS = 300
+# 期限切れ後もこの秒数 (リースの有効期間の倍数) を超えて残っているリース行は実行開始時に削除する
+STALE_LEASE_MULTIPLIER = 10
+
+CREATE_LEASE_TABLE_SQL = f"""
+    CREATE TABLE IF NOT EXISTS `{LEASE_TABLE}` (
+        `source_api` VARCHAR(50) NOT NULL COMMENT 'データの取得元API',
+        `product_id` VARCHAR(255) NOT NULL COMMENT 'API側のプロダクトID (raw_api_data.product_id)',
+        `owner` VARCHAR(128) NOT NULL COMMENT 'リースを持つランナー (ホスト名:PID:乱数)。空文字列は失敗により放棄されたリース',
+        `claimed_at` DATETIME NOT NULL COMMENT 'リースの取得日時',
+        `expires_at` DATETIME NOT NULL COMMENT 'リースの有効期限 (ハートビートで延長される)',
+        PRIMARY KEY (`source_api`, `product_id`),
+        INDEX `idx_work_leases_owner` (`owner`),
+        INDEX `idx_work_leases_expires` (`expires_at`)
+    ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='未処理キューのキーごとのリース (複数ホストでの並列処理用)'
+"""
+
+
+def ensure_work_lease_table_exists(cursor, conn, database_name: str):
+    """product_work_leases テーブルが存在することを確認し、なければ作成する。"""
+    cursor.execute(
+        "SELECT 1 FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_SCHEMA = %s AND TABLE_NAME = %s",
+        (database_name, LEASE_TABLE),
+    )
+    if cursor.fetchone() is None:
+        logger.info("%s テーブルを作成します...", LEASE_TABLE)
+        cursor.execute(CREATE_LEASE_TABLE_SQL)
+        conn.commit()
+        logger.info("%s テーブルが正常に作成されました。", LEASE_TABLE)
+
+
+def make_lease_owner() -> str:
+    """ランナーを識別するリースの所有者名 (ホスト名:PID:乱数) を返す。"""
+    return f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+
+def purge_stale_leases(cursor, conn, lease_seconds: int = DEFAULT_LEASE_SECONDS) -> int:
+    """期限切れから十分に時間が経ったリース行 (異常終了したランナーの残骸) を削除する。"""
+    cursor.execute(
+        f"DELETE FROM `{LEASE_TABLE}` WHERE expires_at < NOW() - INTERVAL %s SECOND",
+        (lease_seconds * STALE_LEASE_MULTIPLIER,),
+    )
+    purged = cursor.rowcount
+    conn.commit()
+    if purged:
+        logger.info("期限切れの古いリースを %s 件削除しました。", purged)
+    return purged
+
+
+def claim_work(cursor, owner: str, claim_size: int, lease_seconds: int = DEFAULT_LEASE_SECONDS) -> list:
+    """
+    有効なリースのない未処理のキーを最大 claim_size 件選んでリースを取得し、取得できた (product_id, source_api) のリストを返す。
+    候補のキー自体がない場合は None を返す (候補はあったが全て他のランナーに先に取得された場合は空リスト)。
+    呼び出し元のトランザクション内で行い、コミットは呼び出し元で行う (コミットまで選んだ raw 行のロックを保持する)。
+    """
+    # raw 行は複数のスナップショットを持つため、キーの数より多めに読んで重複を除く
+    cursor.execute(f"""
+        SELECT r.product_id, r.source_api
+        FROM raw_api_data r
+        LEFT JOIN `{LEASE_TABLE}` l
+            ON l.source_api = r.source_api AND l.product_id = r.product_id AND l.expires_at > NOW()
+        WHERE r.processed_at IS NULL AND l.product_id IS NULL
+        ORDER BY r.source_api, r.product_id
+        LIMIT %s
+        FOR UPDATE OF r SKIP LOCKED
+    """, (claim_size * 2,))
+    candidates = list(dict.fromkeys(tuple(row) for row in cursor.fetchall()))[:claim_size]
+    if not candidates:
+        return None
+
+    # 期限切れのリースだけを上書きする (ON DUPLICATE KEY UPDATE の代入は左から順に評価されるため、
+    # claimed_at / expires_at は owner を更新した後の値で判定する)
+    row_placeholder = "(%s, %s, %s, NOW(), NOW() + INTERVAL %s SECOND)"
+    params = [value for product_api_id, source_api_name in candidates for value in (source_api_name, product_api_id, owner, lease_seconds)]
+    cursor.execute(f"""
+        INSERT INTO `{LEASE_TABLE}` (source_api, product_id, owner, claimed_at, expires_at)
+        VALUES {", ".join([row_placeholder] * len(candidates))}
+        ON DUPLICATE KEY UPDATE
+            owner = IF(expires_at <= NOW(), VALUES(owner), owner),
+            claimed_at = IF(owner = VALUES(owner), VALUES(claimed_at), claimed_at),
+            expires_at = IF(owner = VALUES(owner), VALUES(expires_at), expires_at)
+    """, params)
+
+    cursor.execute(f"SELECT product_id, source_api FROM `{LEASE_TABLE}` WHERE owner = %s", (owner,))
+    owned = {tuple(row) for row in cursor.fetchall()}
+    return [key for key in candidates if key in owned]
+
+
+def release_work(cursor, owner: str) -> tuple:
+    """
+    処理が終わったキーのリースを削除し、未処理の raw 行が残っているキー (処理に失敗したキー) のリースは放棄する。
+    放棄したリースはハートビートで延長されず、期限切れ後にいずれかのランナーが再取得する。
+    (削除した件数, 放棄した件数) を返す。コミットは呼び出し元で行う。
+    """
+    cursor.execute(f"""
+        DELETE l FROM `{LEASE_TABLE}` l
+        WHERE l.owner = %s
+          AND NOT EXISTS (
+              SELECT 1 FROM raw_api_data r
+              WHERE r.source_api = l.source_api AND r.product_id = l.product_id AND r.processed_at IS NULL
+          )
+    """, (owner,))
+    released = cursor.rowcount
+    cursor.execute(f"UPDATE `{LEASE_TABLE}` SET owner = '' WHERE owner = %s", (owner,))
+    abandoned = cursor.rowcount
+    return released, abandoned
+
+
+def iter_leased_key_pages(cursor, conn, owner: str, page_size: int, lease_seconds: int = DEFAULT_LEASE_SECONDS, time_budget_seconds=None):
+    """
+    リースを取得したキーをページ単位で返すジェネレータ (iter_unprocessed_key_pages のリース版)。
+    次のページを要求された時点で前のページのリースを解放し、新しいリースを取得してコミットする。
+    呼び出し元は次のページを要求する前に前のページの処理をコミットしておくこと。
+    有効なリースのない未処理のキーがなくなるか、time_budget_seconds に達したら終了する。
+    """
+    started = time.monotonic()
+    while True:
+        # 前のページの書き込みはコミット済みのため、ここでは読み取りのトランザクションを終えるだけ
+        conn.commit()
+        # ギャップロックで raw_api_data への取り込みを妨げないよう、リースの取得は READ COMMITTED で行う
+        cursor.execute("SET TRANSACTION ISOLATION LEVEL READ COMMITTED")
+        released, abandoned = release_work(cursor, owner)
+        if abandoned:
+            logger.warning("処理できなかった %s 件のキーのリースを放棄しました (期限切れ後に再取得されます)。", abandoned)
+        if time_budget_seconds is not None and time.monotonic() - started >= time_budget_seconds:
+            conn.commit()
+            logger.info("時間予算 (%s 秒) に達したため、新しいリースを取得せずに終了します。", time_budget_seconds)
+            return
+        page = claim_work(cursor, owner, page_size, lease_seconds)
+        conn.commit()
+        if page is None:
+            return
+        logger.debug("リースを解放: %s 件, 取得: %s 件 (owner: %s)", released, len(page), owner)
+        if page:
+            yield page
+
+
+class LeaseHeartbeat:
+    """
+    処理中のリースの有効期限を定期的に延長するバックグラウンドスレッド。
+    メインループの接続はトランザクションの途中のことがあるため、共通プールから借りた専用の接続で更新・コミットする。
+    """
+
+    def __init__(self, owner: str, lease_seconds: int = DEFAULT_LEASE_SECONDS, interval_seconds=None):
+        self.owner = owner
+        self.lease_seconds = lease_seconds
+        self.interval_seconds = interval_seconds if interval_seconds is not None else max(1.0, lease_seconds / 3)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='lease-heartbeat', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def _run(self):
+        conn = None
+        try:
+            conn = get_connection()
+            cursor = conn.cursor()
+            while not self._stop_event.wait(self.interval_seconds):
+                try:
+                    cursor.execute(
+                        f"UPDATE `{LEASE_TABLE}` SET expires_at = NOW() + INTERVAL %s SECOND WHERE owner = %s",
+                        (self.lease_seconds, self.owner),
+                    )
+                    conn.commit()
+                    logger.debug("リース %s 件の有効期限を延長しました (owner: %s)。", cursor.rowcount, self.owner)
+                except Exception as e:
+                    # 一時的なエラーは次の周期で再試行する (その間に期限が切れたリースは他のランナーに再取得されうる)
+                    logger.warning("リースの延長に失敗しました: %s", e)
+                    if conn.is_connected():
+                        conn.rollback()
+            cursor.close()
+        except Exception as e:
+            logger.error("リースのハートビートを開始できませんでした: %s", e)
+        finally:
+            release_connection(conn)
@@ -10,6 +10,11 @@ DROP TABLE IF EXISTS `product_categories`;
 DROP TABLE IF EXISTS `media`;
 DROP TABLE IF EXISTS `link_clicks`;
 
+-- 処理用の補助テーブルの削除 (外部キーはないが、raw_api_data / products と同時に作り直す)
+DROP TABLE IF EXISTS `product_merge_state`;
+DROP TABLE IF EXISTS `product_work_leases`;
+DROP TABLE IF EXISTS `run_checkpoints`;
+
 -- 主なデータテーブルの削除 (依存関係のないものから)
 DROP TABLE IF EXISTS `products`;
 -- raw_api_data から UNIQUE KEY を削除するため、一度DROPしてからCREATEします。
@@ -49,17 +54,20 @@ CREATE TABLE IF NOT EXISTS `raw_api_data` (
     `fetched_at` DATETIME DEFAULT CURRENT_TIMESTAMP COMMENT 'データ取得日時',
     `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP COMMENT 'レコードが最後に更新された日時',
     `processed_at` DATETIME NULL COMMENT 'products/categoriesへの処理が完了した日時 (NULLの場合は未処理)',
+    `api_response_data_zlib` LONGBLOB NULL COMMENT 'zlib圧縮した api_response_data (圧縮済みの行は api_response_data が JSON の null)',
     -- UNIQUE KEY `idx_product_id_source_api` を削除しました。
     -- 代わりに非ユニークなインデックスを設けます。
     INDEX `idx_product_id_source_api` (`product_id`, `source_api`) COMMENT 'product_idとsource_apiの組み合わせでの検索効率を上げるためのインデックス',
-    INDEX `idx_source_api_processed` (`source_api`, `processed_at`) COMMENT 'ソースAPIと処理状況での検索効率を上げるインデックス'
+    INDEX `idx_source_api_processed` (`source_api`, `processed_at`) COMMENT 'ソースAPIと処理状況での検索効率を上げるインデックス',
+    INDEX `idx_raw_processed_source_product` (`processed_at`, `source_api`, `product_id`) COMMENT '未処理キューを (source_api, product_id) のキーセットページングで走査するためのインデックス',
+    INDEX `idx_raw_processed_fetched` (`processed_at`, `fetched_at`) COMMENT '未処理キューの最古の fetched_at (取り込みの遅れ) をインデックスの先頭1件から求めるためのインデックス'
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='APIから取得した生データを格納するテーブル';
 
 
 -- 4. products テーブル (整形された商品データ用) - 画像カラムを簡素化し、og_imageを追加、カテゴリJSONカラム追加
 CREATE TABLE IF NOT EXISTS `products` (
     `id` INT AUTO_INCREMENT PRIMARY KEY COMMENT '主キー',
-    `product_id` VARCHAR(255) NOT NULL COMMENT 'API側で使用する一意のプロダクトID (UNIQUE制約を削除しました)',
+    `product_id` VARCHAR(255) NOT NULL COMMENT 'API側で使用する一意のプロダクトID (バルクUPSERTの重複判定に uk_products_product_id を使用)',
     `title` VARCHAR(255) NOT NULL COMMENT '商品タイトル',
     `original_title` VARCHAR(255) NULL COMMENT '原題など、元のタイトル',
     `caption` TEXT NULL COMMENT '商品説明やキャプション',
@@ -84,8 +92,10 @@ CREATE TABLE IF NOT EXISTS `products` (
 
     `source_api` VARCHAR(50) NOT NULL COMMENT 'データの取得元API',
     `raw_api_data_id` INT NULL, -- raw_api_dataテーブルへの外部キー
+    `content_hash` CHAR(64) NULL COMMENT '統合済みの製品フィールドとカテゴリ集合のSHA-256 (変更検知用)',
     `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
     `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    UNIQUE KEY `uk_products_product_id` (`product_id`) COMMENT 'バルクUPSERT (INSERT ... ON DUPLICATE KEY UPDATE) 用',
     FOREIGN KEY (`raw_api_data_id`) REFERENCES `raw_api_data`(`id`) ON DELETE SET NULL
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='整形された商品情報を管理するテーブル';
 
@@ -135,3 +145,43 @@ CREATE TABLE IF NOT EXISTS `media` (
     `created_at` DATETIME DEFAULT CURRENT_TIMESTAMP,
     FOREIGN KEY (`user_id`) REFERENCES `users`(`id`) ON DELETE CASCADE
 ) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='ユーザーがアップロードしたメディアファイルを管理するテーブル';
+
+-- 9. product_merge_state テーブル (製品ごとのカテゴリ集合と画像URL候補の統合状態)
+CREATE TABLE IF NOT EXISTS `product_merge_state` (
+    `product_id` VARCHAR(255) NOT NULL COMMENT 'API側のプロダクトID (raw_api_data.product_id)',
+    `source_api` VARCHAR(50) NOT NULL COMMENT 'データの取得元API',
+    `genres_json` JSON NULL COMMENT 'これまでに処理した全スナップショットのジャンル名 (JSON配列)',
+    `actresses_json` JSON NULL COMMENT 'これまでに処理した全スナップショットの女優名 (JSON配列)',
+    `series_json` JSON NULL COMMENT 'これまでに処理した全スナップショットのシリーズ名 (JSON配列)',
+    `image_candidates_json` JSON NULL COMMENT '画像URL候補 (新しいスナップショット順、JSON配列)',
+    `last_raw_api_data_id` INT NULL COMMENT '最後に畳み込んだスナップショットのメイン行 (raw_api_data.id)',
+    `snapshots_merged` INT NOT NULL DEFAULT 0 COMMENT '畳み込んだ raw_api_data の行数',
+    `updated_at` DATETIME DEFAULT CURRENT_TIMESTAMP ON UPDATE CURRENT_TIMESTAMP,
+    PRIMARY KEY (`product_id`, `source_api`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='製品ごとのカテゴリ集合と画像URL候補の統合状態';
+
+-- 10. product_work_leases テーブル (未処理キューのキーごとのリース。複数ホストでの並列処理用)
+CREATE TABLE IF NOT EXISTS `product_work_leases` (
+    `source_api` VARCHAR(50) NOT NULL COMMENT 'データの取得元API',
+    `product_id` VARCHAR(255) NOT NULL COMMENT 'API側のプロダクトID (raw_api_data.product_id)',
+    `owner` VARCHAR(128) NOT NULL COMMENT 'リースを持つランナー (ホスト名:PID:乱数)。空文字列は失敗により放棄されたリース',
+    `claimed_at` DATETIME NOT NULL COMMENT 'リースの取得日時',
+    `expires_at` DATETIME NOT NULL COMMENT 'リースの有効期限 (ハートビートで延長される)',
+    PRIMARY KEY (`source_api`, `product_id`),
+    INDEX `idx_work_leases_owner` (`owner`),
+    INDEX `idx_work_leases_expires` (`expires_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='未処理キューのキーごとのリース (複数ホストでの並列処理用)';
+
+-- 11. run_checkpoints テーブル (長時間実行ジョブの再開用チェックポイント)
+CREATE TABLE IF NOT EXISTS `run_checkpoints` (
+    `run_id` VARCHAR(64) NOT NULL COMMENT '実行ID (再開した実行も同じIDを引き継ぐ)',
+    `job_name` VARCHAR(64) NOT NULL COMMENT 'ジョブ名 (load_data_backfill など)',
+    `status` VARCHAR(20) NOT NULL COMMENT 'running / stopped / failed / completed',
+    `last_source_api` VARCHAR(50) NULL COMMENT 'キーセットの位置: 最後に反映したキーの source_api',
+    `last_product_id` VARCHAR(255) NULL COMMENT 'キーセットの位置: 最後に反映したキーの product_id',
+    `counters_json` JSON NULL COMMENT '実行全体の累計カウンタ',
+    `started_at` DATETIME NOT NULL COMMENT '最初の実行の開始日時',
+    `updated_at` DATETIME NOT NULL COMMENT 'チェックポイントの最終更新日時',
+    PRIMARY KEY (`run_id`),
+    INDEX `idx_run_checkpoints_job_status` (`job_name`, `status`, `updated_at`)
+) ENGINE=InnoDB DEFAULT CHARSET=utf8mb4 COLLATE=utf8mb4_unicode_ci COMMENT='長時間実行ジョブの再開用チェックポイント';
@@ -1,15 +1,19 @@
 import os
+import sys
 import mysql.connector
 import json
 from datetime import datetime
 
-# MySQL接続情報
-DB_CONFIG = {
-    'host': os.getenv('DB_HOST', 'localhost'), # Docker Composeのサービス名 'mysql' が渡される
-    'user': os.getenv('DB_USER', 'root'),
-    'password': os.getenv('DB_PASSWORD', 'your_db_password'), # DB_PASSWORD に統一
-    'database': os.getenv('DB_NAME', 'tiper')
-}
+# db_populator のイメージでは field_map.py / db_connection.py / json_codec.py がこのファイルと同じディレクトリにコピーされる。
+# リポジトリから直接実行する場合は app/cli から読み込む
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app', 'cli'))
+from db_connection import get_connection, release_connection
+from field_map import FieldSpec, compile_field_map
+# row_json_data のデコードは orjson があれば orjson で行う (json_codec.loads)
+from json_codec import loads as json_loads
+
+# MySQL接続情報は app/cli/db_connection.py の DB_CONFIG (環境変数 DB_HOST / DB_USER / DB_PASSWORD / DB_NAME) を使う。
+# 接続は1本だけ借り、ダミーデータの確認と本処理で使い回す
 
 # ==============================================================================
 # ヘルパー関数群
@@ -55,6 +59,34 @@ def clean_string(value):
     s = str(value).strip()
     return s if s else None
 
+# ==============================================================================
+# フィールドマップ (items[].item → products のカラム)
+# = field_map.compile_field_map で1回だけコンパイルし、item 1件から全カラムを1パスで取り出す
+# ==============================================================================
+
+ITEM_FIELDS = (
+    FieldSpec('product_id', ('item', 'content_id'), normalize=clean_string), # content_idも文字列として扱う
+    FieldSpec('title', ('item', 'title'), normalize=clean_string),
+    FieldSpec('original_title', ('item', 'original_title'), normalize=clean_string),
+    FieldSpec('caption', ('item', 'caption'), normalize=clean_string),
+    FieldSpec('release_date', ('item', 'release_date'), normalize=parse_date),
+    FieldSpec('maker_name', ('item', 'maker_name'), normalize=clean_string),
+    FieldSpec('item_no', ('item', 'item_no'), normalize=clean_string),
+    FieldSpec('price', ('item', 'price'), normalize=float, default=0.0), # DECIMAL型に合わせるためfloatに
+    FieldSpec('volume', ('item', 'volume'), normalize=convert_to_int),
+    FieldSpec('url', ('item', 'url'), normalize=clean_string),
+    FieldSpec('affiliate_url', ('item', 'affiliate_url'), normalize=clean_string),
+) + tuple(
+    FieldSpec(f"{image_key}_{size}", ('item', image_key, size), normalize=clean_string)
+    for image_key in ('image_url', 'jacket_url')
+    for size in ('small', 'medium', 'large')
+) + (
+    FieldSpec('sample_movie_url', ('item', 'sample_movie_url'), normalize=clean_string),
+    FieldSpec('sample_movie_capture_url', ('item', 'sample_movie_capture_url'), normalize=clean_string),
+)
+
+ITEM_PLAN = compile_field_map(ITEM_FIELDS, 'ItemRecord')
+
 # ==============================================================================
 # データベース操作関数
 # ==============================================================================
@@ -98,13 +130,15 @@ def insert_raw_api_data(conn, data_json, api_name):
     conn.commit()
     return raw_data_id
 
-def populate_products_from_raw_data():
+def populate_products_from_raw_data(conn=None):
     """
     raw_api_data からデータを読み込み、products テーブルを更新または挿入する。
+    conn を渡した場合はその接続を使い、返却せずに返す (渡さない場合は接続を借りて最後に返却する)。
     """
-    conn = None
+    owns_connection = conn is None
     try:
-        conn = mysql.connector.connect(**DB_CONFIG)
+        if owns_connection:
+            conn = get_connection()
         cursor = conn.cursor()
 
         # productsテーブルにsource_apiカラムは既に存在するため、このALTER TABLEは不要です。
@@ -122,7 +156,7 @@ def populate_products_from_raw_data():
             return
 
         raw_api_data_id = raw_data_row[0] # raw_api_data テーブルのID
-        raw_json_data = json.loads(raw_data_row[1]) # row_json_data の内容
+        raw_json_data = json_loads(raw_data_row[1]) # row_json_data の内容
         source_api_value_from_raw_data = raw_data_row[2] # source_name の内容を source_api として使用
 
         # APIレスポンス構造の仮定: トップレベルに 'items' リストがある
@@ -134,26 +168,11 @@ def populate_products_from_raw_data():
 
         processed_count = 0
         for item_data in items:
-            # ネストされたデータからの安全な値の取得
-            product_id = clean_string(get_safe_value(item_data, ['item', 'content_id'])) # content_idも文字列として扱う
-            title = clean_string(get_safe_value(item_data, ['item', 'title']))
-            original_title = clean_string(get_safe_value(item_data, ['item', 'original_title']))
-            caption = clean_string(get_safe_value(item_data, ['item', 'caption']))
-            release_date = parse_date(get_safe_value(item_data, ['item', 'release_date']))
-            maker_name = clean_string(get_safe_value(item_data, ['item', 'maker_name']))
-            item_no = clean_string(get_safe_value(item_data, ['item', 'item_no']))
-            price = float(get_safe_value(item_data, ['item', 'price'], default=0.0)) # DECIMAL型に合わせるためfloatに
-            volume = convert_to_int(get_safe_value(item_data, ['item', 'volume']), default=0)
-            url = clean_string(get_safe_value(item_data, ['item', 'url']))
-            affiliate_url = clean_string(get_safe_value(item_data, ['item', 'affiliate_url']))
-            image_url_small = clean_string(get_safe_value(item_data, ['item', 'image_url', 'small']))
-            image_url_medium = clean_string(get_safe_value(item_data, ['item', 'image_url', 'medium']))
-            image_url_large = clean_string(get_safe_value(item_data, ['item', 'image_url', 'large']))
-            jacket_url_small = clean_string(get_safe_value(item_data, ['item', 'jacket_url', 'small']))
-            jacket_url_medium = clean_string(get_safe_value(item_data, ['item', 'jacket_url', 'medium']))
-            jacket_url_large = clean_string(get_safe_value(item_data, ['item', 'jacket_url', 'large']))
-            sample_movie_url = clean_string(get_safe_value(item_data, ['item', 'sample_movie_url']))
-            sample_movie_capture_url = clean_string(get_safe_value(item_data, ['item', 'sample_movie_capture_url']))
+            # ネストされたデータからの値の取得 (カラムと JSON パスの対応は ITEM_FIELDS を参照)
+            (product_id, title, original_title, caption, release_date, maker_name, item_no, price, volume,
+             url, affiliate_url, image_url_small, image_url_medium, image_url_large,
+             jacket_url_small, jacket_url_medium, jacket_url_large,
+             sample_movie_url, sample_movie_capture_url) = ITEM_PLAN(item_data)
             
             # productsテーブルの source_api には raw_api_data の source_name を利用
             source_api = source_api_value_from_raw_data
@@ -226,8 +245,9 @@ def populate_products_from_raw_data():
     finally:
         if conn and conn.is_connected():
             cursor.close()
-            conn.close()
-            print("MySQL接続を閉じました。")
+        if owns_connection and conn is not None:
+            release_connection(conn)
+            print("MySQL接続を返却しました。")
 
 # ==============================================================================
 # メイン処理
@@ -239,7 +259,7 @@ if __name__ == "__main__":
     # 以下は、raw_api_dataにデータがない場合にのみ実行する例です。
     conn_check = None
     try:
-        conn_check = mysql.connector.connect(**DB_CONFIG)
+        conn_check = get_connection()
         cursor_check = conn_check.cursor()
         cursor_check.execute("SELECT COUNT(*) FROM raw_api_data WHERE source_name = 'item'")
         if cursor_check.fetchone()[0] == 0:
@@ -313,8 +333,11 @@ if __name__ == "__main__":
     finally:
         if conn_check and conn_check.is_connected():
             cursor_check.close()
-            conn_check.close()
-            print("MySQL接続を閉じました。(ダミーデータチェック)")
 
-    # products テーブルへのデータ投入を実行
-    populate_products_from_raw_data()
\ No newline at end of file
+    # products テーブルへのデータ投入を実行 (ダミーデータの確認と同じ接続を使う)
+    try:
+        populate_products_from_raw_data(conn_check if conn_check and conn_check.is_connected() else None)
+    finally:
+        if conn_check is not None:
+            release_connection(conn_check)
+            print("MySQL接続を返却しました。")
\ No newline at end of file